@@ -0,0 +1,158 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recommends movies for every user of TFRecord files in batch.
+
+Files are split into tasks of users_per_task records, so that every worker
+gets work even with few files. Every worker process streams the users of a
+task in batches, computes their embeddings with the user tower of an
+exported item index, scores them against blocks of the item embeddings, and
+writes the top-k unseen movies of every user to a shard of TSV files:
+
+  user_id<TAB>movie_id,movie_id,...<TAB>score,score,...
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+# Workers run in parallel, so each of them uses a single BLAS thread. This
+# must be set before numpy is imported.
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+# pylint: disable=g-bad-import-order
+from absl import app as absl_app
+from absl import flags
+from concurrent import futures
+import time
+import numpy as np
+import tensorflow as tf
+import input_pipeline
+import item_index
+# pylint: enable=g-bad-import-order
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    name='index_dir', default='./item_index',
+    help='Set a directory of an item index exported by export_item_index.py')
+flags.DEFINE_string(
+    name='input_filename', default='./data/train*.tfrecord',
+    help='Set a pattern of TFRecord files of user histories.')
+flags.DEFINE_string(
+    name='output_dir', default='./recommendations',
+    help='Set a directory where the recommendations are written.')
+flags.DEFINE_integer(
+    name='k', default=10,
+    help='Set the number of movies recommended to every user.')
+flags.DEFINE_integer(
+    name='batch_size', default=1024,
+    help='Set the number of users whose embeddings are scored together.')
+flags.DEFINE_integer(
+    name='item_block_size', default=65536,
+    help='Set the number of items scored at once. A worker holds '
+    'batch_size * item_block_size float32 scores in memory.')
+flags.DEFINE_integer(
+    name='num_workers', default=os.cpu_count(),
+    help='Set the number of processes which recommend TFRecord files.')
+flags.DEFINE_integer(
+    name='users_per_task', default=50000,
+    help='Set the number of users recommended by a task. Smaller tasks '
+    'balance the work of workers better, but skip more records of their '
+    'files before reading their own.')
+
+OUTPUT_FILE = 'recommendations-{:05d}.tsv'
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+_recommender = None
+
+
+def _init_worker(index_dir):
+  global _recommender
+  _recommender = item_index.ItemRecommender(index_dir)
+
+
+def split_tasks(input_files, num_records, users_per_task):
+  """Returns (input_file, start, end) record ranges of users_per_task."""
+  return [
+      (input_file, start, min(start + users_per_task, file_records))
+      for input_file, file_records in zip(input_files, num_records)
+      for start in range(0, file_records, users_per_task)]
+
+
+def recommend_task(input_file, start, end, output_file, k, batch_size,
+                   block_size):
+  """Writes the recommendations of a range of users of a TFRecord file.
+
+  Returns:
+    The output file and the number of users.
+  """
+  num_users = 0
+  with tf.gfile.GFile(output_file, 'w') as f:
+    for user_ids, histories in input_pipeline.read_histories(
+        input_file, batch_size, start, end):
+      user_embeddings = _recommender.user_embeddings(histories)
+      ids, scores = item_index.top_k_unseen(
+          user_embeddings, _recommender.item_embeddings, histories, k,
+          block_size)
+      for user_id, movie_ids, user_scores in zip(user_ids, ids, scores):
+        # Users who have seen nearly every movie get fewer recommendations.
+        valid = np.isfinite(user_scores)
+        f.write('{}\t{}\t{}\n'.format(
+            user_id, ','.join(str(i) for i in movie_ids[valid]),
+            ','.join('{:.5f}'.format(s) for s in user_scores[valid])))
+      num_users += len(user_ids)
+  return output_file, num_users
+
+
+def main(_):
+  input_files = sorted(tf.gfile.Glob(FLAGS.input_filename))
+  if not input_files:
+    raise ValueError('No file matches {}'.format(FLAGS.input_filename))
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  start = time.time()
+  total_users = 0
+  with futures.ProcessPoolExecutor(
+      max_workers=FLAGS.num_workers, initializer=_init_worker,
+      initargs=(FLAGS.index_dir,)) as executor:
+    num_records = list(executor.map(input_pipeline.count_records, input_files))
+    tasks = split_tasks(input_files, num_records, FLAGS.users_per_task)
+    tf.logging.info('Recommending for the {} users of {} files in {} '
+                    'tasks...'.format(
+                        sum(num_records), len(input_files), len(tasks)))
+    jobs = [
+        executor.submit(
+            recommend_task, input_file, task_start, task_end,
+            os.path.join(FLAGS.output_dir, OUTPUT_FILE.format(task_id)),
+            FLAGS.k, FLAGS.batch_size, FLAGS.item_block_size)
+        for task_id, (input_file, task_start, task_end) in enumerate(tasks)]
+    for job in futures.as_completed(jobs):
+      output_file, num_users = job.result()
+      total_users += num_users
+      tf.logging.info('Exported {} ({} users, {:.0f} users/sec so far)'.format(
+          output_file, num_users, total_users / (time.time() - start)))
+
+  elapsed = time.time() - start
+  tf.logging.info('Recommended for {} users in {:.1f} secs: {:.0f} users/sec '
+                  'with {} workers.'.format(
+                      total_users, elapsed, total_users / elapsed,
+                      FLAGS.num_workers))
+
+if __name__ == '__main__':
+  absl_app.run(main)
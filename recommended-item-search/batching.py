@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request batching and caching of the recommendation server."""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+
+class LRUCache(object):
+  """A thread-safe cache which evicts the least recently used entries."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      if key not in self._entries:
+        return None
+      self._entries.move_to_end(key)
+      return self._entries[key]
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class _Request(object):
+
+  def __init__(self, value):
+    self.value = value
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class MicroBatcher(object):
+  """Groups values submitted by concurrent threads into batched calls.
+
+  A background thread waits for the first pending value, then for at most
+  max_wait_secs for more values, and calls batch_fn with up to
+  max_batch_size values. batch_fn returns one result per value.
+  """
+
+  def __init__(self, batch_fn, max_batch_size=32, max_wait_secs=0.002):
+    self._batch_fn = batch_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait_secs = max_wait_secs
+    self._requests = queue.Queue()
+    worker = threading.Thread(target=self._run, daemon=True)
+    worker.start()
+
+  def submit(self, value):
+    """Returns the result of value, once its batch is processed."""
+    request = _Request(value)
+    self._requests.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+  def _next_batch(self):
+    batch = [self._requests.get()]
+    deadline = time.time() + self._max_wait_secs
+    while len(batch) < self._max_batch_size:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(self._requests.get(timeout=remaining))
+      except queue.Empty:
+        break
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      try:
+        results = self._batch_fn([request.value for request in batch])
+        for request, result in zip(batch, results):
+          request.result = result
+      except Exception as error:  # pylint: disable=broad-except
+        logging.exception('Batched call failed.')
+        for request in batch:
+          request.error = error
+      for request in batch:
+        request.done.set()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of batching.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent import futures
+import unittest
+import batching
+
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_least_recently_used_entry_is_evicted(self):
+    cache = batching.LRUCache(2)
+    cache.put(('a', 10), 1)
+    cache.put(('b', 10), 2)
+    self.assertEqual(cache.get(('a', 10)), 1)
+    cache.put(('c', 10), 3)
+    self.assertIsNone(cache.get(('b', 10)))
+    self.assertEqual(cache.get(('a', 10)), 1)
+    self.assertEqual(len(cache), 2)
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+  def test_concurrent_values_are_batched(self):
+    batch_sizes = []
+
+    def square(values):
+      batch_sizes.append(len(values))
+      return [value ** 2 for value in values]
+
+    batcher = batching.MicroBatcher(square, max_batch_size=4,
+                                    max_wait_secs=0.2)
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+      results = list(executor.map(batcher.submit, range(8)))
+    self.assertEqual(results, [value ** 2 for value in range(8)])
+    self.assertTrue(all(size <= 4 for size in batch_sizes))
+    self.assertLess(len(batch_sizes), 8)
+
+  def test_errors_are_raised_to_the_submitter(self):
+
+    def fail(values):
+      raise ValueError('failed')
+
+    batcher = batching.MicroBatcher(fail)
+    with self.assertRaises(ValueError):
+      batcher.submit(1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,12 +20,13 @@ from __future__ import print_function
 
 from absl import app as absl_app
 from absl import flags
+from concurrent import futures
 import numpy as np
 import os
 import pandas
-import pickle
 import tempfile
 import tensorflow as tf
+import metadata
 import urllib
 import zipfile
 
@@ -46,31 +47,63 @@ flags.DEFINE_string(
 flags.DEFINE_float(
     name='rating_threshold', default=4.0,
     help='Ignore movies which rating is lower than the threshold.')
+flags.DEFINE_integer(
+    name='since_timestamp', default=0,
+    help='Only keep ratings from this unix timestamp onwards, e.g. the '
+    'ratings since the last training to warm start from it. Keeps all '
+    'ratings if 0.')
+flags.DEFINE_integer(
+    name='num_workers', default=os.cpu_count(),
+    help='Set the number of processes which serialize TFRecord files.')
+flags.DEFINE_integer(
+    name='chunksize', default=0,
+    help='Stream ratings.csv in chunks of this number of rows, and build '
+    'user histories out of core. Loads all ratings in memory if 0.')
+flags.DEFINE_integer(
+    name='num_partitions', default=64,
+    help='Set the number of on-disk partitions of ratings by user id, when '
+    'streaming. Memory usage is bounded by the size of a partition.')
+flags.DEFINE_string(
+    name='partition_dir', default=None,
+    help='Specify a local directory for the on-disk partitions of ratings. '
+    'A temporary directory is used if not set.')
+
+NUM_TRAIN_FILES = 8
+NUM_EVAL_FILES = 1
+HOLDOUT_FRACTION = 0.1
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
-def load_movielens_data():
-  # Download MovieLens dataset
+RATINGS_COLUMNS = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
+
+def download_movielens_data():
+  """Downloads and extracts MovieLens dataset, returns its directory."""
   urllib.request.urlretrieve(
       url=os.path.join(FLAGS.base_url, FLAGS.filename),
       filename=FLAGS.filename)
-  
-  # Extract MovieLens dataset from zipfile
   zipfile.ZipFile(FLAGS.filename, 'r').extractall()
+  return FLAGS.filename.split('.')[0]
 
-  # Load MovieLens dataset
-  tmp_dir = FLAGS.filename.split('.')[0]
-  movies = pandas.read_csv(
-      filepath_or_buffer=os.path.join(tmp_dir, 'movies.csv'),
+def remove_movielens_data(data_dir):
+  tf.gfile.DeleteRecursively(data_dir)
+  tf.gfile.Remove(FLAGS.filename)
+
+def load_movies(data_dir):
+  return pandas.read_csv(
+      filepath_or_buffer=os.path.join(data_dir, 'movies.csv'),
       names=['movie_id', 'title', 'genres'], header=0)
+
+def load_movielens_data():
+  data_dir = download_movielens_data()
+
+  # Load MovieLens dataset
+  movies = load_movies(data_dir)
   ratings = pandas.read_csv(
-      filepath_or_buffer=os.path.join(tmp_dir, 'ratings.csv'),
-      names=['user_id', 'movie_id', 'rating', 'unix_timestamp'],
-      header=0)
+      filepath_or_buffer=os.path.join(data_dir, 'ratings.csv'),
+      names=RATINGS_COLUMNS, header=0)
   
   # Remove unnecessary files.
-  tf.gfile.DeleteRecursively(tmp_dir)
-  tf.gfile.Remove(FLAGS.filename)
+  remove_movielens_data(data_dir)
   return movies, ratings
 
 def split_dataframe(dataframe, holdout_fraction=0.1):
@@ -86,25 +119,21 @@ def split_dataframe(dataframe, holdout_fraction=0.1):
   train = dataframe[~dataframe.index.isin(test.index)]
   return train, test
 
-def make_sequence_example(user_id, movie_ids):
-  """Returns a SequenceExample for the given user_id and movie_ids.
+def make_example(user_id, movie_ids):
+  """Returns an Example for the given user_id and movie_ids.
   Args:
     user_id: An user_id.
-    movie_ids: A list of strings.
+    movie_ids: A list of movie ids.
   Returns:
-    A tf.train.SequenceExample containing user_id and movie_ids.
+    A tf.train.Example containing user_id and movie_ids, packed in a single
+    Int64List.
   """
-  def _int64_feature(value):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
-  feature = {'user_id': _int64_feature(user_id)}
-  movie_id_features = [
-      tf.train.Feature(int64_list=tf.train.Int64List(value=[id_]))
-      for id_ in movie_ids]
-  feature_list = {'movie_ids': tf.train.FeatureList(feature=movie_id_features)}
-  features = tf.train.Features(feature=feature)
-  feature_lists = tf.train.FeatureLists(feature_list=feature_list)
-  return tf.train.SequenceExample(context=features, feature_lists=feature_lists)
+  feature = {
+      'user_id': tf.train.Feature(
+          int64_list=tf.train.Int64List(value=[user_id])),
+      'movie_ids': tf.train.Feature(
+          int64_list=tf.train.Int64List(value=movie_ids))}
+  return tf.train.Example(features=tf.train.Features(feature=feature))
 
 def split_range(num_records, num_buckets):
   interval = num_records // num_buckets
@@ -112,52 +141,164 @@ def split_range(num_records, num_buckets):
   tail_ids = head_ids[1:] + [num_records]
   return list(zip(head_ids, tail_ids))
 
+def write_tfrecord_file(export_path, user_ids, movie_ids):
+  """Writes a TFRecord file of one Example per user."""
+  with tf.python_io.TFRecordWriter(export_path) as record_writer:
+    for user_id, ids in zip(user_ids, movie_ids):
+      record_writer.write(make_example(user_id, ids).SerializeToString())
+  return export_path
+
 def make_tfrecord_files(dataframe, file_type, num_files):
-  """Writes training and test data in TFRecord format."""
-  user_id = dataframe['user_id'].values
-  movie_ids = dataframe['movie_id2'].values
+  """Writes training and test data in TFRecord format, in parallel."""
+  user_id = [int(id_) for id_ in dataframe['user_id'].values]
+  movie_ids = [np.asarray(ids).tolist() for ids in dataframe['movie_id2'].values]
   
   N = dataframe.shape[0]
-  for file_id, head_tail in enumerate(split_range(N, num_files)):
-    export_file = "{}-{:05d}.tfrecord".format(file_type, file_id)
-    export_path = os.path.join(FLAGS.export_dir, export_file)
-    with tf.python_io.TFRecordWriter(export_path) as record_writer:
-      for i in range(head_tail[0], head_tail[1]):
-        sequence_example = make_sequence_example(user_id[i], movie_ids[i])
-        record_writer.write(sequence_example.SerializeToString())
+  with futures.ProcessPoolExecutor(max_workers=FLAGS.num_workers) as executor:
+    jobs = []
+    for file_id, (head, tail) in enumerate(split_range(N, num_files)):
+      export_file = "{}-{:05d}.tfrecord".format(file_type, file_id)
+      export_path = os.path.join(FLAGS.export_dir, export_file)
+      jobs.append(executor.submit(
+          write_tfrecord_file, export_path, user_id[head:tail],
+          movie_ids[head:tail]))
+    for job in futures.as_completed(jobs):
+      tf.logging.info('Exported {}'.format(job.result()))
 
-def main(_):
-  tf.logging.info('Download {} ...'.format(FLAGS.filename))
-  movies, ratings = load_movielens_data()
-  movieid_to_index = dict(zip(movies['movie_id'].values, np.arange(len(movies))))
-  movies['movie_id2'] = movies['movie_id'].apply(lambda x: movieid_to_index[x])
-  ratings['movie_id2'] = ratings['movie_id'].apply(lambda x: movieid_to_index[x])
-  
-  tf.logging.info('Converting dataset ...')
-  ratings = ratings[ratings['rating'] > FLAGS.rating_threshold]
-  rawdata = (
-      ratings[['user_id', 'movie_id2']]
-      .groupby('user_id', as_index=False).aggregate(lambda x: list(x)))
-  
+def group_by_user(user_ids, movie_ids):
+  """Groups movie ids by user, keeping the order of each user's movies."""
+  order = np.argsort(user_ids, kind='mergesort')
+  user_ids, movie_ids = user_ids[order], movie_ids[order]
+  unique_user_ids, heads = np.unique(user_ids, return_index=True)
+  return unique_user_ids, np.split(movie_ids, heads[1:])
+
+def partition_ratings(ratings_path, movies, partition_dir):
+  """Streams ratings into on-disk partitions of (user_id, movie_id2) pairs.
+
+  Ratings are read by chunks of FLAGS.chunksize rows, filtered by
+  FLAGS.rating_threshold and FLAGS.since_timestamp, and appended to one of
+  FLAGS.num_partitions files chosen by user id, so that all ratings of a
+  user are in the same file.
+
+  Returns:
+    Paths of the partition files, and the number of ratings of each movie.
+  """
+  paths = [os.path.join(partition_dir, 'part-{:05d}.bin'.format(i))
+           for i in range(FLAGS.num_partitions)]
+  partition_files = [open(path, 'wb') for path in paths]
+  counts = np.zeros(len(movies), dtype=np.int64)
+  try:
+    chunks = pandas.read_csv(
+        filepath_or_buffer=ratings_path, names=RATINGS_COLUMNS, header=0,
+        usecols=['user_id', 'movie_id', 'rating', 'unix_timestamp'],
+        chunksize=FLAGS.chunksize)
+    for chunk in chunks:
+      chunk = chunk[(chunk['rating'] > FLAGS.rating_threshold) &
+                    (chunk['unix_timestamp'] >= FLAGS.since_timestamp)]
+      pairs = np.empty((len(chunk), 2), dtype=np.int64)
+      pairs[:, 0] = chunk['user_id'].values
+      pairs[:, 1] = pandas.Categorical(
+          chunk['movie_id'], categories=movies['movie_id']).codes
+      pairs = pairs[pairs[:, 1] >= 0]
+      counts += np.bincount(pairs[:, 1], minlength=len(movies))
+      partitions = pairs[:, 0] % FLAGS.num_partitions
+      for i in np.unique(partitions):
+        pairs[partitions == i].tofile(partition_files[i])
+  finally:
+    for partition_file in partition_files:
+      partition_file.close()
+  return paths, counts
+
+def make_tfrecord_files_from_partitions(paths):
+  """Writes training and test data from partitions, one at a time."""
+  random_state = np.random.RandomState()
+  train_writers = [
+      tf.python_io.TFRecordWriter(os.path.join(
+          FLAGS.export_dir, 'train-{:05d}.tfrecord'.format(file_id)))
+      for file_id in range(NUM_TRAIN_FILES)]
+  eval_writers = [
+      tf.python_io.TFRecordWriter(os.path.join(
+          FLAGS.export_dir, 'eval-{:05d}.tfrecord'.format(file_id)))
+      for file_id in range(NUM_EVAL_FILES)]
+  num_train, num_eval = 0, 0
+  try:
+    for path in paths:
+      pairs = np.fromfile(path, dtype=np.int64).reshape(-1, 2)
+      user_ids, movie_ids = group_by_user(pairs[:, 0], pairs[:, 1])
+      is_eval = random_state.rand(len(user_ids)) < HOLDOUT_FRACTION
+      for user_id, ids, to_eval in zip(user_ids, movie_ids, is_eval):
+        example = make_example(int(user_id), ids.tolist()).SerializeToString()
+        if to_eval:
+          eval_writers[num_eval % NUM_EVAL_FILES].write(example)
+          num_eval += 1
+        else:
+          train_writers[num_train % NUM_TRAIN_FILES].write(example)
+          num_train += 1
+      tf.logging.info('Exported users of {}'.format(path))
+  finally:
+    for writer in train_writers + eval_writers:
+      writer.close()
+  tf.logging.info('Exported {} training and {} eval users'.format(
+      num_train, num_eval))
+
+def reset_export_dir():
   if tf.gfile.Exists(FLAGS.export_dir):
     tf.logging.info('Remove {} ...'.format(FLAGS.export_dir))
     tf.gfile.DeleteRecursively(FLAGS.export_dir)
   tf.gfile.MakeDirs(FLAGS.export_dir)
+
+def prepare_in_memory():
+  """Prepares TFRecord files with all ratings loaded in memory."""
+  movies, ratings = load_movielens_data()
+  movies['movie_id2'] = np.arange(len(movies))
+  ratings['movie_id2'] = pandas.Categorical(
+      ratings['movie_id'], categories=movies['movie_id']).codes
+  
+  tf.logging.info('Converting dataset ...')
+  ratings = ratings[(ratings['rating'] > FLAGS.rating_threshold) &
+                    (ratings['movie_id2'] >= 0) &
+                    (ratings['unix_timestamp'] >= FLAGS.since_timestamp)]
+  counts = np.bincount(ratings['movie_id2'].values, minlength=len(movies))
+  user_ids, movie_ids = group_by_user(
+      ratings['user_id'].values, ratings['movie_id2'].values)
+  rawdata = pandas.DataFrame({'user_id': user_ids, 'movie_id2': movie_ids})
+  del ratings
   
+  reset_export_dir()
   tf.logging.info('Exporting TFRecord to {}'.format(FLAGS.export_dir))
-  train_inputs, eval_inputs = split_dataframe(rawdata)
-  make_tfrecord_files(dataframe=train_inputs, file_type='train', num_files=8)
-  make_tfrecord_files(dataframe=eval_inputs, file_type='eval', num_files=1)
+  train_inputs, eval_inputs = split_dataframe(rawdata, HOLDOUT_FRACTION)
+  make_tfrecord_files(
+      dataframe=train_inputs, file_type='train', num_files=NUM_TRAIN_FILES)
+  make_tfrecord_files(
+      dataframe=eval_inputs, file_type='eval', num_files=NUM_EVAL_FILES)
+  return movies, user_ids, movie_ids, counts
+
+def prepare_streaming():
+  """Prepares TFRecord files with bounded memory, streaming ratings."""
+  data_dir = download_movielens_data()
+  movies = load_movies(data_dir)
+  movies['movie_id2'] = np.arange(len(movies))
+
+  reset_export_dir()
+  with tempfile.TemporaryDirectory(dir=FLAGS.partition_dir) as partition_dir:
+    tf.logging.info('Partitioning ratings in {} ...'.format(partition_dir))
+    paths, counts = partition_ratings(
+        os.path.join(data_dir, 'ratings.csv'), movies, partition_dir)
+    remove_movielens_data(data_dir)
+    tf.logging.info('Exporting TFRecord to {}'.format(FLAGS.export_dir))
+    make_tfrecord_files_from_partitions(paths)
+  return movies, None, None, counts
+
+def main(_):
+  tf.logging.info('Download {} ...'.format(FLAGS.filename))
+  if FLAGS.chunksize:
+    movies, user_ids, histories, counts = prepare_streaming()
+  else:
+    movies, user_ids, histories, counts = prepare_in_memory()
   
   tf.logging.info('Exporting metadata to {}'.format(FLAGS.export_dir))
-  with tempfile.TemporaryDirectory() as tmp_dir:
-    filename = 'metadata.pickle'
-    metadata = {'N': len(movies), 'movies': movies, 'rawdata': rawdata}
-    old_path = os.path.join(tmp_dir, filename)
-    new_path = os.path.join(FLAGS.export_dir, filename)
-    with open(old_path, 'wb') as f:
-      pickle.dump(metadata, f)
-    tf.gfile.Copy(old_path, new_path, overwrite=True)
+  metadata.write_metadata(
+      FLAGS.export_dir, movies, counts, user_ids=user_ids, histories=histories)
     
   tf.logging.info('Exporting an index file for TensorBoard projector')
   with tempfile.TemporaryDirectory() as tmp_dir:
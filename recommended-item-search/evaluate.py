@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Evaluates a checkpoint of the softmax model offline.
+
+A random fraction of the movies of every eval user is held out. The user
+embedding is computed from the other movies, all unseen movies are scored
+in blocks, and precision, recall and NDCG at several k are averaged over
+users. Metrics are logged and written as summaries of the checkpoint step,
+so that they appear in TensorBoard next to the training curves. This
+replaces the in-graph precision_at_10, which is disabled with
+softmax_main.py --noeval_in_graph_metrics.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# pylint: disable=g-bad-import-order
+from absl import app as absl_app
+from absl import flags
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import input_pipeline
+import item_index
+# pylint: enable=g-bad-import-order
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    name='model_dir', default='./model',
+    help='Set a model directory where checkpoint files are stored.')
+flags.DEFINE_string(
+    name='checkpoint_path', default=None,
+    help='Set a checkpoint to evaluate. The latest checkpoint of model_dir '
+    'is evaluated if not set.')
+flags.DEFINE_string(
+    name='eval_filename', default='eval*.tfrecord',
+    help='Set a file pattern of evaluation inputs.')
+flags.DEFINE_enum(
+    name='activation', default='relu',
+    enum_values=['relu', 'None'], case_sensitive=False,
+    help='Specify the activation function used in hidden layers.')
+flags.DEFINE_list(
+    name='k_values', default=['1', '5', '10', '20', '50'],
+    help='Set the cutoffs of precision, recall and NDCG.')
+flags.DEFINE_float(
+    name='holdout_fraction', default=0.2,
+    help='Set the fraction of the movies of every user which are held out '
+    'as targets. Users with fewer than 2 movies are skipped.')
+flags.DEFINE_integer(
+    name='batch_size', default=1024,
+    help='Set the number of users whose embeddings are scored together.')
+flags.DEFINE_integer(
+    name='item_block_size', default=65536,
+    help='Set the number of items scored at once. Memory is bounded by '
+    'batch_size * item_block_size float32 scores.')
+flags.DEFINE_integer(
+    name='max_users', default=0,
+    help='Stop after evaluating this number of users, or all users if 0.')
+flags.DEFINE_integer(
+    name='seed', default=20190501,
+    help='Set random seed for holding out movies.')
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def split_histories(user_ids, histories, holdout_fraction, seed):
+  """Splits every history into input movies and held out target movies.
+
+  The movies of every user are drawn from a random state seeded by the seed
+  and the user id, so that they do not depend on the batches of users.
+
+  Returns:
+    The (inputs, targets) lists, without the histories of fewer than 2
+    movies.
+  """
+  inputs, targets = [], []
+  for user_id, history in zip(user_ids, histories):
+    history = np.unique(history[history >= 0])
+    if len(history) < 2:
+      continue
+    num_targets = min(len(history) - 1,
+                      max(1, int(round(len(history) * holdout_fraction))))
+    random_state = np.random.RandomState(
+        [seed % 2 ** 32, int(user_id) % 2 ** 32])
+    permutation = random_state.permutation(len(history))
+    targets.append(history[permutation[:num_targets]])
+    inputs.append(history[permutation[num_targets:]])
+  return inputs, targets
+
+
+def ranking_metrics(top_ids, targets, k_values):
+  """Returns the sums over users of precision, recall and NDCG at each k.
+
+  Args:
+    top_ids: the ranked movie ids of every user, of shape (users, max k).
+    targets: the held out movie ids of every user.
+    k_values: the cutoffs, at most top_ids.shape[1].
+  """
+  num_users, max_k = top_ids.shape
+  # Hits are found at once by encoding (user, movie) pairs as integers.
+  num_movies = int(max(top_ids.max(initial=0),
+                       max(target.max() for target in targets))) + 1
+  rows = np.arange(num_users, dtype=np.int64)[:, np.newaxis]
+  target_codes = np.concatenate([
+      user * num_movies + target for user, target in enumerate(targets)])
+  hits = np.isin(rows * num_movies + top_ids, target_codes)
+
+  num_targets = np.array([len(target) for target in targets])
+  discounts = 1. / np.log2(np.arange(2, max_k + 2))
+  ideal_gains = np.cumsum(discounts)
+  metrics = {}
+  for k in k_values:
+    num_hits = hits[:, :k].sum(axis=1)
+    dcg = hits[:, :k].dot(discounts[:k])
+    idcg = ideal_gains[np.minimum(num_targets, k) - 1]
+    metrics['precision_at_{}'.format(k)] = (num_hits / k).sum()
+    metrics['recall_at_{}'.format(k)] = (num_hits / num_targets).sum()
+    metrics['ndcg_at_{}'.format(k)] = (dcg / idcg).sum()
+  return metrics
+
+
+def evaluate(checkpoint, eval_filename, activation, k_values,
+             holdout_fraction, batch_size, item_block_size, max_users=0,
+             seed=0):
+  """Evaluates a checkpoint on the users of the eval files.
+
+  Returns:
+    A dict of metric names to their averages over users, with the
+    throughput of the evaluation in users/sec.
+  """
+  item_embeddings = item_index.load_item_embeddings(checkpoint)
+  layers = item_index.load_user_tower(checkpoint)
+  k_values = sorted(set(k_values))
+  max_k = min(k_values[-1], item_embeddings.shape[0])
+  k_values = [k for k in k_values if k <= max_k]
+
+  totals = {}
+  num_users = 0
+  start = time.time()
+  for eval_file in sorted(tf.gfile.Glob(eval_filename)):
+    for user_ids, histories in input_pipeline.read_histories(
+        eval_file, batch_size):
+      inputs, targets = split_histories(
+          user_ids, histories, holdout_fraction, seed)
+      if max_users:
+        inputs, targets = (inputs[:max_users - num_users],
+                           targets[:max_users - num_users])
+      if not inputs:
+        continue
+      user_embeddings = item_index.compute_user_embeddings(
+          item_embeddings, layers, activation, inputs)
+      top_ids, _ = item_index.top_k_unseen(
+          user_embeddings, item_embeddings, inputs, max_k, item_block_size)
+      for name, value in ranking_metrics(top_ids, targets, k_values).items():
+        totals[name] = totals.get(name, 0.) + value
+      num_users += len(inputs)
+      if max_users and num_users >= max_users:
+        break
+    tf.logging.info('Evaluated {} users, {:.0f} users/sec so far.'.format(
+        num_users, num_users / (time.time() - start)))
+    if max_users and num_users >= max_users:
+      break
+
+  if not num_users:
+    raise ValueError('No eval user has 2 movies or more in {}'.format(
+        eval_filename))
+  metrics = dict(
+      (name, total / num_users) for name, total in totals.items())
+  metrics['num_users'] = num_users
+  metrics['users_per_sec'] = num_users / (time.time() - start)
+  return metrics
+
+
+def write_summaries(model_dir, checkpoint, metrics):
+  """Writes the metrics as summaries of the global step of the checkpoint."""
+  global_step = int(tf.train.load_variable(
+      checkpoint, tf.GraphKeys.GLOBAL_STEP))
+  writer = tf.summary.FileWriter(os.path.join(model_dir, 'eval_offline'))
+  writer.add_summary(tf.Summary(value=[
+      tf.Summary.Value(tag=name, simple_value=value)
+      for name, value in sorted(metrics.items())]), global_step)
+  writer.close()
+
+
+def main(_):
+  checkpoint = (FLAGS.checkpoint_path or
+                tf.train.latest_checkpoint(FLAGS.model_dir))
+  if checkpoint is None:
+    raise ValueError('No checkpoint is found in {}'.format(FLAGS.model_dir))
+  tf.logging.info('Evaluating {} ...'.format(checkpoint))
+  metrics = evaluate(
+      checkpoint, FLAGS.eval_filename, FLAGS.activation,
+      [int(k) for k in FLAGS.k_values], FLAGS.holdout_fraction,
+      FLAGS.batch_size, FLAGS.item_block_size, FLAGS.max_users, FLAGS.seed)
+  for name, value in sorted(metrics.items()):
+    tf.logging.info('{}: {:.4f}'.format(name, value))
+  write_summaries(FLAGS.model_dir, checkpoint, metrics)
+
+if __name__ == '__main__':
+  absl_app.run(main)
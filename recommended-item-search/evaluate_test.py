@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of evaluate.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+import evaluate
+
+USER_IDS = [3, 8, 21, 34, 55]
+HISTORIES = np.array([[1, 2, 3, 4, 5, 6],
+                      [7, -1, -1, -1, -1, -1],
+                      [9, 9, 10, -1, -1, -1],
+                      [11, 12, 13, 14, -1, -1],
+                      [-1, -1, -1, -1, -1, -1]])
+
+
+class RankingMetricsTest(unittest.TestCase):
+
+  def test_metrics_of_hand_ranked_users(self):
+    top_ids = np.array([[1, 2, 3], [4, 5, 6]])
+    targets = [np.array([2, 9]), np.array([4])]
+    metrics = evaluate.ranking_metrics(top_ids, targets, [1, 3])
+    # The first user hits at rank 2 out of 2 targets, the second at rank 1.
+    self.assertAlmostEqual(metrics['precision_at_1'], 1.)
+    self.assertAlmostEqual(metrics['recall_at_1'], 1.)
+    self.assertAlmostEqual(metrics['ndcg_at_1'], 1.)
+    self.assertAlmostEqual(metrics['precision_at_3'], 2. / 3)
+    self.assertAlmostEqual(metrics['recall_at_3'], 1.5)
+    second_rank = 1. / np.log2(3)
+    self.assertAlmostEqual(metrics['ndcg_at_3'],
+                           1. + second_rank / (1. + second_rank))
+
+  def test_no_hits(self):
+    metrics = evaluate.ranking_metrics(
+        np.array([[1, 2]]), [np.array([3])], [2])
+    self.assertEqual(metrics, {'precision_at_2': 0., 'recall_at_2': 0.,
+                               'ndcg_at_2': 0.})
+
+
+class SplitHistoriesTest(unittest.TestCase):
+
+  def test_targets_are_disjoint_from_inputs(self):
+    inputs, targets = evaluate.split_histories(
+        USER_IDS, HISTORIES, 0.5, seed=0)
+    self.assertEqual(len(inputs), 3)
+    for history, user_inputs, user_targets in zip(
+        HISTORIES[[0, 2, 3]], inputs, targets):
+      self.assertTrue(len(user_inputs) and len(user_targets))
+      self.assertFalse(set(user_inputs) & set(user_targets))
+      self.assertEqual(set(user_inputs) | set(user_targets),
+                       set(history[history >= 0]))
+
+  def test_split_does_not_depend_on_batches(self):
+    inputs, targets = evaluate.split_histories(
+        USER_IDS, HISTORIES, 0.5, seed=7)
+    batched_inputs, batched_targets = [], []
+    for start in range(0, len(USER_IDS), 2):
+      batch_inputs, batch_targets = evaluate.split_histories(
+          USER_IDS[start:start + 2], HISTORIES[start:start + 2], 0.5, seed=7)
+      batched_inputs += batch_inputs
+      batched_targets += batch_targets
+    for expected, actual in zip(inputs + targets,
+                                batched_inputs + batched_targets):
+      np.testing.assert_array_equal(expected, actual)
+
+  def test_at_least_one_input_is_kept(self):
+    inputs, _ = evaluate.split_histories(USER_IDS, HISTORIES, 1., seed=0)
+    for user_inputs in inputs:
+      self.assertEqual(len(user_inputs), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
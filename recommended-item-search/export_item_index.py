@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# pylint: disable=g-bad-import-order
+from absl import app as absl_app
+from absl import flags
+import time
+import tensorflow as tf
+import item_index
+# pylint: enable=g-bad-import-order
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    name='model_dir', default='./model',
+    help='Set a model directory where checkpoint files are stored.')
+flags.DEFINE_string(
+    name='checkpoint_path', default=None,
+    help='Set a checkpoint to export, such as the one of the SavedModel '
+    'served by recommend_server.py. The latest checkpoint of model_dir is '
+    'exported if not set.')
+flags.DEFINE_string(
+    name='metadata_path', default='metadata.json',
+    help='Set a path to metadata created by data_preparation.py')
+flags.DEFINE_enum(
+    name='activation', default='relu',
+    enum_values=['relu', 'None'], case_sensitive=False,
+    help='Specify the activation function used in hidden layers.')
+flags.DEFINE_string(
+    name='output_dir', default='./item_index',
+    help='Set a directory where the item index is exported.')
+flags.DEFINE_enum(
+    name='index_type', default='brute_force',
+    enum_values=item_index.INDEX_TYPES,
+    help='Specify brute force scoring, or an Annoy index for large '
+    'catalogues.')
+flags.DEFINE_integer(
+    name='num_trees', default=100,
+    help='Set the number of trees of the Annoy index.')
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def main(_):
+  item_index.export_item_index(
+      model_dir=FLAGS.model_dir, metadata_path=FLAGS.metadata_path,
+      activation=FLAGS.activation, output_dir=FLAGS.output_dir,
+      index_type=FLAGS.index_type, num_trees=FLAGS.num_trees,
+      checkpoint_path=FLAGS.checkpoint_path)
+
+  recommender = item_index.ItemRecommender(FLAGS.output_dir)
+  history = list(range(min(5, recommender.num_items)))
+  start = time.time()
+  recommendations = recommender.recommend(history)
+  tf.logging.info('Recommended in {:.2f} ms for history {}: {}'.format(
+      (time.time() - start) * 1000, history,
+      [item['title'] for item in recommendations]))
+
+if __name__ == '__main__':
+  absl_app.run(main)
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import resource
+import time
+import tensorflow as tf
+
+
+class ThroughputHook(tf.train.SessionRunHook):
+  """Logs training steps/sec and examples/sec under a given name."""
+
+  def __init__(self, name, batch_size, every_n_steps=1000):
+    self._name = name
+    self._batch_size = batch_size
+    self._timer = tf.train.SecondOrStepTimer(every_steps=every_n_steps)
+    self._global_step_tensor = None
+    self._start_time = None
+    self._start_step = None
+    self._last_step = None
+
+  def begin(self):
+    self._global_step_tensor = tf.train.get_global_step()
+    if self._global_step_tensor is None:
+      raise RuntimeError('Global step should be created to use ThroughputHook.')
+
+  def before_run(self, run_context):
+    return tf.train.SessionRunArgs(self._global_step_tensor)
+
+  def after_run(self, run_context, run_values):
+    global_step = run_values.results
+    if self._start_time is None:
+      self._start_time, self._start_step = time.time(), global_step
+      self._timer.update_last_triggered_step(global_step)
+    elif self._timer.should_trigger_for_step(global_step):
+      elapsed_secs, elapsed_steps = self._timer.update_last_triggered_step(
+          global_step)
+      if elapsed_secs:
+        self._log(elapsed_steps / elapsed_secs)
+    self._last_step = global_step
+
+  def end(self, session):
+    if self._start_time is None or self._last_step == self._start_step:
+      return
+    steps_per_sec = (
+        (self._last_step - self._start_step) / (time.time() - self._start_time))
+    tf.logging.info('{}: average over the run'.format(self._name))
+    self._log(steps_per_sec)
+
+  def _log(self, steps_per_sec):
+    tf.logging.info('{}: {:.2f} steps/sec, {:.1f} examples/sec'.format(
+        self._name, steps_per_sec, steps_per_sec * self._batch_size))
+
+
+class MemoryReportHook(tf.train.SessionRunHook):
+  """Logs the size of variables and optimizer slots, and peak memory."""
+
+  def __init__(self, every_n_steps=1000):
+    self._timer = tf.train.SecondOrStepTimer(every_steps=every_n_steps)
+    self._global_step_tensor = None
+
+  def begin(self):
+    self._global_step_tensor = tf.train.get_global_step()
+    if self._global_step_tensor is None:
+      raise RuntimeError(
+          'Global step should be created to use MemoryReportHook.')
+    trainable = set(var.op.name for var in tf.trainable_variables())
+    self._trainable_bytes, self._other_bytes = 0, 0
+    for var in tf.global_variables():
+      num_bytes = var.shape.num_elements() * var.dtype.base_dtype.size
+      if var.op.name in trainable:
+        self._trainable_bytes += num_bytes
+      else:
+        self._other_bytes += num_bytes
+
+  def after_create_session(self, session, coord):
+    self._log()
+
+  def before_run(self, run_context):
+    return tf.train.SessionRunArgs(self._global_step_tensor)
+
+  def after_run(self, run_context, run_values):
+    if self._timer.should_trigger_for_step(run_values.results):
+      self._timer.update_last_triggered_step(run_values.results)
+      self._log()
+
+  def _log(self):
+    # ru_maxrss is in kilobytes on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    tf.logging.info(
+        'Memory: {:.1f} MB of trainable variables, {:.1f} MB of optimizer '
+        'slots and other variables, {:.1f} MB peak RSS of this process'.format(
+            self._trainable_bytes / 2**20, self._other_bytes / 2**20,
+            peak_rss / 2**20))
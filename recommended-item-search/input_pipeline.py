@@ -14,52 +14,207 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+import numpy as np
 import tensorflow as tf
 # tf.enable_eager_execution()
 
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# user_id is not currently used.
+FEATURES = {
+  'user_id': tf.FixedLenFeature([], dtype=tf.int64),
+  'movie_ids': tf.FixedLenSequenceFeature(
+    [], dtype=tf.int64, allow_missing=True, default_value=-1)
+}
+
 
 def parse_fn(serialized_example):
   """Parse a serialized example."""
+  parsed_features = tf.parse_single_example(
+    serialized=serialized_example, features=FEATURES)
+  movie_ids = parsed_features['movie_ids']
+  return movie_ids
+
+def parse_batch_fn(serialized_examples):
+  """Parse a batch of serialized examples at once.
   
-  # user_id is not currently used.
-  context_features = {
-    'user_id': tf.FixedLenFeature([], dtype=tf.int64)
-  }
-  sequence_features = {
-    'movie_ids': tf.FixedLenSequenceFeature([], dtype=tf.int64)
-  }
-  parsed_feature, parsed_sequence_feature = tf.parse_single_sequence_example(
-    serialized=serialized_example,
-    context_features=context_features,
-    sequence_features=sequence_features
-  )
-  movie_ids = parsed_sequence_feature['movie_ids']
+  Note that movie_id sequences are padded with -1, the default value of
+  movie_ids, up to the longest sequence in the batch.
+  """
+  parsed_features = tf.parse_example(
+    serialized=serialized_examples, features=FEATURES)
+  movie_ids = parsed_features['movie_ids']
   return movie_ids
 
-def generate_input_fn(file_pattern, batch_size, mode=tf.estimator.ModeKeys.EVAL):
+def count_records(input_file):
+  """Count the records of a TFRecord file."""
+  return sum(1 for _ in tf.python_io.tf_record_iterator(input_file))
+
+def read_histories(input_file, batch_size, start=0, end=None):
+  """Yields (user_ids, histories) batches of a TFRecord file, without a graph.
+
+  Histories are numpy arrays of movie ids, which are not padded. Only the
+  records from start to end, if given, are read, and records before start
+  are skipped without being parsed.
+  """
+  user_ids, histories = [], []
+  for i, record in enumerate(tf.python_io.tf_record_iterator(input_file)):
+    if i < start:
+      continue
+    if end is not None and i >= end:
+      break
+    example = tf.train.Example()
+    example.ParseFromString(record)
+    feature = example.features.feature
+    user_ids.append(feature['user_id'].int64_list.value[0])
+    histories.append(
+      np.asarray(feature['movie_ids'].int64_list.value, dtype=np.int64))
+    if len(user_ids) == batch_size:
+      yield user_ids, histories
+      user_ids, histories = [], []
+  if user_ids:
+    yield user_ids, histories
+
+def batch_examples(dataset, batch_size, num_parallel_calls=AUTOTUNE,
+                   bucket_boundaries=None):
+  """Batch and parse serialized examples.
+  
+  Args:
+    dataset: dataset of serialized examples.
+    batch_size: batch size.
+    num_parallel_calls: parallelism of parsing, or AUTOTUNE.
+    bucket_boundaries: optional increasing lengths of movie_id sequences.
+      Sequences are then batched with sequences of similar lengths, which
+      reduces padding.
+  Returns:
+    dataset of movie_id sequences padded with -1.
+  """
+  if not bucket_boundaries:
+    # Examples are batched first, and then parsed by batches.
+    dataset = dataset.batch(batch_size=batch_size)
+    return dataset.map(
+      map_func=parse_batch_fn, num_parallel_calls=num_parallel_calls)
+  
+  # Bucketing needs the length of each sequence, so examples are parsed
+  # one by one.
+  dataset = dataset.map(map_func=parse_fn, num_parallel_calls=num_parallel_calls)
+  return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+    element_length_func=lambda movie_ids: tf.shape(movie_ids)[0],
+    bucket_boundaries=bucket_boundaries,
+    bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+    padded_shapes=tf.TensorShape([None]),
+    padding_values=tf.constant(-1, dtype=tf.int64)))
+
+def generate_input_fn(file_pattern, batch_size, mode=tf.estimator.ModeKeys.EVAL,
+                      cycle_length=AUTOTUNE, num_parallel_calls=AUTOTUNE,
+                      shuffle_buffer_size=1000, prefetch_buffer_size=AUTOTUNE,
+                      bucket_boundaries=None, cache_filename=None):
   """Generate input function for Estimator. 
   
   Args:
     file_pattern: pattern of input file names. 
     batch_size: batch size used in input function.
+    mode: shuffles inputs in TRAIN mode.
+    cycle_length: number of input files read concurrently, or AUTOTUNE.
+    num_parallel_calls: parallelism of reading and parsing, or AUTOTUNE.
+    shuffle_buffer_size: buffer size of shuffling in TRAIN mode.
+    prefetch_buffer_size: number of prefetched batches, or AUTOTUNE.
+    bucket_boundaries: optional increasing lengths of movie_id sequences to
+      batch sequences of similar lengths together.
+    cache_filename: if not None, inputs are cached after the first epoch, in
+      memory if it is empty, or else in files with this prefix. Serialized
+      examples are cached in TRAIN mode, so that they are still shuffled,
+      and parsed batches are cached in other modes, where the cache should
+      be written first by write_eval_cache.
   Returns:
     input function which returns sequences of movie_ids.
   """
   def _input_fn():
-    #ToDo(yaboo): num_cpu should be parameterized.
-    files = tf.data.Dataset.list_files(file_pattern)
-    dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=8)
+    is_training = mode == tf.estimator.ModeKeys.TRAIN
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=is_training)
+    dataset = files.interleave(
+      tf.data.TFRecordDataset, cycle_length=cycle_length,
+      num_parallel_calls=num_parallel_calls)
     
-    #ToDo(yaboo): buffer_size should be parameterized.
-    if mode == tf.estimator.ModeKeys.TRAIN:
-      dataset = dataset.shuffle(buffer_size=1000)
-    dataset = dataset.map(map_func=parse_fn, num_parallel_calls=8)
-    dataset = dataset.repeat()
-    dataset = dataset.prefetch(2 * batch_size)
-    
-    # Note that movie_id sequences are padded with -1.
-    dataset = dataset.padded_batch(
-      batch_size=batch_size, padded_shapes=(tf.TensorShape([None])),
-      padding_values=(tf.constant(-1, dtype=tf.int64)))
+    if is_training:
+      if cache_filename is not None:
+        dataset = dataset.cache(filename=cache_filename)
+      dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+      dataset = dataset.repeat()
+      dataset = batch_examples(
+        dataset, batch_size, num_parallel_calls, bucket_boundaries)
+    elif cache_filename is not None:
+      dataset = batch_examples(
+        dataset, batch_size, num_parallel_calls, bucket_boundaries)
+      dataset = dataset.cache(filename=cache_filename)
+      dataset = dataset.repeat()
+    else:
+      dataset = dataset.repeat()
+      dataset = batch_examples(
+        dataset, batch_size, num_parallel_calls, bucket_boundaries)
+    dataset = dataset.prefetch(prefetch_buffer_size)
     return dataset
-  return _input_fn
\ No newline at end of file
+  return _input_fn
+
+def write_eval_cache(file_pattern, batch_size, cache_filename,
+                     cycle_length=AUTOTUNE, num_parallel_calls=AUTOTUNE,
+                     bucket_boundaries=None):
+  """Write the cache of parsed eval batches, unless it exists.
+
+  tf.data only keeps a cache once a read reaches the end of its inputs,
+  which evaluations of a fixed number of steps may never do. So the cache
+  is written by reading all eval inputs once, and evaluations then only
+  read it.
+
+  Returns:
+    the number of cached batches, or None if the cache already exists.
+  """
+  if tf.gfile.Exists(cache_filename + '.index'):
+    return None
+  with tf.Graph().as_default():
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+    dataset = files.interleave(
+      tf.data.TFRecordDataset, cycle_length=cycle_length,
+      num_parallel_calls=num_parallel_calls)
+    dataset = batch_examples(
+      dataset, batch_size, num_parallel_calls, bucket_boundaries)
+    dataset = dataset.cache(filename=cache_filename)
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    num_batches = 0
+    with tf.Session() as sess:
+      try:
+        while True:
+          sess.run(next_batch)
+          num_batches += 1
+      except tf.errors.OutOfRangeError:
+        pass
+  return num_batches
+
+def benchmark_input_fn(input_fn, num_steps, log_every_n_steps=100):
+  """Reads batches of an input function without a model.
+  
+  Args:
+    input_fn: input function generated by generate_input_fn.
+    num_steps: number of batches to read.
+    log_every_n_steps: frequency of logging.
+  Returns:
+    the average number of examples per second.
+  """
+  with tf.Graph().as_default():
+    movie_ids = input_fn().make_one_shot_iterator().get_next()
+    num_examples = tf.shape(movie_ids)[0]
+    with tf.Session() as sess:
+      # The first batch includes the time to fill buffers.
+      sess.run(num_examples)
+      start_time = time.time()
+      total_examples = 0
+      for step in range(1, num_steps + 1):
+        total_examples += sess.run(num_examples)
+        if step % log_every_n_steps == 0 or step == num_steps:
+          elapsed_secs = time.time() - start_time
+          tf.logging.info(
+            'Input benchmark: {} steps, {:.2f} steps/sec, '
+            '{:.1f} examples/sec'.format(
+              step, step / elapsed_secs, total_examples / elapsed_secs))
+  return total_examples / (time.time() - start_time)
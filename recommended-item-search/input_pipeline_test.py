@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of input_pipeline.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tensorflow as tf
+import input_pipeline
+
+HISTORIES = [[1, 2, 3], [4], [5, 6], [7, 8, 9, 10], [11], [12, 13]]
+
+
+def write_examples(filename, histories):
+  with tf.python_io.TFRecordWriter(filename) as writer:
+    for user_id, history in enumerate(histories):
+      example = tf.train.Example(features=tf.train.Features(feature={
+          'user_id': tf.train.Feature(
+              int64_list=tf.train.Int64List(value=[user_id])),
+          'movie_ids': tf.train.Feature(
+              int64_list=tf.train.Int64List(value=history))}))
+      writer.write(example.SerializeToString())
+
+
+def read_batches(input_fn, num_steps):
+  with tf.Graph().as_default():
+    next_batch = input_fn().make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      return [sess.run(next_batch) for _ in range(num_steps)]
+
+
+class InputPipelineTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(InputPipelineTest, self).setUp()
+    self.eval_filename = os.path.join(self.get_temp_dir(), 'eval.tfrecord')
+    write_examples(self.eval_filename, HISTORIES)
+    self.cache_filename = os.path.join(self.get_temp_dir(), 'eval_cache')
+
+  def test_eval_cache_is_kept_after_one_evaluation(self):
+    num_batches = input_pipeline.write_eval_cache(
+        self.eval_filename, batch_size=4, cache_filename=self.cache_filename)
+    self.assertEqual(num_batches, 2)
+    input_fn = input_pipeline.generate_input_fn(
+        self.eval_filename, batch_size=4,
+        cache_filename=self.cache_filename)
+    # An evaluation of fewer steps than batches does not drop the cache.
+    read_batches(input_fn, num_steps=1)
+    self.assertTrue(tf.gfile.Exists(self.cache_filename + '.index'))
+    self.assertIsNone(input_pipeline.write_eval_cache(
+        self.eval_filename, batch_size=4, cache_filename=self.cache_filename))
+
+  def test_cached_batches_match_parsed_batches(self):
+    input_pipeline.write_eval_cache(
+        self.eval_filename, batch_size=4, cache_filename=self.cache_filename)
+    cached = read_batches(input_pipeline.generate_input_fn(
+        self.eval_filename, batch_size=4,
+        cache_filename=self.cache_filename), num_steps=2)
+    parsed = read_batches(input_pipeline.generate_input_fn(
+        self.eval_filename, batch_size=4), num_steps=2)
+    for cached_batch, parsed_batch in zip(cached, parsed):
+      self.assertAllEqual(cached_batch, parsed_batch)
+
+  def test_batches_are_padded_with_minus_one(self):
+    batches = read_batches(input_pipeline.generate_input_fn(
+        self.eval_filename, batch_size=2), num_steps=1)
+    self.assertAllEqual(batches[0], [[1, 2, 3], [4, -1, -1]])
+
+
+if __name__ == '__main__':
+  tf.test.main()
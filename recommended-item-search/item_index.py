@@ -0,0 +1,295 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+import os
+import re
+import numpy as np
+import tensorflow as tf
+import metadata
+
+INDEX_TYPES = ['brute_force', 'annoy']
+ITEM_EMBEDDINGS_VARIABLE = 'input_layer/movie_ids_embedding/embedding_weights'
+USER_TOWER_SCOPE = 'user_embeddings'
+
+ITEM_EMBEDDINGS_FILE = 'item_embeddings.npy'
+USER_TOWER_FILE = 'user_tower.npz'
+TITLES_FILE = 'titles.tsv'
+ANNOY_FILE = 'items.annoy'
+CONFIG_FILE = 'item_index.json'
+
+
+def load_item_embeddings(checkpoint):
+  """Loads the movie_ids embedding of a checkpoint, even if partitioned."""
+  names = [name for name, _ in tf.train.list_variables(checkpoint)]
+  if ITEM_EMBEDDINGS_VARIABLE in names:
+    return tf.train.load_variable(
+        checkpoint, ITEM_EMBEDDINGS_VARIABLE).astype(np.float32)
+  # A partitioned embedding is saved as part_0, part_1, ... along axis 0.
+  parts = sorted(
+      (name for name in names
+       if name.startswith(ITEM_EMBEDDINGS_VARIABLE + '/part_')),
+      key=lambda name: int(name.rsplit('_', 1)[1]))
+  if not parts:
+    raise ValueError('No {} is found in {}'.format(
+        ITEM_EMBEDDINGS_VARIABLE, checkpoint))
+  return np.concatenate(
+      [tf.train.load_variable(checkpoint, name) for name in parts]
+  ).astype(np.float32)
+
+def load_user_tower(checkpoint):
+  """Loads the (kernel, bias) pairs of the user tower of a checkpoint."""
+  # Dense layers are named dense, dense_1, dense_2, ... in creation order.
+  def _layer_number(layer_name):
+    suffix = re.search(r'_(\d+)$', layer_name)
+    return int(suffix.group(1)) if suffix else 0
+  layer_names = sorted(set(
+      name.split('/')[1] for name, _ in tf.train.list_variables(checkpoint)
+      if name.startswith(USER_TOWER_SCOPE + '/') and name.endswith('/kernel')),
+      key=_layer_number)
+  layers = []
+  for layer_name in layer_names:
+    prefix = '{}/{}/'.format(USER_TOWER_SCOPE, layer_name)
+    layers.append((tf.train.load_variable(checkpoint, prefix + 'kernel'),
+                   tf.train.load_variable(checkpoint, prefix + 'bias')))
+  return layers
+
+def compute_user_embeddings(item_embeddings, layers, activation, histories):
+  """Computes user embeddings like model_fn, without TensorFlow.
+
+  Args:
+    item_embeddings: the movie_ids embedding.
+    layers: (kernel, bias) pairs of the user tower.
+    activation: name of the activation used in hidden layers.
+    histories: a list of movie id lists, or a -1 padded 2D array.
+  Returns:
+    A float32 array of shape (len(histories), embedding size).
+  """
+  num_items = item_embeddings.shape[0]
+  inputs = np.zeros(
+      (len(histories), item_embeddings.shape[1]), dtype=np.float32)
+  for i, history in enumerate(histories):
+    history = np.asarray(history, dtype=np.int64)
+    history = history[(history >= 0) & (history < num_items)]
+    if len(history):
+      inputs[i] = item_embeddings[history].mean(axis=0)
+  for kernel, bias in layers:
+    inputs = inputs.dot(kernel) + bias
+    if activation == 'relu':
+      inputs = np.maximum(inputs, 0)
+  return inputs
+
+def top_k_unseen(user_embeddings, item_embeddings, histories, k,
+                 block_size):
+  """Returns the top-k movie ids and scores of each user, by blocks of items.
+
+  Scores of a block are computed with one matrix product, seen movies are
+  masked, and the top-k of the block is merged with the top-k so far, so
+  memory is bounded by the block size rather than the number of items.
+  Scores of seen movies are -inf when fewer than k movies are unseen.
+  """
+  num_users = len(user_embeddings)
+  num_items = len(item_embeddings)
+  k = min(k, num_items)
+  top_ids = np.zeros((num_users, 0), dtype=np.int64)
+  top_scores = np.zeros((num_users, 0), dtype=np.float32)
+
+  lengths = [len(history) for history in histories]
+  seen_rows = np.repeat(np.arange(num_users), lengths)
+  seen_items = (np.concatenate(histories).astype(np.int64) if seen_rows.size
+                else np.zeros(0, dtype=np.int64))
+  for start in range(0, num_items, block_size):
+    end = min(start + block_size, num_items)
+    scores = user_embeddings.dot(item_embeddings[start:end].T)
+    in_block = (seen_items >= start) & (seen_items < end)
+    scores[seen_rows[in_block], seen_items[in_block] - start] = -np.inf
+
+    block_k = min(k, end - start)
+    block_top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+    ids = np.hstack([top_ids, block_top + start])
+    candidates = np.hstack(
+        [top_scores, np.take_along_axis(scores, block_top, axis=1)])
+    if candidates.shape[1] > k:
+      keep = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+      ids = np.take_along_axis(ids, keep, axis=1)
+      candidates = np.take_along_axis(candidates, keep, axis=1)
+    top_ids, top_scores = ids, candidates
+
+  order = np.argsort(-top_scores, axis=1)
+  return (np.take_along_axis(top_ids, order, axis=1),
+          np.take_along_axis(top_scores, order, axis=1))
+
+def export_item_index(model_dir, metadata_path, activation, output_dir,
+                      index_type='brute_force', num_trees=100,
+                      checkpoint_path=None):
+  """Exports item embeddings, user tower and titles from a checkpoint.
+
+  Args:
+    model_dir: model directory of the softmax model.
+    metadata_path: path to metadata created by data_preparation.py.
+    activation: name of the activation used in hidden layers.
+    output_dir: directory where the index artifacts are written.
+    index_type: 'brute_force', or 'annoy' to also build an Annoy index.
+    num_trees: number of trees of the Annoy index.
+    checkpoint_path: checkpoint to export, or None for the latest checkpoint
+      of model_dir.
+  """
+  checkpoint = checkpoint_path or tf.train.latest_checkpoint(model_dir)
+  if checkpoint is None:
+    raise ValueError('No checkpoint is found in {}'.format(model_dir))
+  tf.logging.info('Exporting item index from {} ...'.format(checkpoint))
+  tf.gfile.MakeDirs(output_dir)
+
+  item_embeddings = load_item_embeddings(checkpoint)
+  np.save(os.path.join(output_dir, ITEM_EMBEDDINGS_FILE), item_embeddings)
+
+  layers = load_user_tower(checkpoint)
+  tower = {}
+  for i, (kernel, bias) in enumerate(layers):
+    tower['kernel_{}'.format(i)] = kernel
+    tower['bias_{}'.format(i)] = bias
+  np.savez(os.path.join(output_dir, USER_TOWER_FILE), **tower)
+
+  movies = metadata.load_metadata(metadata_path).movies()
+  movies[['movie_id2', 'title']].to_csv(
+      os.path.join(output_dir, TITLES_FILE), header=False, index=False,
+      sep='\t')
+
+  if index_type == 'annoy':
+    build_annoy_index(
+        item_embeddings, os.path.join(output_dir, ANNOY_FILE), num_trees)
+
+  # Servers check that user embeddings come from the same training step.
+  global_step = int(tf.train.load_variable(
+      checkpoint, tf.GraphKeys.GLOBAL_STEP))
+  config = {
+      'checkpoint': checkpoint, 'global_step': global_step,
+      'activation': activation,
+      'index_type': index_type, 'num_items': item_embeddings.shape[0],
+      'num_layers': len(layers)}
+  with open(os.path.join(output_dir, CONFIG_FILE), 'w') as f:
+    json.dump(config, f)
+  tf.logging.info('Item index is exported to {}'.format(output_dir))
+
+def _augment_items(item_embeddings):
+  """Maps inner product search to angular search with an extra dimension.
+
+  Every item x becomes [x, sqrt(M^2 - |x|^2)], where M is the largest norm,
+  and every query q becomes [q, 0], so the angular distance ranks items by
+  their inner product with q.
+  """
+  norms = np.linalg.norm(item_embeddings, axis=1)
+  extra = np.sqrt(np.maximum(norms.max() ** 2 - norms ** 2, 0))
+  return np.hstack([item_embeddings, extra[:, np.newaxis]])
+
+def build_annoy_index(item_embeddings, index_path, num_trees):
+  from annoy import AnnoyIndex
+  augmented = _augment_items(item_embeddings)
+  annoy_index = AnnoyIndex(augmented.shape[1], metric='angular')
+  for item_id, vector in enumerate(augmented):
+    annoy_index.add_item(item_id, vector)
+  annoy_index.build(num_trees)
+  annoy_index.save(index_path)
+  tf.logging.info('Annoy index with {} trees is built.'.format(num_trees))
+
+class ItemRecommender(object):
+  """Recommends movies for a movie history from an exported item index."""
+
+  def __init__(self, index_dir):
+    with open(os.path.join(index_dir, CONFIG_FILE)) as f:
+      self.config = json.load(f)
+    # Memory-mapped, so that processes serving the same index share it.
+    self.item_embeddings = np.load(
+        os.path.join(index_dir, ITEM_EMBEDDINGS_FILE), mmap_mode='r')
+    tower = np.load(os.path.join(index_dir, USER_TOWER_FILE))
+    self.layers = [
+        (tower['kernel_{}'.format(i)], tower['bias_{}'.format(i)])
+        for i in range(self.config['num_layers'])]
+    self.titles = {}
+    # to_csv quotes titles with quotes, e.g. "Great Performances" Cats.
+    with open(os.path.join(index_dir, TITLES_FILE), newline='') as f:
+      for movie_id, title in csv.reader(f, delimiter='\t'):
+        self.titles[int(movie_id)] = title
+    self.annoy_index = None
+    if self.config['index_type'] == 'annoy':
+      from annoy import AnnoyIndex
+      self.annoy_index = AnnoyIndex(
+          self.item_embeddings.shape[1] + 1, metric='angular')
+      self.annoy_index.load(os.path.join(index_dir, ANNOY_FILE))
+
+  @property
+  def num_items(self):
+    return self.item_embeddings.shape[0]
+
+  def user_embeddings(self, histories):
+    """Computes user embeddings like model_fn, without TensorFlow.
+
+    Args:
+      histories: a list of movie id lists, or a -1 padded 2D array.
+    Returns:
+      A float32 array of shape (len(histories), embedding size).
+    """
+    return compute_user_embeddings(
+        self.item_embeddings, self.layers, self.config['activation'],
+        histories)
+
+  def query(self, user_embeddings, k, histories=None):
+    """Returns the top-k movie ids and scores of each user embedding.
+
+    Movies in histories, if given, are excluded from the results.
+    """
+    if self.annoy_index is not None:
+      return self._query_annoy(user_embeddings, k, histories)
+    scores = user_embeddings.dot(self.item_embeddings.T)
+    if histories is not None:
+      for i, history in enumerate(histories):
+        history = np.asarray(history, dtype=np.int64)
+        # Unknown movies are ignored, as in compute_user_embeddings.
+        history = history[(history >= 0) & (history < self.num_items)]
+        scores[i, history] = -np.inf
+    k = min(k, self.num_items)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return (np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1))
+
+  def _query_annoy(self, user_embeddings, k, histories):
+    all_ids, all_scores = [], []
+    for i, user_embedding in enumerate(user_embeddings):
+      seen = set()
+      if histories is not None:
+        seen = set(int(movie_id) for movie_id in histories[i] if movie_id >= 0)
+      candidates = self.annoy_index.get_nns_by_vector(
+          np.append(user_embedding, 0.), k + len(seen))
+      ids = [movie_id for movie_id in candidates if movie_id not in seen][:k]
+      all_ids.append(ids)
+      all_scores.append(self.item_embeddings[ids].dot(user_embedding))
+    return all_ids, all_scores
+
+  def recommend(self, history, k=10):
+    """Returns the top-k unseen movies of a movie history as dicts."""
+    user_embeddings = self.user_embeddings([history])
+    ids, scores = self.query(user_embeddings, k, [history])
+    return [
+        {'movie_id': int(movie_id), 'title': self.titles.get(int(movie_id)),
+         'score': float(score)}
+        for movie_id, score in zip(ids[0], scores[0])]
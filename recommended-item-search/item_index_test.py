@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of item_index.py and of the tasks of batch_recommend.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import batch_recommend
+import item_index
+
+NUM_ITEMS = 50
+EMBEDDING_SIZE = 8
+HISTORIES = [[0, 1, 2], [], [49, 10, 3, 7], [5]]
+
+
+def brute_force_top_k(user_embeddings, item_embeddings, histories, k):
+  scores = user_embeddings.dot(item_embeddings.T)
+  for i, history in enumerate(histories):
+    scores[i, history] = -np.inf
+  top_ids = np.argsort(-scores, axis=1, kind='mergesort')[:, :k]
+  return top_ids, np.take_along_axis(scores, top_ids, axis=1)
+
+
+class TopKUnseenTest(unittest.TestCase):
+
+  def setUp(self):
+    random_state = np.random.RandomState(0)
+    self.item_embeddings = random_state.normal(
+        size=(NUM_ITEMS, EMBEDDING_SIZE)).astype(np.float32)
+    self.user_embeddings = random_state.normal(
+        size=(len(HISTORIES), EMBEDDING_SIZE)).astype(np.float32)
+
+  def test_blocks_match_brute_force(self):
+    expected_ids, expected_scores = brute_force_top_k(
+        self.user_embeddings, self.item_embeddings, HISTORIES, 10)
+    for block_size in [1, 7, 10, 50, 64]:
+      top_ids, top_scores = item_index.top_k_unseen(
+          self.user_embeddings, self.item_embeddings, HISTORIES, 10,
+          block_size)
+      np.testing.assert_array_equal(top_ids, expected_ids)
+      np.testing.assert_allclose(top_scores, expected_scores, rtol=1e-6)
+
+  def test_seen_movies_are_excluded(self):
+    top_ids, _ = item_index.top_k_unseen(
+        self.user_embeddings, self.item_embeddings, HISTORIES, 10, 16)
+    for history, ids in zip(HISTORIES, top_ids):
+      self.assertFalse(set(history) & set(ids.tolist()))
+
+  def test_k_is_clamped_to_the_number_of_items(self):
+    top_ids, top_scores = item_index.top_k_unseen(
+        self.user_embeddings, self.item_embeddings, HISTORIES, 100, 16)
+    self.assertEqual(top_ids.shape, (len(HISTORIES), NUM_ITEMS))
+    self.assertEqual(np.isinf(top_scores[2]).sum(), len(HISTORIES[2]))
+
+
+class ItemRecommenderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index_dir = tempfile.mkdtemp()
+    random_state = np.random.RandomState(0)
+    self.item_embeddings = random_state.normal(
+        size=(NUM_ITEMS, EMBEDDING_SIZE)).astype(np.float32)
+    kernel = random_state.normal(
+        size=(EMBEDDING_SIZE, EMBEDDING_SIZE)).astype(np.float32)
+    bias = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    np.save(os.path.join(self.index_dir, item_index.ITEM_EMBEDDINGS_FILE),
+            self.item_embeddings)
+    np.savez(os.path.join(self.index_dir, item_index.USER_TOWER_FILE),
+             kernel_0=kernel, bias_0=bias)
+    with open(os.path.join(self.index_dir, item_index.TITLES_FILE), 'w') as f:
+      for movie_id in range(NUM_ITEMS):
+        f.write('{}\tMovie {}\n'.format(movie_id, movie_id))
+    with open(os.path.join(self.index_dir, item_index.CONFIG_FILE), 'w') as f:
+      json.dump({'index_type': 'brute_force', 'num_layers': 1,
+                 'activation': 'relu'}, f)
+    self.layers = [(kernel, bias)]
+
+  def tearDown(self):
+    shutil.rmtree(self.index_dir)
+
+  def test_user_embeddings_ignore_padding_and_unknown_movies(self):
+    embeddings = item_index.compute_user_embeddings(
+        self.item_embeddings, self.layers, 'relu',
+        [[3, 4, -1, -1], [3, 4, NUM_ITEMS + 5], [-1]])
+    np.testing.assert_allclose(embeddings[0], embeddings[1])
+    np.testing.assert_array_equal(embeddings[2], np.zeros(EMBEDDING_SIZE))
+
+  def test_query_ignores_unknown_movies(self):
+    recommender = item_index.ItemRecommender(self.index_dir)
+    histories = [[1, 2, -1, NUM_ITEMS, NUM_ITEMS + 100]]
+    user_embeddings = recommender.user_embeddings(histories)
+    ids, scores = recommender.query(user_embeddings, 5, histories)
+    expected_ids, expected_scores = item_index.top_k_unseen(
+        user_embeddings, self.item_embeddings, [[1, 2]], 5, NUM_ITEMS)
+    np.testing.assert_array_equal(ids, expected_ids)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+  def test_recommend_returns_titles(self):
+    recommender = item_index.ItemRecommender(self.index_dir)
+    recommendations = recommender.recommend([1, 2], k=3)
+    self.assertEqual(len(recommendations), 3)
+    for recommendation in recommendations:
+      self.assertNotIn(recommendation['movie_id'], [1, 2])
+      self.assertEqual(recommendation['title'],
+                       'Movie {}'.format(recommendation['movie_id']))
+
+
+class SplitTasksTest(unittest.TestCase):
+
+  def test_record_ranges_cover_every_file(self):
+    tasks = batch_recommend.split_tasks(['a', 'b', 'c'], [5, 2, 0], 2)
+    self.assertEqual(tasks, [('a', 0, 2), ('a', 2, 4), ('a', 4, 5),
+                             ('b', 0, 2)])
+
+
+if __name__ == '__main__':
+  unittest.main()
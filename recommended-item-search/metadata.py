@@ -0,0 +1,169 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metadata of the prepared MovieLens dataset.
+
+Metadata is a small JSON header with counts and file names, next to compact
+columnar files which are only loaded when accessed:
+  metadata.json: N (vocabulary size), num_users and the file names below.
+  movies.tsv: movie_id2, movie_id, title and genres of each movie.
+  movie_vocab.txt: the movie_id of each movie_id2, one per line, which maps
+    the rows of the movie_ids embedding of two datasets when warm starting.
+  movie_counts.npy: number of ratings above threshold of each movie.
+  histories_*.npy: user ids, offsets and movie ids of user histories, in
+    compressed sparse row layout. Only written by in-memory preparation.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import io
+import json
+import os
+import pickle
+import numpy as np
+import pandas
+import tensorflow as tf
+
+HEADER_FILE = 'metadata.json'
+MOVIES_FILE = 'movies.tsv'
+COUNTS_FILE = 'movie_counts.npy'
+VOCAB_FILE = 'movie_vocab.txt'
+HISTORY_USER_IDS_FILE = 'histories_user_ids.npy'
+HISTORY_OFFSETS_FILE = 'histories_offsets.npy'
+HISTORY_MOVIE_IDS_FILE = 'histories_movie_ids.npy'
+
+
+def _save_array(path, array):
+  with tf.io.gfile.GFile(path, 'wb') as f:
+    np.save(f, array)
+
+def _load_array(path):
+  if '://' not in path:
+    return np.load(path, mmap_mode='r')
+  with tf.io.gfile.GFile(path, 'rb') as f:
+    return np.load(io.BytesIO(f.read()))
+
+def write_vocab(path, movies):
+  """Writes the movie_id of each movie_id2 to a vocabulary file."""
+  with tf.io.gfile.GFile(path, 'w') as f:
+    for movie_id in movies.sort_values('movie_id2')['movie_id'].values:
+      f.write('{}\n'.format(movie_id))
+
+def write_metadata(export_dir, movies, counts, user_ids=None, histories=None):
+  """Writes the metadata header and files to export_dir.
+
+  Args:
+    export_dir: directory of the prepared dataset.
+    movies: DataFrame of movie_id2, movie_id, title and genres.
+    counts: number of ratings of each movie.
+    user_ids: optional array of user ids.
+    histories: optional list of movie id arrays, one per user id.
+  """
+  header = {
+      'N': len(movies),
+      'num_users': None if user_ids is None else len(user_ids),
+      'movies': MOVIES_FILE,
+      'counts': COUNTS_FILE,
+      'vocab': VOCAB_FILE,
+      'histories': None}
+
+  with tf.io.gfile.GFile(os.path.join(export_dir, MOVIES_FILE), 'w') as f:
+    movies[['movie_id2', 'movie_id', 'title', 'genres']].to_csv(
+        f, header=True, index=False, sep='\t')
+  write_vocab(os.path.join(export_dir, VOCAB_FILE), movies)
+  _save_array(os.path.join(export_dir, COUNTS_FILE),
+              np.asarray(counts, dtype=np.int64))
+
+  if histories is not None:
+    lengths = np.array([len(history) for history in histories], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    movie_ids = (np.concatenate(histories).astype(np.int32) if len(histories)
+                 else np.zeros(0, dtype=np.int32))
+    _save_array(os.path.join(export_dir, HISTORY_USER_IDS_FILE),
+                np.asarray(user_ids, dtype=np.int64))
+    _save_array(os.path.join(export_dir, HISTORY_OFFSETS_FILE), offsets)
+    _save_array(os.path.join(export_dir, HISTORY_MOVIE_IDS_FILE), movie_ids)
+    header['histories'] = {
+        'user_ids': HISTORY_USER_IDS_FILE, 'offsets': HISTORY_OFFSETS_FILE,
+        'movie_ids': HISTORY_MOVIE_IDS_FILE}
+
+  with tf.io.gfile.GFile(os.path.join(export_dir, HEADER_FILE), 'w') as f:
+    json.dump(header, f)
+
+class Metadata(object):
+  """Reads the metadata header, and loads the other files lazily."""
+
+  def __init__(self, path):
+    self._dir = os.path.dirname(path)
+    self._legacy = None
+    if path.endswith('.pickle'):
+      # Metadata pickled by earlier versions of data_preparation.py.
+      with tf.io.gfile.GFile(path, 'rb') as f:
+        self._legacy = pickle.load(f)
+      self.header = {'N': self._legacy['N']}
+    else:
+      with tf.io.gfile.GFile(path, 'r') as f:
+        self.header = json.load(f)
+
+  @property
+  def N(self):  # pylint: disable=invalid-name
+    return self.header['N']
+
+  @property
+  def num_users(self):
+    return self.header.get('num_users')
+
+  @functools.lru_cache(maxsize=None)
+  def movies(self):
+    """Returns a DataFrame of movie_id2, movie_id, title and genres."""
+    if self._legacy is not None:
+      return self._legacy['movies']
+    with tf.io.gfile.GFile(
+        os.path.join(self._dir, self.header['movies']), 'r') as f:
+      return pandas.read_csv(f, sep='\t', header=0)
+
+  def vocab_path(self):
+    """Returns the path of the movie vocabulary file, or None."""
+    if not self.header.get('vocab'):
+      return None
+    return os.path.join(self._dir, self.header['vocab'])
+
+  @functools.lru_cache(maxsize=None)
+  def counts(self):
+    """Returns the number of ratings of each movie, or None."""
+    if self._legacy is not None:
+      return self._legacy.get('counts')
+    return _load_array(os.path.join(self._dir, self.header['counts']))
+
+  @functools.lru_cache(maxsize=None)
+  def histories(self):
+    """Returns (user_ids, offsets, movie_ids) arrays of histories, or None.
+
+    The movie ids of user_ids[i] are movie_ids[offsets[i]:offsets[i + 1]].
+    """
+    files = self.header.get('histories')
+    if not files:
+      return None
+    return tuple(_load_array(os.path.join(self._dir, files[name]))
+                 for name in ['user_ids', 'offsets', 'movie_ids'])
+
+@functools.lru_cache(maxsize=None)
+def load_metadata(path):
+  """Returns the Metadata at path, reading its header only once."""
+  return Metadata(path)
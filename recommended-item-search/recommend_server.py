@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Online recommendation server.
+
+Computes user embeddings of movie histories with the SavedModel exported
+by softmax_main.py, and retrieves unseen movies from the item index exported
+by export_item_index.py. Runs locally with:
+
+  MODEL_DIR=./model INDEX_DIR=./item_index python3 recommend_server.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from flask import Flask
+from flask import jsonify
+from flask import request
+import numpy as np
+import tensorflow as tf
+import batching
+import item_index
+
+# Configurable parameters
+MODEL_DIR = os.environ.get('MODEL_DIR', './model')
+EXPORT_NAME = os.environ.get('EXPORT_NAME', 'Servo')
+INDEX_DIR = os.environ.get('INDEX_DIR', './item_index')
+MAX_SHOW = 100
+BATCH_SIZE = 64
+BATCH_WAIT_SECS = 0.002
+CACHE_SIZE = 10000
+
+
+def latest_saved_model(model_dir, export_name):
+  """Returns the directory of the latest SavedModel exported by LatestExporter."""
+  export_dir = os.path.join(model_dir, 'export', export_name)
+  versions = [version for version in tf.gfile.ListDirectory(export_dir)
+              if version.strip('/').isdigit()]
+  if not versions:
+    raise ValueError('No SavedModel is found in {}'.format(export_dir))
+  latest = max(versions, key=lambda version: int(version.strip('/')))
+  return os.path.join(export_dir, latest.strip('/'))
+
+
+def check_same_step(saved_model_dir, index_config):
+  """Raises ValueError unless the SavedModel and the item index are
+  exported from the same global step, as their embeddings must match."""
+  saved_model_step = int(tf.train.load_variable(
+      os.path.join(saved_model_dir, 'variables', 'variables'),
+      tf.GraphKeys.GLOBAL_STEP))
+  index_step = index_config.get('global_step')
+  if index_step != saved_model_step:
+    raise ValueError(
+        'SavedModel {} is exported at step {}, but the item index is '
+        'exported from {} at step {}. Export the item index again from the '
+        'checkpoint of the SavedModel.'.format(
+            saved_model_dir, saved_model_step,
+            index_config.get('checkpoint'), index_step))
+
+
+def pad_histories(histories):
+  """Pads movie histories with -1, as input_pipeline does."""
+  max_length = max([len(history) for history in histories] + [1])
+  padded = np.full((len(histories), max_length), -1, dtype=np.int64)
+  for i, history in enumerate(histories):
+    padded[i, :len(history)] = history
+  return padded
+
+
+class RecommendUtil(object):
+
+  def __init__(self):
+    print('Initialising recommendation utility...')
+
+    saved_model_dir = latest_saved_model(MODEL_DIR, EXPORT_NAME)
+    print('Loading SavedModel {}...'.format(saved_model_dir))
+    self.predictor = tf.contrib.predictor.from_saved_model(saved_model_dir)
+    print('SavedModel loaded.')
+
+    print('Loading item index {}...'.format(INDEX_DIR))
+    self.recommender = item_index.ItemRecommender(INDEX_DIR)
+    print('Item index with {} items loaded.'.format(
+        self.recommender.num_items))
+    check_same_step(saved_model_dir, self.recommender.config)
+
+    self.embed_batcher = batching.MicroBatcher(
+        self._user_embeddings_batch, max_batch_size=BATCH_SIZE,
+        max_wait_secs=BATCH_WAIT_SECS)
+    self.cache = batching.LRUCache(CACHE_SIZE)
+    print('Recommendation utility is up and running.')
+
+  def _user_embeddings_batch(self, histories):
+    predictions = self.predictor({'input': pad_histories(histories)})
+    return list(predictions['user_embeddings'])
+
+  def recommend(self, histories, num_matches=10):
+    """Returns the top unseen movies for each movie history."""
+    for history in histories:
+      if min(history) < 0 or max(history) >= self.recommender.num_items:
+        raise ValueError('Movie ids should be in [0, {}).'.format(
+            self.recommender.num_items))
+
+    results = [None] * len(histories)
+    missing = []
+    for i, history in enumerate(histories):
+      results[i] = self.cache.get((tuple(sorted(history)), num_matches))
+      if results[i] is None:
+        missing.append(i)
+    if not missing:
+      return results
+
+    # Single histories are batched with concurrent requests, while
+    # multiple histories of one request already make a batch.
+    if len(missing) == 1:
+      user_embeddings = np.array(
+          [self.embed_batcher.submit(histories[missing[0]])])
+    else:
+      user_embeddings = np.array(
+          self._user_embeddings_batch([histories[i] for i in missing]))
+    ids, scores = self.recommender.query(
+        user_embeddings, num_matches, [histories[i] for i in missing])
+    for i, movie_ids, movie_scores in zip(missing, ids, scores):
+      results[i] = [
+          {'movie_id': int(movie_id),
+           'title': self.recommender.titles.get(int(movie_id)),
+           'score': float(score)}
+          for movie_id, score in zip(movie_ids, movie_scores)]
+      self.cache.put((tuple(sorted(histories[i])), num_matches), results[i])
+    return results
+
+
+recommend_util = RecommendUtil()
+
+app = Flask(__name__)
+
+
+@app.route('/')
+def display_default():
+  return 'Welcome to the recommendation app!\n' \
+         'use /recommend?movie_ids=<id1>,<id2>,... to get recommendations'
+
+
+@app.route('/readiness_check')
+def check_readiness():
+  return 'App is ready!'
+
+
+@app.route('/recommend', methods=['GET', 'POST'])
+def recommend():
+  try:
+    if request.method == 'POST':
+      body = request.get_json(force=True)
+      histories = body.get('histories')
+      show = str(body.get('show', 10))
+    else:
+      movie_ids = request.args.get('movie_ids', '')
+      histories = [[movie_id for movie_id in movie_ids.split(',') if movie_id]]
+      show = request.args.get('show', '10')
+
+    is_valid, error = validate_request(histories, show)
+
+    if not is_valid:
+      results = error
+    else:
+      histories = [[int(movie_id) for movie_id in history]
+                   for history in histories]
+      results = recommend_util.recommend(histories, int(show))
+      if request.method == 'GET':
+        results = results[0]
+
+  except Exception as error:
+    results = 'Unexpected error: {}'.format(error)
+
+  response = jsonify(results)
+  return response
+
+
+def validate_request(histories, show):
+  is_valid = True
+  error = ''
+
+  if not histories or not all(histories):
+    is_valid = False
+    error = 'Movie histories should not be empty!'
+  elif not all(str(movie_id).lstrip('-').isdigit()
+               for history in histories for movie_id in history):
+    is_valid = False
+    error = 'Invalid movie id!'
+  elif not show.isdigit() or not 0 < int(show) <= MAX_SHOW:
+    is_valid = False
+    error = 'Invalid show results value!'
+
+  return is_valid, error
+
+
+if __name__ == '__main__':
+  app.run(host='127.0.0.1', port=8081)
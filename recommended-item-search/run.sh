@@ -17,6 +17,7 @@
 # Configurable parameters
 MODEL_DIR="gs://yaboo-sandbox-recommendation/softmax"
 DATA_DIR="./data"
+INDEX_DIR="./item_index"
 
 # Download MovieLens dataset and save it in tfrecord format.
 python3 data_preparation.py \
@@ -35,6 +36,46 @@ python3 softmax_main.py \
   --eval_filename="${DATA_DIR}/eval*.tfrecord" \
   --log_step_count_steps=1000 \
   --save_checkpoints_steps=100000 \
-  --metadata_path="${DATA_DIR}/metadata.pickle" \
+  --metadata_path="${DATA_DIR}/metadata.json" \
   --hidden_dims=35 \
   --activation='None'
+
+# To refresh the model with new movies and recent ratings, prepare the
+# ratings since the last training to another directory, and warm start a new
+# model from the previous one, e.g.:
+#
+# python3 data_preparation.py \
+#   --export_dir=./data_recent \
+#   --filename='ml-20m.zip' \
+#   --rating_threshold='4.0' \
+#   --since_timestamp=1420070400
+#
+# python3 softmax_main.py \
+#   --model_dir=${MODEL_DIR}_warm \
+#   --warm_start_from=${MODEL_DIR} \
+#   --warm_start_metadata_path="${DATA_DIR}/metadata.json" \
+#   --metadata_path="./data_recent/metadata.json" \
+#   --train_filename="./data_recent/train*.tfrecord" \
+#   --eval_filename="./data_recent/eval*.tfrecord" \
+#   --train_max_steps=10000 \
+#   --hidden_dims=35 \
+#   --activation='None'
+
+# Evaluate the latest checkpoint offline
+python3 evaluate.py \
+  --model_dir=${MODEL_DIR} \
+  --eval_filename="${DATA_DIR}/eval*.tfrecord" \
+  --activation='None'
+
+# Export item embeddings and build an index for recommendation
+python3 export_item_index.py \
+  --model_dir=${MODEL_DIR} \
+  --metadata_path="${DATA_DIR}/metadata.json" \
+  --activation='None' \
+  --output_dir=${INDEX_DIR}
+
+# Recommend movies for every user in batch
+python3 batch_recommend.py \
+  --index_dir=${INDEX_DIR} \
+  --input_filename="${DATA_DIR}/train*.tfrecord" \
+  --output_dir=./recommendations
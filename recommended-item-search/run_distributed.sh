@@ -0,0 +1,77 @@
+#!/bin/bash
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Trains the recommendation model with parameter servers, a chief, workers
+# and an evaluator, all running as local processes on this machine.
+# Data is expected to be prepared by data_preparation.py (see run.sh).
+
+# Configurable parameters
+MODEL_DIR="./model_distributed"
+DATA_DIR="./data"
+NUM_PS=2
+NUM_WORKERS=2
+BASE_PORT=2222
+
+hosts() {
+  local first_port=$1 count=$2 hosts=""
+  for ((i = 0; i < count; i++)); do
+    hosts="${hosts}${hosts:+,}\"localhost:$((first_port + i))\""
+  done
+  echo "[${hosts}]"
+}
+
+PS_HOSTS=$(hosts ${BASE_PORT} ${NUM_PS})
+CHIEF_HOSTS=$(hosts $((BASE_PORT + NUM_PS)) 1)
+WORKER_HOSTS=$(hosts $((BASE_PORT + NUM_PS + 1)) ${NUM_WORKERS})
+CLUSTER="{\"ps\": ${PS_HOSTS}, \"chief\": ${CHIEF_HOSTS}, \"worker\": ${WORKER_HOSTS}}"
+
+# All tasks resume from MODEL_DIR, which is cleared once here.
+rm -rf ${MODEL_DIR}
+
+start_task() {
+  local task_type=$1 task_index=$2
+  TF_CONFIG="{\"cluster\": ${CLUSTER}, \"task\": {\"type\": \"${task_type}\", \"index\": ${task_index}}}" \
+  python3 softmax_main.py \
+    --distribution='parameter_server' \
+    --resume_training \
+    --model_dir=${MODEL_DIR} \
+    --train_max_steps=100000 \
+    --train_batch_size=200 \
+    --eval_batch_size=1000 \
+    --eval_steps=10 \
+    --train_filename="${DATA_DIR}/train*.tfrecord" \
+    --eval_filename="${DATA_DIR}/eval*.tfrecord" \
+    --log_step_count_steps=1000 \
+    --save_checkpoints_steps=10000 \
+    --metadata_path="${DATA_DIR}/metadata.json" \
+    --hidden_dims=35 \
+    --activation='None' \
+    > "${MODEL_DIR}.${task_type}-${task_index}.log" 2>&1 &
+}
+
+PIDS=()
+for ((i = 0; i < NUM_PS; i++)); do
+  start_task ps ${i}; PIDS+=($!)
+done
+for ((i = 0; i < NUM_WORKERS; i++)); do
+  start_task worker ${i}; PIDS+=($!)
+done
+start_task evaluator 0; PIDS+=($!)
+start_task chief 0; CHIEF_PID=$!
+
+# Parameter servers never exit, so other tasks are stopped with the chief.
+trap 'kill ${PIDS[@]} 2> /dev/null' EXIT
+wait ${CHIEF_PID}
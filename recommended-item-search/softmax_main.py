@@ -22,16 +22,24 @@ from __future__ import print_function
 # pylint: disable=g-bad-import-order
 from absl import app as absl_app
 from absl import flags
+import math
+import multiprocessing
+import os
 import tensorflow as tf
+import hooks
 import input_pipeline
+import item_index
+import metadata
 import softmax_model
 # pylint: enable=g-bad-import-order
 
 FLAGS = flags.FLAGS
 
+DISTRIBUTIONS = ['none', 'mirrored', 'parameter_server']
+
 flags.DEFINE_string(
-    name='metadata_path', default='metadata.pickle',
-    help='Set a path to metadata created by preprocess_movielens.py')
+    name='metadata_path', default='metadata.json',
+    help='Set a path to metadata created by data_preparation.py')
 flags.DEFINE_list(
     name='hidden_dims', default=['64','32'],
     help='The sizes of hidden layers for MLP. e.g. --layers=32,16,8,4')
@@ -39,6 +47,18 @@ flags.DEFINE_enum(
     name='activation', default='relu',
     enum_values=['relu', 'None'], case_sensitive=False,
     help='Specify an activation function used in hidden layers.')
+flags.DEFINE_enum(
+    name='loss_mode', default='full', enum_values=softmax_model.LOSS_MODES,
+    help='Specify a training loss: full softmax over all movies, sampled '
+    'softmax, or softmax over the labels of the batch (in_batch). '
+    'Evaluation uses full softmax, unless --noeval_in_graph_metrics.')
+flags.DEFINE_integer(
+    name='num_sampled', default=2000,
+    help='Set the number of negative movies sampled by sampled softmax.')
+flags.DEFINE_enum(
+    name='sampler', default='popularity', enum_values=softmax_model.SAMPLERS,
+    help='Specify a sampler of negative movies for sampled softmax. '
+    'log_uniform assumes movie ids sorted by decreasing popularity.')
 flags.DEFINE_string(
     name='model_dir', default='./model',
     help='Set a model directory where model and checkpoint files are stored.')
@@ -48,6 +68,17 @@ flags.DEFINE_string(
 flags.DEFINE_boolean(
     name='resume_training', default=False,
     help='Resume training from a latest checkpoint.')
+flags.DEFINE_string(
+    name='warm_start_from', default=None,
+    help='Set a model directory or checkpoint of a previous model to warm '
+    'start from, outside of model_dir. Its movie_ids embedding is remapped '
+    'to the movies of metadata_path, new movies get initialized rows, and '
+    'the other variables are copied. Hidden dims must be the same. Ignored '
+    'when resuming training from a checkpoint of model_dir.')
+flags.DEFINE_string(
+    name='warm_start_metadata_path', default=None,
+    help='Set a path to metadata of the data the previous model was trained '
+    'on, which maps its embedding rows to movies when warm starting.')
 flags.DEFINE_string(
     name='train_filename', default='train*.tfrecord',
     help='Set a file pattern of training inputs.')
@@ -57,6 +88,36 @@ flags.DEFINE_integer(
 flags.DEFINE_integer(
     name='train_max_steps', default=1000000,
     help='Set a max training step per execution.')
+flags.DEFINE_integer(
+    name='cycle_length', default=input_pipeline.AUTOTUNE,
+    help='Set the number of input files read concurrently. '
+    '-1 lets tf.data tune it at runtime.')
+flags.DEFINE_integer(
+    name='num_parallel_calls', default=input_pipeline.AUTOTUNE,
+    help='Set parallelism of reading and parsing inputs. '
+    '-1 lets tf.data tune it at runtime.')
+flags.DEFINE_integer(
+    name='shuffle_buffer_size', default=1000,
+    help='Set a buffer size for shuffling training inputs.')
+flags.DEFINE_integer(
+    name='prefetch_buffer_size', default=input_pipeline.AUTOTUNE,
+    help='Set the number of prefetched batches. '
+    '-1 lets tf.data tune it at runtime.')
+flags.DEFINE_list(
+    name='bucket_boundaries', default=[],
+    help='Set increasing lengths of movie histories to batch histories of '
+    'similar lengths together and reduce padding. e.g. '
+    '--bucket_boundaries=20,50,100,200,500. Empty disables bucketing.')
+flags.DEFINE_string(
+    name='eval_cache', default=None,
+    help='Cache parsed eval batches in local files with this prefix, which '
+    'are written at startup unless they exist, and which evaluations read '
+    'instead of parsing eval inputs again. Remove them when eval inputs '
+    'change.')
+flags.DEFINE_integer(
+    name='benchmark_input_steps', default=0,
+    help='If positive, only read this number of training batches and report '
+    'examples/sec of the input pipeline, without training the model.')
 flags.DEFINE_string(
     name='eval_filename', default='eval*.tfrecord',
     help='Set a file pattern of evaluation inputs.')
@@ -66,6 +127,12 @@ flags.DEFINE_integer(
 flags.DEFINE_integer(
     name='eval_steps', default=10,
     help='Set the number of steps per evaluation.')
+flags.DEFINE_boolean(
+    name='eval_in_graph_metrics', default=True,
+    help='Compute precision_at_10 against all movies during evaluation, '
+    'which scores eval_batch_size x movies logits at once. Disable it on '
+    'large catalogues and run evaluate.py on checkpoints instead; the eval '
+    'loss is then the training loss.')
 flags.DEFINE_integer(
     name='eval_throttle_secs', default=10,
     help='Set throttle secs for each evaluation.')
@@ -87,6 +154,36 @@ flags.DEFINE_integer(
 flags.DEFINE_integer(
     name='log_step_count_steps', default=1000,
     help='Set frequency of loss logging.')
+flags.DEFINE_enum(
+    name='distribution', default='none', enum_values=DISTRIBUTIONS,
+    help='Specify a distribution strategy for training: none, mirrored '
+    'across CPU replicas of this host, or parameter_server with a cluster '
+    'defined by TF_CONFIG, where the movie_ids embedding is partitioned '
+    'across parameter servers. See run_distributed.sh.')
+flags.DEFINE_integer(
+    name='num_cpu_replicas', default=2,
+    help='Set the number of CPU replicas of the mirrored distribution.')
+flags.DEFINE_integer(
+    name='embedding_partitions', default=0,
+    help='Set the number of shards of the movie_ids embedding. 0 uses one '
+    'shard per parameter server with the parameter_server distribution, '
+    'and a single shard otherwise. Partitioning is not supported by the '
+    'mirrored distribution.')
+flags.DEFINE_enum(
+    name='embedding_optimizer', default='adagrad',
+    enum_values=softmax_model.EMBEDDING_OPTIMIZERS,
+    help='Specify an optimizer of the movie_ids embedding. adagrad keeps an '
+    'accumulator as large as the embedding, while sgd keeps none and halves '
+    'its memory. Updates only touch rows of the batch with the sampled and '
+    'in_batch loss modes.')
+flags.DEFINE_integer(
+    name='intra_op_threads', default=0,
+    help='Set the number of threads used within an op. 0 lets TensorFlow '
+    'choose, or splits the CPU cores between mirrored replicas.')
+flags.DEFINE_integer(
+    name='inter_op_threads', default=0,
+    help='Set the number of ops run in parallel. 0 lets TensorFlow choose, '
+    'or runs one op per mirrored replica at a time.')
 flags.DEFINE_integer(
     name='tf_random_seed', default=20190501,
     help='Set random seed for TensorFlow.')
@@ -94,6 +191,34 @@ flags.DEFINE_integer(
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
+def get_session_config():
+  """Get session config with thread settings of the distribution."""
+  intra_op_threads = FLAGS.intra_op_threads
+  inter_op_threads = FLAGS.inter_op_threads
+  device_count = None
+  if FLAGS.distribution == 'mirrored':
+    # Every replica runs on its own virtual CPU device, and its ops share
+    # the CPU cores of the host with the ops of the other replicas.
+    device_count = {'CPU': FLAGS.num_cpu_replicas}
+    if not intra_op_threads:
+      intra_op_threads = max(
+          1, multiprocessing.cpu_count() // FLAGS.num_cpu_replicas)
+    if not inter_op_threads:
+      inter_op_threads = FLAGS.num_cpu_replicas
+  return tf.ConfigProto(
+      allow_soft_placement=True, device_count=device_count,
+      intra_op_parallelism_threads=intra_op_threads,
+      inter_op_parallelism_threads=inter_op_threads)
+
+def get_train_distribute():
+  """Get a distribution strategy for training, or None."""
+  if FLAGS.distribution == 'mirrored':
+    devices = ['/cpu:{}'.format(i) for i in range(FLAGS.num_cpu_replicas)]
+    return tf.contrib.distribute.MirroredStrategy(devices=devices)
+  if FLAGS.distribution == 'parameter_server':
+    return tf.contrib.distribute.ParameterServerStrategy()
+  return None
+
 def get_run_config():
   """Get running parameters for Estimator."""
   return tf.estimator.RunConfig(
@@ -102,11 +227,22 @@ def get_run_config():
       log_step_count_steps=FLAGS.log_step_count_steps,
       keep_checkpoint_max=FLAGS.keep_checkpoint_max,
       save_checkpoints_steps=FLAGS.save_checkpoints_steps,
-      train_distribute=None,
-      session_config=tf.ConfigProto(allow_soft_placement=True)
+      train_distribute=get_train_distribute(),
+      session_config=get_session_config()
   )
 
-def get_hyperparams():
+def get_embedding_partitions(run_config):
+  """Get the number of partitions of the movie_ids embedding."""
+  if FLAGS.embedding_partitions:
+    if FLAGS.distribution == 'mirrored' and FLAGS.embedding_partitions > 1:
+      raise ValueError(
+          'The mirrored distribution does not support partitioned embeddings.')
+    return FLAGS.embedding_partitions
+  if FLAGS.distribution == 'parameter_server':
+    return max(1, run_config.num_ps_replicas)
+  return 1
+
+def get_hyperparams(run_config):
   """Get hyper params which are used in model function."""
   return tf.contrib.training.HParams(
       metadata_path=FLAGS.metadata_path,
@@ -115,19 +251,93 @@ def get_hyperparams():
       learning_rate=FLAGS.learning_rate,
       lr_decay_steps=FLAGS.lr_decay_steps,
       lr_decay_rate=FLAGS.lr_decay_rate,
+      loss_mode=FLAGS.loss_mode,
+      num_sampled=FLAGS.num_sampled,
+      sampler=FLAGS.sampler,
+      embedding_partitions=get_embedding_partitions(run_config),
+      embedding_optimizer=FLAGS.embedding_optimizer,
+      eval_in_graph_metrics=FLAGS.eval_in_graph_metrics,
   )
 
+def get_vocab_path(metadata_path, filename):
+  """Get the movie vocabulary file of metadata, written to model_dir if the
+  metadata was prepared before vocabulary files."""
+  meta = metadata.load_metadata(metadata_path)
+  if meta.vocab_path():
+    return meta.vocab_path()
+  vocab_path = os.path.join(FLAGS.model_dir, filename)
+  tf.gfile.MakeDirs(FLAGS.model_dir)
+  metadata.write_vocab(vocab_path, meta.movies())
+  return vocab_path
+
+def get_warm_start_settings():
+  """Get warm start settings from a previous model, or None."""
+  if not FLAGS.warm_start_from:
+    return None
+  if not FLAGS.warm_start_metadata_path:
+    raise ValueError('Warm starting needs --warm_start_metadata_path.')
+  # Rows of new movies are initialized like embedding_column does.
+  dimension = int(FLAGS.hidden_dims[-1])
+  vocab_info = tf.estimator.VocabInfo(
+      new_vocab=get_vocab_path(FLAGS.metadata_path, 'movie_vocab.txt'),
+      new_vocab_size=metadata.load_metadata(FLAGS.metadata_path).N,
+      num_oov_buckets=0,
+      old_vocab=get_vocab_path(
+          FLAGS.warm_start_metadata_path, 'previous_movie_vocab.txt'),
+      backup_initializer=tf.truncated_normal_initializer(
+          stddev=1 / math.sqrt(dimension)))
+  return tf.estimator.WarmStartSettings(
+      ckpt_to_initialize_from=FLAGS.warm_start_from,
+      vars_to_warm_start='.*',
+      var_name_to_vocab_info={
+          item_index.ITEM_EMBEDDINGS_VARIABLE: vocab_info})
+
+def get_input_fn(file_pattern, batch_size, mode, cache_filename=None):
+  """Get input function with input pipeline parameters."""
+  return input_pipeline.generate_input_fn(
+      file_pattern=file_pattern, batch_size=batch_size, mode=mode,
+      cycle_length=FLAGS.cycle_length,
+      num_parallel_calls=FLAGS.num_parallel_calls,
+      shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+      prefetch_buffer_size=FLAGS.prefetch_buffer_size,
+      bucket_boundaries=[int(length) for length in FLAGS.bucket_boundaries],
+      cache_filename=cache_filename)
+
+def get_eval_cache_filename():
+  """Get a cache filename of eval inputs, which is written first, or None.
+
+  tf.data drops a partially written cache, so evaluations which stop before
+  the end of eval inputs would write the cache again every time.
+  """
+  if FLAGS.eval_cache is None:
+    return None
+  num_batches = input_pipeline.write_eval_cache(
+      file_pattern=FLAGS.eval_filename, batch_size=FLAGS.eval_batch_size,
+      cache_filename=FLAGS.eval_cache, cycle_length=FLAGS.cycle_length,
+      num_parallel_calls=FLAGS.num_parallel_calls,
+      bucket_boundaries=[int(length) for length in FLAGS.bucket_boundaries])
+  if num_batches is not None:
+    tf.logging.info('Cached {} eval batches in {}'.format(
+        num_batches, FLAGS.eval_cache))
+  return FLAGS.eval_cache
+
 def get_train_spec():
   """Get train spec for Estimator."""
   profile_hook = tf.train.ProfilerHook(
       save_steps=FLAGS.save_checkpoints_steps, output_dir=FLAGS.model_dir,
       show_memory=True)
-  train_input_fn = input_pipeline.generate_input_fn(
+  throughput_hook = hooks.ThroughputHook(
+      name='loss_mode={}'.format(FLAGS.loss_mode),
+      batch_size=FLAGS.train_batch_size,
+      every_n_steps=FLAGS.log_step_count_steps)
+  memory_hook = hooks.MemoryReportHook(
+      every_n_steps=FLAGS.save_checkpoints_steps)
+  train_input_fn = get_input_fn(
       file_pattern=FLAGS.train_filename, batch_size=FLAGS.train_batch_size,
       mode=tf.estimator.ModeKeys.TRAIN)
   train_spec = tf.estimator.TrainSpec(
       input_fn=train_input_fn, max_steps=FLAGS.train_max_steps,
-      hooks=[profile_hook])
+      hooks=[profile_hook, throughput_hook, memory_hook])
   return train_spec
   
 def get_eval_spec():
@@ -135,9 +345,10 @@ def get_eval_spec():
   exporter = tf.estimator.LatestExporter(
       name=FLAGS.export_dir, exports_to_keep=FLAGS.keep_checkpoint_max,
       serving_input_receiver_fn=softmax_model.serving_input_fn)
-  eval_input_fn = input_pipeline.generate_input_fn(
+  eval_input_fn = get_input_fn(
       file_pattern=FLAGS.eval_filename, batch_size=FLAGS.eval_batch_size,
-      mode=tf.estimator.ModeKeys.EVAL)
+      mode=tf.estimator.ModeKeys.EVAL,
+      cache_filename=get_eval_cache_filename())
   eval_spec = tf.estimator.EvalSpec(
       input_fn=eval_input_fn, steps=FLAGS.eval_steps,
       throttle_secs=FLAGS.eval_throttle_secs, exporters=exporter)
@@ -145,18 +356,37 @@ def get_eval_spec():
 
 def remove_artifacts():
   """Remove previous artifacts if needed."""
+  if FLAGS.warm_start_from and not FLAGS.resume_training and (
+      os.path.abspath(FLAGS.warm_start_from) + os.sep).startswith(
+          os.path.abspath(FLAGS.model_dir) + os.sep):
+    raise ValueError('Warm starting from {} would remove it with {}.'.format(
+        FLAGS.warm_start_from, FLAGS.model_dir))
   if not FLAGS.resume_training:
     if tf.gfile.Exists(FLAGS.model_dir):
       tf.logging.info('Removing {} ...'.format(FLAGS.model_dir))
       tf.gfile.DeleteRecursively(FLAGS.model_dir)
   tf.summary.FileWriterCache.clear()
   
+def benchmark_input():
+  """Report throughput of the training input pipeline alone."""
+  train_input_fn = get_input_fn(
+      file_pattern=FLAGS.train_filename, batch_size=FLAGS.train_batch_size,
+      mode=tf.estimator.ModeKeys.TRAIN)
+  input_pipeline.benchmark_input_fn(
+      train_input_fn, num_steps=FLAGS.benchmark_input_steps,
+      log_every_n_steps=max(1, FLAGS.benchmark_input_steps // 10))
+
 def main(_):
+  if FLAGS.benchmark_input_steps > 0:
+    benchmark_input()
+    return
   remove_artifacts()
+  run_config = get_run_config()
   estimator = tf.estimator.Estimator(
       model_fn=softmax_model.model_fn,
-      params=get_hyperparams(),
-      config=get_run_config())
+      params=get_hyperparams(run_config),
+      config=run_config,
+      warm_start_from=get_warm_start_settings())
   tf.estimator.train_and_evaluate(
       estimator=estimator,
       train_spec=get_train_spec(),
@@ -15,16 +15,28 @@
 # limitations under the License.
 
 import os
-import pickle
+import numpy as np
 import tensorflow as tf
+import metadata
 # tf.enable_eager_execution()
 
+LOSS_MODES = ['full', 'sampled', 'in_batch']
+SAMPLERS = ['log_uniform', 'popularity']
+EMBEDDING_OPTIMIZERS = ['adagrad', 'sgd']
+EMBEDDING_SCOPE = 'input_layer/'
+
+
+def get_movie_log_probs(metadata_path):
+  """Returns log-probabilities of movies in training labels, or None."""
+  counts = metadata.load_metadata(metadata_path).counts()
+  if counts is None:
+    return None
+  counts = np.asarray(counts, dtype=np.float64) + 1.0
+  return np.log(counts / counts.sum()).astype(np.float32)
 
 def get_feature_columns(metadata_path, embeddings_dim):
   def _get_num_bucket():
-    with tf.io.gfile.GFile(metadata_path, 'rb') as f:
-      metadata = pickle.load(f)
-    return metadata['N']
+    return metadata.load_metadata(metadata_path).N
     
   categorical_col = tf.feature_column.categorical_column_with_identity(
       key='movie_ids', num_buckets=_get_num_bucket())
@@ -36,6 +48,12 @@ def get_feature_columns(metadata_path, embeddings_dim):
   ]
   return feature_columns
 
+def get_embedding_partitioner(num_partitions):
+  """Get a partitioner of the movie_ids embedding, or None."""
+  if num_partitions > 1:
+    return tf.fixed_size_partitioner(num_partitions)
+  return None
+
 def get_activation_fn(activation):
   if activation == 'relu':
     return tf.nn.relu
@@ -83,6 +101,97 @@ def softmax_loss(user_embeddings, movie_embeddings, labels):
   loss = tf.losses.sparse_softmax_cross_entropy(labels, logits)
   return loss
 
+def sampled_softmax_loss(
+    user_embeddings, movie_embeddings, labels, num_sampled, sampler,
+    movie_log_probs=None):
+  """Calculate loss against a sample of negative movies.
+
+  tf.nn.sampled_softmax_loss subtracts the log expected count of every
+  candidate from its logit, which corrects the bias of the sampler.
+  """
+  num_movies = movie_embeddings.shape[0].value
+  labels = tf.expand_dims(labels, axis=1)
+  if sampler == 'popularity':
+    if movie_log_probs is None:
+      raise ValueError('The popularity sampler needs movie counts in metadata.')
+    sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+        true_classes=labels, num_true=1, num_sampled=num_sampled, unique=True,
+        range_max=num_movies, unigrams=np.exp(movie_log_probs).tolist())
+  else:
+    sampled_values = tf.nn.log_uniform_candidate_sampler(
+        true_classes=labels, num_true=1, num_sampled=num_sampled, unique=True,
+        range_max=num_movies)
+  losses = tf.nn.sampled_softmax_loss(
+      weights=movie_embeddings, biases=tf.zeros([num_movies]), labels=labels,
+      inputs=user_embeddings, num_sampled=num_sampled, num_classes=num_movies,
+      sampled_values=sampled_values, remove_accidental_hits=True)
+  return tf.reduce_mean(losses)
+
+def in_batch_softmax_loss(
+    user_embeddings, movie_embeddings, labels, movie_log_probs=None):
+  """Calculate loss using the labels of the other users as negatives.
+
+  Popular movies appear more often as in-batch negatives, so their logits
+  are corrected by their log-probability when movie counts are known.
+  """
+  label_embeddings = tf.nn.embedding_lookup(movie_embeddings, labels)
+  logits = tf.matmul(user_embeddings, label_embeddings, transpose_b=True)
+  if movie_log_probs is not None:
+    logits -= tf.expand_dims(tf.gather(movie_log_probs, labels), axis=0)
+
+  # Mask duplicated labels, which are not negatives of each other.
+  batch_size = tf.shape(labels)[0]
+  duplicates = tf.logical_and(
+      tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(labels, 0)),
+      tf.logical_not(tf.cast(tf.eye(batch_size), tf.bool)))
+  logits = tf.where(duplicates, tf.fill(tf.shape(logits), -1e9), logits)
+  loss = tf.losses.sparse_softmax_cross_entropy(
+      tf.range(batch_size), logits)
+  return loss
+
+def train_loss(user_embeddings, movie_embeddings, labels, params):
+  """Calculate training loss according to params.loss_mode."""
+  movie_log_probs = None
+  if params.loss_mode != 'full':
+    movie_log_probs = get_movie_log_probs(params.metadata_path)
+  if params.loss_mode == 'sampled':
+    return sampled_softmax_loss(
+        user_embeddings, movie_embeddings, labels, params.num_sampled,
+        params.sampler, movie_log_probs)
+  if params.loss_mode == 'in_batch':
+    return in_batch_softmax_loss(
+        user_embeddings, movie_embeddings, labels, movie_log_probs)
+  return softmax_loss(user_embeddings, movie_embeddings, labels)
+
+def get_embedding_optimizer(name, learning_rate):
+  if name == 'sgd':
+    return tf.train.GradientDescentOptimizer(learning_rate)
+  return tf.train.AdagradOptimizer(learning_rate)
+
+def train_op_fn(loss, learning_rate, params):
+  """Create a train op, optimizing the movie_ids embedding separately.
+
+  The embedding gradient is IndexedSlices unless the full softmax loss is
+  used, so sparse updates only touch its rows.
+  """
+  global_step = tf.train.get_global_step()
+  optimizer = tf.train.AdagradOptimizer(learning_rate)
+  if params.embedding_optimizer == 'adagrad':
+    return optimizer.minimize(loss, global_step=global_step)
+
+  grads_and_vars = optimizer.compute_gradients(loss)
+  embedding_grads_and_vars = [
+      (grad, var) for grad, var in grads_and_vars
+      if var.op.name.startswith(EMBEDDING_SCOPE)]
+  other_grads_and_vars = [
+      (grad, var) for grad, var in grads_and_vars
+      if not var.op.name.startswith(EMBEDDING_SCOPE)]
+  embedding_optimizer = get_embedding_optimizer(
+      params.embedding_optimizer, learning_rate)
+  return tf.group(
+      embedding_optimizer.apply_gradients(embedding_grads_and_vars),
+      optimizer.apply_gradients(other_grads_and_vars, global_step=global_step))
+
 def serving_input_fn():
   receiver_tensor = {'input': tf.placeholder(shape=[None, None], dtype=tf.int64)}
   features = {'movie_ids': receiver_tensor['input']}
@@ -103,19 +212,30 @@ def model_fn(features, labels, mode, params):
   feature_columns = get_feature_columns(
       metadata_path=params.metadata_path,
       embeddings_dim=params.hidden_dims[-1])
-  user_input = tf.feature_column.input_layer(
-      features=features, feature_columns=feature_columns)
+  # the movie_ids embedding is split across parameter servers if partitioned.
+  partitioner = get_embedding_partitioner(params.embedding_partitions)
+  with tf.variable_scope(tf.get_variable_scope(), partitioner=partitioner):
+    user_input = tf.feature_column.input_layer(
+        features=features, feature_columns=feature_columns)
   user_embeddings = build_network(
       inputs=user_input, hidden_dims=params.hidden_dims,
       activation_fn=get_activation_fn(params.activation_name))
   
-  # extract movie_embeddings
-  with tf.variable_scope('input_layer', reuse=True):
-    movie_embeddings = tf.get_variable('movie_ids_embedding/embedding_weights')
+  # extract movie_embeddings, a PartitionedVariable if partitioned.
+  with tf.variable_scope('input_layer', reuse=True, partitioner=partitioner):
+    movie_embeddings = tf.get_variable(
+        'movie_ids_embedding/embedding_weights',
+        shape=[metadata.load_metadata(params.metadata_path).N,
+               params.hidden_dims[-1]])
 
   # generate labels from features['movie_ids']
   labels = generate_labels(features)
-  loss = softmax_loss(user_embeddings, movie_embeddings, labels)
+  # without in-graph metrics, eval avoids the logits of all movies too.
+  if mode == tf.estimator.ModeKeys.TRAIN or (
+      mode == tf.estimator.ModeKeys.EVAL and not params.eval_in_graph_metrics):
+    loss = train_loss(user_embeddings, movie_embeddings, labels, params)
+  else:
+    loss = softmax_loss(user_embeddings, movie_embeddings, labels)
   
   estimator_spec = None
   
@@ -134,18 +254,17 @@ def model_fn(features, labels, mode, params):
     learning_rate = tf.train.exponential_decay(
         learning_rate=params.learning_rate, global_step=global_step,
         decay_steps=params.lr_decay_steps, decay_rate=params.lr_decay_rate)
-    optimizer = tf.train.AdagradOptimizer(learning_rate)
-    train_op = optimizer.minimize(loss, global_step=global_step)
+    train_op = train_op_fn(loss, learning_rate, params)
     estimator_spec = tf.estimator.EstimatorSpec(
         mode=mode, loss=loss, train_op=train_op)
 
   if mode == tf.estimator.ModeKeys.EVAL:
-    predictions = tf.matmul(
-        user_embeddings, movie_embeddings, transpose_b=True)
-    eval_metric_ops = {
-        'precision_at_10': tf.metrics.precision_at_k(
-            labels=labels, predictions=predictions, k=10)
-    }
+    eval_metric_ops = {}
+    if params.eval_in_graph_metrics:
+      predictions = tf.matmul(
+          user_embeddings, movie_embeddings, transpose_b=True)
+      eval_metric_ops['precision_at_10'] = tf.metrics.precision_at_k(
+          labels=labels, predictions=predictions, k=10)
     estimator_spec = tf.estimator.EstimatorSpec(
         mode=mode, loss=loss, eval_metric_ops=eval_metric_ops)
   
@@ -14,8 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import math
+import re
+import time
 import apache_beam as beam
 from apache_beam.io.gcp.datastore.v1.datastoreio import WriteToDatastore
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 import tensorflow as tf
 from google.cloud.proto.datastore.v1 import entity_pb2
 from googledatastore import helper as datastore_helper
@@ -26,30 +32,61 @@ from tensorflow_transform.beam import impl
 
 encoder = None
 
+METRICS_NAMESPACE = 'etl'
 
-def get_source_query(limit=1000000):
+VECTOR_LENGTH = 512
+# Estimated serialized size of one embedding record: the float32 vector,
+# a 36 characters UUID, the language code, the title text (at most 500
+# characters, about 60 on average) and the tf.Example framing.
+ESTIMATED_RECORD_BYTES = VECTOR_LENGTH * 4 + 36 + 8 + 60 + 100
+# Language codes are pasted in the query, so they are only letters and dashes.
+LANGUAGE_PATTERN = re.compile(r'^[a-z-]+$')
+
+
+def get_articles_query(languages=('en',)):
+  languages = [language.strip() for language in languages]
+  for language in languages:
+    if not LANGUAGE_PATTERN.match(language):
+      raise ValueError('Invalid language code: {!r}'.format(language))
   query = """
-    SELECT
-      GENERATE_UUID() as id,
-      text
-    FROM
-    (
         SELECT
-          DISTINCT LOWER(title) text
+          DISTINCT LOWER(title) text,
+          language
         FROM
           `bigquery-samples.wikipedia_benchmark.Wiki100B`
         WHERE
           ARRAY_LENGTH(split(title,' ')) >= 5
         AND
-          language = 'en'
+          language IN ({0})
         AND
           LENGTH(title) < 500
-     )
+  """.format(', '.join("'{}'".format(language) for language in languages))
+  return query
+
+
+def get_source_query(limit=1000000, languages=('en',)):
+  query = """
+    SELECT
+      GENERATE_UUID() as id,
+      text,
+      language
+    FROM
+    (
+      {1}
+    )
     LIMIT {0}
-  """.format(limit)
+  """.format(limit, get_articles_query(languages))
   return query
 
 
+def count_source_records(project, limit=1000000, languages=('en',)):
+  """Returns the number of records the source query reads."""
+  from google.cloud import bigquery
+  query = 'SELECT COUNT(*) FROM ({})'.format(get_articles_query(languages))
+  rows = list(bigquery.Client(project=project).query(query).result())
+  return min(limit, rows[0][0])
+
+
 def embed_text(text):
   import tensorflow_hub as hub
   global encoder
@@ -72,6 +109,8 @@ def get_metadata():
     'id': dataset_schema.ColumnSchema(
       tf.string, [], dataset_schema.FixedColumnRepresentation()),
     'text': dataset_schema.ColumnSchema(
+      tf.string, [], dataset_schema.FixedColumnRepresentation()),
+    'language': dataset_schema.ColumnSchema(
       tf.string, [], dataset_schema.FixedColumnRepresentation())
   }))
   return metadata
@@ -82,33 +121,78 @@ def preprocess_fn(input_features):
   embedding = tft.apply_function(embed_text, input_features['text'])
   output_features = {
     'id': input_features['id'],
+    'text': input_features['text'],
+    'language': input_features['language'],
     'embedding': embedding
   }
   return output_features
 
 
+class CountElementsFn(beam.DoFn):
+  """Passes elements through, counting them under the given stage name."""
+
+  def __init__(self, stage):
+    self._counter = Metrics.counter(
+      METRICS_NAMESPACE, '{}_elements'.format(stage))
+
+  def process(self, element):
+    self._counter.inc()
+    yield element
+
+
 def create_entity(input_features, kind):
   entity = entity_pb2.Entity()
   datastore_helper.add_key_path(
     entity.key, kind, input_features['id'])
   datastore_helper.add_properties(
     entity, {
-      'text': unicode(input_features['text'])
+      'text': unicode(input_features['text']),
+      'language': unicode(input_features['language'])
     })
   return entity
 
 
+def get_num_shards(num_records, target_shard_size_mb):
+  total_bytes = num_records * ESTIMATED_RECORD_BYTES
+  target_shard_bytes = target_shard_size_mb * 1024 ** 2
+  return max(1, int(math.ceil(total_bytes / float(target_shard_bytes))))
+
+
+def log_metrics(job, elapsed_secs):
+  results = job.metrics().query(
+    MetricsFilter().with_namespace(METRICS_NAMESPACE))
+  for counter in results['counters']:
+    value = counter.committed or counter.attempted
+    logging.info('{}: {} ({} per second)'.format(
+      counter.key.metric.name, value, round(value / elapsed_secs, 2)))
+  for distribution in results['distributions']:
+    value = distribution.committed or distribution.attempted
+    logging.info('{}: mean {}, min {}, max {}'.format(
+      distribution.key.metric.name, value.mean, value.min, value.max))
+
+
 def run(pipeline_options, known_args):
 
   pipeline = beam.Pipeline(options=pipeline_options)
   gcp_project = pipeline_options.get_all_options()['project']
+  languages = known_args.languages.split(',')
+
+  # The shards are sized for the records the query actually returns, which
+  # are counted by a query of the same articles before the pipeline runs.
+  num_records = count_source_records(
+    gcp_project, known_args.limit, languages)
+  num_shards = get_num_shards(num_records, known_args.target_shard_size_mb)
+  logging.info('Writing embeddings of {} records to {} shards.'.format(
+    num_records, num_shards))
 
   with impl.Context(known_args.transform_temp_dir):
     articles = (
         pipeline
         | 'Read articles from BigQuery' >> beam.io.Read(beam.io.BigQuerySource(
-      project=gcp_project, query=get_source_query(known_args.limit),
+      project=gcp_project, query=get_source_query(
+        known_args.limit, languages),
       use_standard_sql=True))
+        | 'Count articles' >> beam.ParDo(CountElementsFn('articles'))
     )
 
     articles_dataset = (articles, get_metadata())
@@ -118,13 +202,15 @@ def run(pipeline_options, known_args):
     )
 
     embeddings, transformed_metadata = embeddings_dataset
+    embeddings = embeddings | 'Count embeddings' >> beam.ParDo(
+      CountElementsFn('embeddings'))
 
     embeddings | 'Write embeddings to TFRecords' >> beam.io.tfrecordio.WriteToTFRecord(
       file_path_prefix='{0}'.format(known_args.output_dir),
       file_name_suffix='.tfrecords',
       coder=tft_coders.example_proto_coder.ExampleProtoCoder(
         transformed_metadata.schema),
-      num_shards=int(known_args.limit/25000)
+      num_shards=num_shards
     )
 
     (
@@ -140,7 +226,11 @@ def run(pipeline_options, known_args):
         file_path_prefix=known_args.debug_output_prefix,
         file_name_suffix='.txt')
 
+  time_start = time.time()
   job = pipeline.run()
 
   if pipeline_options.get_all_options()['runner'] == 'DirectRunner':
-    job.wait_until_finish()
\ No newline at end of file
+    job.wait_until_finish()
+    log_metrics(job, time.time() - time_start)
+
+  return job
@@ -52,6 +52,15 @@ def get_args(argv):
                       default=1000000,
                       help='Maximum number of records to retrieve from BigQuery.')
 
+  parser.add_argument('--languages',
+                      default='en',
+                      help='Comma separated language codes of the articles.')
+
+  parser.add_argument('--target_shard_size_mb',
+                      type=int,
+                      default=64,
+                      help='Target size of each embeddings TFRecord shard.')
+
   known_args, pipeline_args = parser.parse_known_args(argv)
   return known_args, pipeline_args
 
@@ -65,5 +74,6 @@ def main(argv=None):
 
 
 if __name__ == '__main__':
-  logging.getLogger().setLevel(logging.ERROR)
+  # INFO, so that the counters and throughput of DirectRunner runs are shown.
+  logging.getLogger().setLevel(logging.INFO)
   main()
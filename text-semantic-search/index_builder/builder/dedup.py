@@ -0,0 +1,264 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Finds near-duplicate items of a built Annoy index.
+
+Every worker of a process pool memory-maps the same index file, so the
+index is only paged in once, and finds the nearest neighbours of a batch of
+items. Pairs of items whose cosine similarity is above a threshold are
+clustered with union-find into duplicate groups, whose first item is kept.
+
+Writes two files to the output directory:
+  duplicate_groups.jsonl: a JSON list of the ids of every duplicate group,
+    the kept id first.
+  dedup_ids.txt: the ids of the kept items, one per line, which
+    task.py --dedup-ids uses to build an index without duplicates.
+
+Runs locally, next to the index artefacts downloaded from GCS, with:
+  python -m builder.dedup --index-file embeds.index --output-dir dedup
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import time
+import numpy as np
+import tensorflow as tf
+from annoy import AnnoyIndex
+import ivf
+
+VECTOR_LENGTH = 512
+METRIC = 'angular'
+GROUPS_FILE = 'duplicate_groups.jsonl'
+DEDUP_IDS_FILE = 'dedup_ids.txt'
+
+BATCH_SIZE = 10000
+
+_worker_index = None
+
+
+def get_vector_length(index_file):
+  """Returns the dimensions of the index, projected if the index is."""
+  if os.path.exists(index_file + '.projection'):
+    with open(index_file + '.projection', 'rb') as handle:
+      return np.load(handle)['matrix'].shape[1]
+  return VECTOR_LENGTH
+
+
+def _init_worker(index_file, vector_length):
+  global _worker_index
+  _worker_index = AnnoyIndex(vector_length, metric=METRIC)
+  _worker_index.load(index_file, prefault=False)
+
+
+def _find_pairs(args):
+  """Returns the (first, second, similarity) pairs of a batch of items
+  above the threshold, with first < second.
+
+  k-NN is not symmetric, so a pair is kept whichever of its two items finds
+  the other, and may be found twice.
+  """
+  start, end, num_neighbours, threshold, search_k = args
+  items, neighbours, similarities = [], [], []
+  for item in range(start, end):
+    ids, distances = _worker_index.get_nns_by_item(
+      item, num_neighbours + 1, search_k=search_k, include_distances=True)
+    for neighbour, distance in zip(ids, distances):
+      # The angular distance of Annoy is sqrt(2 * (1 - cosine)).
+      similarity = 1. - distance * distance / 2.
+      if neighbour != item and similarity >= threshold:
+        items.append(min(item, neighbour))
+        neighbours.append(max(item, neighbour))
+        similarities.append(similarity)
+  return (end - start, np.array(items, dtype=np.uint32),
+          np.array(neighbours, dtype=np.uint32),
+          np.array(similarities, dtype=np.float32))
+
+
+def find_duplicate_pairs(index_file, num_items, vector_length,
+                         num_neighbours=10, threshold=0.95, search_k=-1,
+                         num_workers=None):
+  """Finds the pairs of items above the threshold with a process pool.
+
+  Returns:
+    Arrays of the first items, second items and similarities of the
+    distinct pairs.
+  """
+  num_workers = num_workers or multiprocessing.cpu_count()
+  batches = [(start, min(start + BATCH_SIZE, num_items), num_neighbours,
+              threshold, search_k)
+             for start in range(0, num_items, BATCH_SIZE)]
+  pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(index_file, vector_length))
+  items, neighbours, similarities = [], [], []
+  start_time = time.time()
+  done = 0
+  try:
+    for batch_size, batch_items, batch_neighbours, batch_similarities in \
+        pool.imap_unordered(_find_pairs, batches):
+      items.append(batch_items)
+      neighbours.append(batch_neighbours)
+      similarities.append(batch_similarities)
+      done += batch_size
+      elapsed = time.time() - start_time
+      logging.info('Searched {} of {} items, {:.0f} items/sec.'.format(
+        done, num_items, done / max(elapsed, 1e-6)))
+  finally:
+    pool.close()
+    pool.join()
+  if not items:
+    empty = np.zeros(0, dtype=np.uint32)
+    return empty, empty, np.zeros(0, dtype=np.float32)
+  items, neighbours = np.concatenate(items), np.concatenate(neighbours)
+  # Pairs found from both of their items are kept once.
+  pair_codes = (items.astype(np.uint64) << np.uint64(32)) | neighbours
+  _, first_positions = np.unique(pair_codes, return_index=True)
+  return (items[first_positions], neighbours[first_positions],
+          np.concatenate(similarities)[first_positions])
+
+
+def union_find(num_items, items, neighbours):
+  """Returns the root of every item, the smallest item of its group."""
+  parents = np.arange(num_items, dtype=np.int64)
+
+  def _find(item):
+    while parents[item] != item:
+      parents[item] = parents[parents[item]]
+      item = parents[item]
+    return item
+
+  for item, neighbour in zip(items, neighbours):
+    root, other = _find(item), _find(neighbour)
+    if root != other:
+      parents[max(root, other)] = min(root, other)
+  for item in range(num_items):
+    parents[item] = _find(item)
+  return parents
+
+
+def write_groups(output_dir, mapping, roots):
+  """Writes the duplicate groups and the ids of the kept items.
+
+  Returns:
+    The number of groups and the number of kept items.
+  """
+  tf.gfile.MakeDirs(output_dir)
+  order = np.argsort(roots, kind='mergesort')
+  group_roots, starts, sizes = np.unique(
+    roots[order], return_index=True, return_counts=True)
+  num_groups = 0
+  with tf.gfile.GFile(os.path.join(output_dir, GROUPS_FILE), 'w') as handle:
+    for start, size in zip(starts, sizes):
+      if size > 1:
+        group = order[start:start + size]
+        handle.write(json.dumps(
+          [tf.compat.as_text(mapping[int(item)]) for item in group]) + '\n')
+        num_groups += 1
+  with tf.gfile.GFile(os.path.join(output_dir, DEDUP_IDS_FILE), 'w') as handle:
+    for root in group_roots:
+      handle.write(tf.compat.as_text(mapping[int(root)]) + '\n')
+  return num_groups, len(group_roots)
+
+
+def load_dedup_ids(dedup_ids_file):
+  """Returns the set of the ids kept by a dedup job, as bytes."""
+  with tf.gfile.GFile(dedup_ids_file, 'r') as handle:
+    return set(tf.compat.as_bytes(line.rstrip('\n'))
+               for line in handle if line.strip())
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--index-file',
+    help='Local path to the Annoy index, next to its mapping file',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--output-dir',
+    help='GCS or local path to the output directory',
+    required=True
+  )
+
+  args_parser.add_argument(
+    '--threshold',
+    help='Minimum cosine similarity of near-duplicate items',
+    default=0.95,
+    type=float
+  )
+
+  args_parser.add_argument(
+    '--num-neighbours',
+    help='Number of nearest neighbours compared with every item',
+    default=10,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--search-k',
+    help='Number of nodes inspected by Annoy searches, -1 for its default',
+    default=-1,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--num-workers',
+    help='Number of worker processes, by default the number of CPUs',
+    default=None,
+    type=int
+  )
+
+  return args_parser.parse_args()
+
+
+def main():
+
+  args = get_args()
+
+  with open(args.index_file, 'rb') as handle:
+    if handle.read(len(ivf.MAGIC)) == ivf.MAGIC:
+      raise ValueError('Deduplication needs an Annoy index, not an IVF index.')
+  with open(args.index_file + '.mapping', 'rb') as handle:
+    mapping = pickle.load(handle)
+  num_items = len(mapping)
+  vector_length = get_vector_length(args.index_file)
+
+  start_time = time.time()
+  logging.info('Finding near-duplicates of {} items...'.format(num_items))
+  items, neighbours, _ = find_duplicate_pairs(
+    args.index_file, num_items, vector_length, args.num_neighbours,
+    args.threshold, args.search_k, args.num_workers)
+  logging.info('Found {} pairs above {} in {:.1f} secs.'.format(
+    len(items), args.threshold, time.time() - start_time))
+
+  roots = union_find(num_items, items, neighbours)
+  num_groups, num_kept = write_groups(args.output_dir, mapping, roots)
+  logging.info('{} duplicate groups, {} of {} items are kept.'.format(
+    num_groups, num_kept, num_items))
+  logging.info('Deduplication elapsed time: {:.1f} secs, {:.0f} items/sec.'
+               .format(time.time() - start_time,
+                       num_items / max(time.time() - start_time, 1e-6)))
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
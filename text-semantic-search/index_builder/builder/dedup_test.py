@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from annoy import AnnoyIndex
+import dedup
+
+DIMS = 8
+
+
+class UnionFindTest(unittest.TestCase):
+
+  def test_groups_are_rooted_at_their_smallest_item(self):
+    roots = dedup.union_find(7, [4, 1, 5], [6, 4, 3])
+    self.assertEqual(roots.tolist(), [0, 1, 2, 3, 1, 3, 1])
+
+  def test_no_pairs_keep_every_item(self):
+    roots = dedup.union_find(3, [], [])
+    self.assertEqual(roots.tolist(), [0, 1, 2])
+
+  def test_long_chains_are_merged(self):
+    items = np.arange(999, 0, -1)
+    roots = dedup.union_find(1000, items, items - 1)
+    self.assertEqual(set(roots.tolist()), {0})
+
+
+class DedupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.temp_dir, 'embeds.index')
+    random_state = np.random.RandomState(0)
+    vectors = random_state.normal(size=(6, DIMS))
+    # Items 3 and 5 are near-duplicates of item 0, item 4 of item 2.
+    vectors[3] = vectors[0] + 0.01
+    vectors[5] = vectors[0] - 0.01
+    vectors[4] = 2 * vectors[2]
+    annoy_index = AnnoyIndex(DIMS, metric=dedup.METRIC)
+    for item, vector in enumerate(vectors):
+      annoy_index.add_item(item, vector)
+    annoy_index.build(10)
+    annoy_index.save(self.index_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_distinct_pairs_above_the_threshold(self):
+    items, neighbours, similarities = dedup.find_duplicate_pairs(
+      self.index_file, 6, DIMS, num_neighbours=5, threshold=0.99,
+      num_workers=1)
+    self.assertEqual(sorted(zip(items.tolist(), neighbours.tolist())),
+                     [(0, 3), (0, 5), (2, 4), (3, 5)])
+    self.assertTrue(np.all(similarities >= 0.99))
+
+  def test_groups_and_kept_ids_are_written(self):
+    items, neighbours, _ = dedup.find_duplicate_pairs(
+      self.index_file, 6, DIMS, num_neighbours=5, threshold=0.99,
+      num_workers=1)
+    roots = dedup.union_find(6, items, neighbours)
+    mapping = dict((item, 'id-{}'.format(item)) for item in range(6))
+    output_dir = os.path.join(self.temp_dir, 'dedup')
+    self.assertEqual(dedup.write_groups(output_dir, mapping, roots), (2, 3))
+    with open(os.path.join(output_dir, dedup.GROUPS_FILE)) as handle:
+      groups = [json.loads(line) for line in handle]
+    self.assertEqual(groups, [['id-0', 'id-3', 'id-5'], ['id-2', 'id-4']])
+    self.assertEqual(
+      dedup.load_dedup_ids(os.path.join(output_dir, dedup.DEDUP_IDS_FILE)),
+      {b'id-0', b'id-1', b'id-2'})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,56 +16,267 @@
 
 import tensorflow as tf
 import numpy as np
+import hashlib
+import json
 import logging
 import pickle
 import os
 from annoy import AnnoyIndex
+import projection as proj
+import lexical
+import ivf
+import dedup
+import staging
 
 VECTOR_LENGTH = 512
 METRIC = 'angular'
+INDEX_TYPES = ['annoy', 'ivf']
+REVERSE_INDEX_DTYPE = np.dtype([('hash', '<u8'), ('item', '<u4')])
+# Suffixes of the files written next to the index, by some configurations.
+ARTEFACT_SUFFIXES = ['', '.mapping', '.ids', '.projection', '.attributes',
+                     '.lexicon', '.postings', '.doclens']
 
 
-def build_index(embedding_files_pattern, index_filename,
-                num_trees=100):
+def _load_embeddings_file(embed_file, feature_names=(), keep_ids=None):
+  """Returns the identifiers, the embeddings matrix and the features of the
+  items of a TFRecord file, without the items which are not in keep_ids."""
+  identifiers = []
+  file_embeddings = []
+  features = dict((name, []) for name in feature_names)
+  skipped = 0
+  record_iterator = tf.python_io.tf_record_iterator(path=embed_file)
+  for string_record in record_iterator:
+    example = tf.train.Example()
+    example.ParseFromString(string_record)
+    string_identifier = example.features.feature['id'].bytes_list.value[0]
+    if keep_ids is not None and string_identifier not in keep_ids:
+      skipped += 1
+      continue
+    identifiers.append(string_identifier)
+    for name in feature_names:
+      values = example.features.feature[name].bytes_list.value
+      features[name].append(values[0] if values else '')
+    file_embeddings.append(
+      example.features.feature['embedding'].float_list.value)
+  if skipped:
+    logging.info('Skipped {} items which are not in the kept ids.'.format(
+      skipped))
+  file_embeddings = (np.array(file_embeddings, dtype=np.float32)
+                     if file_embeddings
+                     else np.zeros((0, VECTOR_LENGTH), dtype=np.float32))
+  return identifiers, file_embeddings, features
+
+
+def load_embeddings(embedding_files_pattern, feature_names=(), keep_ids=None,
+                    staging_area=None):
+  """Loads the embeddings in the TFRecord files into memory.
 
-  annoy_index = AnnoyIndex(VECTOR_LENGTH, metric=METRIC)
-  mapping = {}
+  When keep_ids is a set of identifiers, the other items are skipped. When a
+  staging area is given, every file is staged as a shard once loaded, and
+  shards staged by an earlier run of the job are not loaded again. The
+  embeddings are then staged as one matrix, which is memory-mapped.
+
+  Returns:
+    A (mapping, embeddings, features) tuple, where mapping maps the item
+    number to its string identifier, embeddings is a float32 matrix whose rows
+    are indexed by item number, and features maps each of the feature_names
+    to the list of its string values, indexed by item number.
+  """
+  identifiers = []
+  embeddings = []
+  features = dict((name, []) for name in feature_names)
 
   embed_files = tf.gfile.Glob(embedding_files_pattern)[:250]
   logging.info('{} embedding files are found.'.format(len(embed_files)))
 
-  item_counter = 0
+  fingerprints = []
   for f, embed_file in enumerate(embed_files):
-    logging.info('Loading embeddings in file {} of {}...'.format(
-      f, len(embed_files)))
-    record_iterator = tf.python_io.tf_record_iterator(
-      path=embed_file)
-
-    for string_record in record_iterator:
-      example = tf.train.Example()
-      example.ParseFromString(string_record)
-      string_identifier = example.features.feature['id'].bytes_list.value[0]
-      mapping[item_counter] = string_identifier
-      embedding = np.array(
-        example.features.feature['embedding'].float_list.value)
-      annoy_index.add_item(item_counter, embedding)
-      item_counter += 1
-
-    logging.info('Loaded {} items to the index'.format(item_counter))
-
-  logging.info('Start building the index with {} trees...'.format(num_trees))
-  annoy_index.build(n_trees=num_trees)
-  logging.info('Index is successfully built.')
-  logging.info('Saving index to disk...')
-  annoy_index.save(index_filename)
-  logging.info('Index is saved to disk.')
+    shard = 'shard-{:05d}'.format(f)
+    fingerprint = (staging.file_fingerprint(embed_file)
+                   if staging_area is not None else None)
+    fingerprints.append(fingerprint)
+    if staging_area is not None and staging_area.is_done(shard, fingerprint):
+      logging.info('Embeddings in file {} of {} are already staged.'.format(
+        f, len(embed_files)))
+      file_identifiers, file_features = staging_area.load_object(
+        shard + '.ids')
+      file_embeddings = staging_area.load_array(shard + '.npy')
+    else:
+      logging.info('Loading embeddings in file {} of {}...'.format(
+        f, len(embed_files)))
+      file_identifiers, file_embeddings, file_features = (
+        _load_embeddings_file(embed_file, feature_names, keep_ids))
+      if staging_area is not None:
+        staging_area.save_array(shard + '.npy', file_embeddings)
+        staging_area.save_object(shard + '.ids',
+                                 (file_identifiers, file_features))
+        staging_area.mark_done(shard, [shard + '.npy', shard + '.ids'],
+                               fingerprint)
+
+    identifiers.extend(file_identifiers)
+    embeddings.append(file_embeddings)
+    for name in feature_names:
+      features[name].extend(file_features[name])
+    logging.info('Loaded {} items.'.format(len(identifiers)))
+
+  mapping = dict(enumerate(identifiers))
+  if not embeddings:
+    embeddings = np.zeros((0, VECTOR_LENGTH), dtype=np.float32)
+  elif staging_area is None:
+    embeddings = np.concatenate(embeddings)
+  else:
+    if not staging_area.is_done('embeddings', fingerprints):
+      logging.info('Staging the embeddings matrix...')
+      staging_area.concatenate_arrays(
+        'embeddings.npy', embeddings, embeddings[0].shape[1])
+      # The matrix is rebuilt from the shards faster than it is copied.
+      staging_area.mark_done('embeddings', ['embeddings.npy'], fingerprints,
+                             mirror=False)
+    embeddings = staging_area.load_array('embeddings.npy')
+  return mapping, embeddings, features
+
+
+def save_attributes(filename, attributes):
+  """Saves the item attributes as a vocabulary and a compact codes array."""
+  arrays = {}
+  for name, values in attributes.items():
+    vocabulary, codes = np.unique(values, return_inverse=True)
+    if len(vocabulary) == 1 and vocabulary[0] == '':
+      logging.warning('Attribute {} is not found in embeddings.'.format(name))
+      continue
+    codes_dtype = np.uint8 if len(vocabulary) <= 2 ** 8 else (
+      np.uint16 if len(vocabulary) <= 2 ** 16 else np.uint32)
+    arrays[name + '_vocabulary'] = vocabulary
+    arrays[name + '_codes'] = codes.astype(codes_dtype)
+    logging.info('Attribute {} has {} distinct values.'.format(
+      name, len(vocabulary)))
+  if arrays:
+    with open(filename, 'wb') as handle:
+      np.savez(handle, **arrays)
+  return bool(arrays)
+
+
+def id_hash(identifier):
+  """Returns a 64-bit hash of an item identifier, stable across processes."""
+  if not isinstance(identifier, bytes):
+    identifier = identifier.encode('utf-8')
+  return int(np.frombuffer(
+    hashlib.md5(identifier).digest()[:8], dtype='<u8')[0])
+
+
+def save_reverse_index(filename, mapping):
+  """Saves (hash of identifier, item number) pairs sorted by hash as .npy,
+  so that item numbers are found by binary search in the mmapped array."""
+  item_numbers = np.fromiter(mapping.keys(), dtype=np.uint32,
+                             count=len(mapping))
+  # The first 8 bytes of the md5 digests are id_hash of every identifier.
+  digests = b''.join(
+    hashlib.md5(identifier if isinstance(identifier, bytes)
+                else identifier.encode('utf-8')).digest()[:8]
+    for identifier in mapping.values())
+  reverse_index = np.empty(len(mapping), dtype=REVERSE_INDEX_DTYPE)
+  reverse_index['hash'] = np.frombuffer(digests, dtype='<u8')
+  reverse_index['item'] = item_numbers
+  reverse_index.sort(order='hash')
+  with open(filename, 'wb') as handle:
+    np.save(handle, reverse_index)
+
+
+def build_index(embedding_files_pattern, index_filename,
+                num_trees=100, projection=None, projection_dims=128,
+                projection_sample_size=100000, attribute_names=(),
+                build_lexical_index=False, index_type='annoy',
+                num_lists=None, nprobe=16, dedup_ids_file=None,
+                staging_dir=None, remote_staging_dir=None):
+
+  feature_names = list(attribute_names)
+  if build_lexical_index:
+    feature_names.append('text')
+
+  staging_area = None
+  build_fingerprint = None
+  if staging_dir:
+    # The staged shards depend on the loaded features and the kept ids, so
+    # every combination of them is staged in its own directory.
+    inputs = [sorted(feature_names), staging.file_fingerprint(dedup_ids_file)
+              if dedup_ids_file else None]
+    key = hashlib.md5(json.dumps(inputs).encode('utf-8')).hexdigest()[:12]
+    staging_area = staging.StagingArea(
+      os.path.join(staging_dir, key),
+      os.path.join(remote_staging_dir, key) if remote_staging_dir else None)
+    build_fingerprint = [
+      [staging.file_fingerprint(embed_file) for embed_file in
+       tf.gfile.Glob(embedding_files_pattern)[:250]],
+      num_trees, projection, projection_dims, projection_sample_size,
+      index_type, num_lists, nprobe]
+    if staging_area.is_done('index', build_fingerprint):
+      logging.info('Index {} is already built.'.format(index_filename))
+      return
+
+  keep_ids = None
+  if dedup_ids_file:
+    keep_ids = dedup.load_dedup_ids(dedup_ids_file)
+    logging.info('{} deduplicated ids are loaded.'.format(len(keep_ids)))
+  mapping, embeddings, features = load_embeddings(
+    embedding_files_pattern, feature_names, keep_ids, staging_area)
+
+  if build_lexical_index:
+    logging.info('Building the inverted index of the item texts...')
+    lexical.build_inverted_index(features.pop('text'), index_filename)
+    logging.info('Inverted index is saved to disk.')
+
+  if save_attributes(index_filename + '.attributes', features):
+    logging.info('Attributes are saved to disk.')
+  del features
+
+  if projection:
+    logging.info('Fitting {} projection to {} dimensions...'.format(
+      projection, projection_dims))
+    mean, matrix = proj.fit_projection(
+      embeddings, projection, projection_dims, projection_sample_size)
+    logging.info('Projection recall report: {}'.format(
+      proj.recall_report(embeddings, mean, matrix)))
+    embeddings = proj.project(embeddings, mean, matrix)
+    proj.save_projection(index_filename + '.projection', mean, matrix)
+    logging.info('Projection is saved to disk.')
+
+  if index_type == 'ivf':
+    logging.info('Start building the IVF index...')
+    ivf.build_ivf_index(embeddings, index_filename, num_lists, nprobe)
+    del embeddings
+    logging.info('Index is successfully built.')
+  else:
+    annoy_index = AnnoyIndex(embeddings.shape[1], metric=METRIC)
+    for item_number, embedding in enumerate(embeddings):
+      annoy_index.add_item(item_number, embedding)
+    logging.info('Added {} items to the index'.format(len(embeddings)))
+    del embeddings
+
+    logging.info('Start building the index with {} trees...'.format(
+      num_trees))
+    annoy_index.build(n_trees=num_trees)
+    logging.info('Index is successfully built.')
+    logging.info('Saving index to disk...')
+    annoy_index.save(index_filename)
+    logging.info('Index is saved to disk.')
+    annoy_index.unload()
   logging.info("Index file size: {} GB".format(
     round(os.path.getsize(index_filename) / float(1024 ** 3), 2)))
-  annoy_index.unload()
   logging.info('Saving mapping to disk...')
   with open(index_filename + '.mapping', 'wb') as handle:
     pickle.dump(mapping, handle, protocol=pickle.HIGHEST_PROTOCOL)
   logging.info('Mapping is saved to disk.')
   logging.info("Mapping file size: {} MB".format(
     round(os.path.getsize(index_filename + '.mapping') / float(1024 ** 2), 2)))
+  logging.info('Saving reverse mapping to disk...')
+  save_reverse_index(index_filename + '.ids', mapping)
+  logging.info('Reverse mapping is saved to disk.')
+  if staging_area is not None:
+    # The index artefacts are copied to the remote staging directory, so that
+    # a job restarted on another machine uploads them without rebuilding.
+    logging.info('Staging the index artefacts...')
+    staging_area.mark_done(
+      'index', [], build_fingerprint, mirror=False,
+      outputs=[index_filename + suffix for suffix in ARTEFACT_SUFFIXES
+               if os.path.exists(index_filename + suffix)])
 
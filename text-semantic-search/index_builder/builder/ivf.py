@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import math
+import numpy as np
+
+# An IVF (inverted file) index is a single file, whose sections start at
+# ALIGNMENT byte boundaries:
+#   header: MAGIC, then the dimensions, number of items, number of lists,
+#     default number of probed lists, and byte offsets of the other sections
+#     as little-endian uint64.
+#   centroids: float32 (num_lists, dims) unit-norm centroids of the lists.
+#   offsets: uint64 (num_lists + 1) start of each list in ids and vectors.
+#   ids: uint32 (num_items) item numbers, grouped by list.
+#   vectors: float32 (num_items, dims) unit-norm item vectors, grouped by list.
+MAGIC = b'EMBIVF01'
+HEADER_SIZE = 128
+ALIGNMENT = 64
+
+KMEANS_ITERATIONS = 100
+KMEANS_BATCH_SIZE = 10000
+ASSIGN_BATCH_SIZE = 10000
+
+
+def _normalize(vectors):
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def _aligned(offset):
+  return int(math.ceil(offset / float(ALIGNMENT))) * ALIGNMENT
+
+
+def default_num_lists(num_items):
+  """Returns about 4 * sqrt(num_items) lists, a usual IVF trade-off."""
+  return max(1, min(num_items, int(4 * math.sqrt(num_items))))
+
+
+def train_kmeans(embeddings, num_lists, num_iterations=KMEANS_ITERATIONS,
+                 batch_size=KMEANS_BATCH_SIZE, seed=0):
+  """Fits unit-norm centroids with mini-batch spherical k-means.
+
+  Every iteration assigns a random batch of items to their closest
+  centroid, and moves each centroid towards the mean of its items with a
+  learning rate of 1 / (number of items assigned to it so far).
+  """
+  random = np.random.RandomState(seed)
+  num_items = len(embeddings)
+  centroids = _normalize(
+    embeddings[np.sort(random.choice(num_items, num_lists, replace=False))])
+  counts = np.zeros(num_lists, dtype=np.float64)
+
+  for iteration in range(num_iterations):
+    batch = _normalize(embeddings[np.sort(random.choice(
+      num_items, min(batch_size, num_items), replace=False))])
+    assignments = np.argmax(batch.dot(centroids.T), axis=1)
+    order = np.argsort(assignments, kind='mergesort')
+    lists, starts, batch_counts = np.unique(
+      assignments[order], return_index=True, return_counts=True)
+    sums = np.add.reduceat(batch[order], starts, axis=0)
+    counts[lists] += batch_counts
+    rates = (batch_counts / counts[lists])[:, np.newaxis]
+    centroids[lists] += rates * (sums / batch_counts[:, np.newaxis] -
+                                 centroids[lists])
+    centroids[lists] = _normalize(centroids[lists])
+    if (iteration + 1) % 10 == 0:
+      logging.info('K-means iteration {} of {}.'.format(
+        iteration + 1, num_iterations))
+
+  empty = np.flatnonzero(counts == 0)
+  if len(empty):
+    logging.warning('{} lists were never assigned items.'.format(len(empty)))
+  return centroids
+
+
+def assign_lists(embeddings, centroids):
+  """Returns the list of the closest centroid of every item."""
+  assignments = np.empty(len(embeddings), dtype=np.uint32)
+  for start in range(0, len(embeddings), ASSIGN_BATCH_SIZE):
+    batch = _normalize(embeddings[start:start + ASSIGN_BATCH_SIZE])
+    assignments[start:start + len(batch)] = np.argmax(
+      batch.dot(centroids.T), axis=1)
+  return assignments
+
+
+def build_ivf_index(embeddings, index_filename, num_lists=None, nprobe=16):
+  """Builds an IVF index of the embeddings, and writes it to index_filename.
+
+  Args:
+    embeddings: float32 matrix whose rows are indexed by item number.
+    index_filename: output file.
+    num_lists: number of lists, or None for default_num_lists.
+    nprobe: number of lists probed by queries which do not set it.
+  """
+  num_items, dims = embeddings.shape
+  num_lists = min(num_lists or default_num_lists(num_items), num_items)
+  logging.info('Training k-means with {} lists...'.format(num_lists))
+  centroids = train_kmeans(embeddings, num_lists)
+
+  logging.info('Assigning {} items to lists...'.format(num_items))
+  assignments = assign_lists(embeddings, centroids)
+  ids = np.argsort(assignments, kind='mergesort').astype(np.uint32)
+  counts = np.bincount(assignments, minlength=num_lists)
+  offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.uint64)
+  logging.info('Largest list has {} items, median list {} items.'.format(
+    counts.max(), int(np.median(counts))))
+
+  centroids_offset = HEADER_SIZE
+  offsets_offset = _aligned(centroids_offset + centroids.nbytes)
+  ids_offset = _aligned(offsets_offset + offsets.nbytes)
+  vectors_offset = _aligned(ids_offset + ids.nbytes)
+  file_size = vectors_offset + num_items * dims * 4
+
+  output = np.memmap(index_filename, dtype=np.uint8, mode='w+',
+                     shape=(file_size,))
+  header = np.array([dims, num_items, num_lists, nprobe, centroids_offset,
+                     offsets_offset, ids_offset, vectors_offset],
+                    dtype='<u8')
+  output[:len(MAGIC)] = np.frombuffer(MAGIC, dtype=np.uint8)
+  output[len(MAGIC):len(MAGIC) + header.nbytes] = header.view(np.uint8)
+  for offset, array in [(centroids_offset, centroids),
+                        (offsets_offset, offsets.astype('<u8')),
+                        (ids_offset, ids.astype('<u4'))]:
+    output[offset:offset + array.nbytes] = array.view(np.uint8).ravel()
+
+  # Vectors are copied by blocks, so that the embeddings are not duplicated.
+  vectors = np.ndarray((num_items, dims), dtype='<f4', buffer=output,
+                       offset=vectors_offset)
+  for start in range(0, num_items, ASSIGN_BATCH_SIZE):
+    block = ids[start:start + ASSIGN_BATCH_SIZE]
+    vectors[start:start + len(block)] = _normalize(embeddings[block])
+  output.flush()
+  del vectors, output
+  logging.info('IVF index with {} lists is written to {}.'.format(
+    num_lists, index_filename))
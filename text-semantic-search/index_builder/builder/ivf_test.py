@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ivf
+
+NUM_CLUSTERS = 4
+ITEMS_PER_CLUSTER = 50
+DIMS = 16
+
+
+def clustered_embeddings(seed=0):
+  """Returns items around NUM_CLUSTERS orthogonal directions, and their
+  cluster numbers."""
+  random_state = np.random.RandomState(seed)
+  clusters = np.repeat(np.arange(NUM_CLUSTERS), ITEMS_PER_CLUSTER)
+  random_state.shuffle(clusters)
+  embeddings = 10 * np.eye(DIMS)[clusters] + random_state.normal(
+    size=(len(clusters), DIMS))
+  return embeddings.astype(np.float32), clusters
+
+
+def read_ivf_index(index_filename):
+  data = np.fromfile(index_filename, dtype=np.uint8)
+  (dims, num_items, num_lists, nprobe, centroids_offset, offsets_offset,
+   ids_offset, vectors_offset) = [int(value) for value in np.frombuffer(
+     data, dtype='<u8', count=8, offset=len(ivf.MAGIC))]
+  return {
+    'magic': data[:len(ivf.MAGIC)].tobytes(),
+    'dims': dims, 'nprobe': nprobe,
+    'centroids': np.frombuffer(data, dtype='<f4', count=num_lists * dims,
+                               offset=centroids_offset).reshape(-1, dims),
+    'offsets': np.frombuffer(data, dtype='<u8', count=num_lists + 1,
+                             offset=offsets_offset).astype(np.int64),
+    'ids': np.frombuffer(data, dtype='<u4', count=num_items,
+                         offset=ids_offset),
+    'vectors': np.frombuffer(data, dtype='<f4', count=num_items * dims,
+                             offset=vectors_offset).reshape(-1, dims)}
+
+
+class IVFTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.index_filename = os.path.join(self.temp_dir, 'embeds.index')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_default_num_lists(self):
+    self.assertEqual(ivf.default_num_lists(1), 1)
+    self.assertEqual(ivf.default_num_lists(10000), 400)
+
+  def test_kmeans_separates_clusters(self):
+    embeddings, clusters = clustered_embeddings()
+    # Like any k-means started from random items, some seeds end in a local
+    # minimum which splits a cluster, so the seed is fixed.
+    centroids = ivf.train_kmeans(embeddings, NUM_CLUSTERS, num_iterations=20,
+                                 seed=1)
+    np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1.,
+                               rtol=1e-5)
+    assignments = ivf.assign_lists(embeddings, centroids)
+    for cluster in range(NUM_CLUSTERS):
+      self.assertEqual(len(set(assignments[clusters == cluster])), 1)
+    self.assertEqual(len(set(assignments)), NUM_CLUSTERS)
+
+  def test_index_file_groups_items_by_list(self):
+    embeddings, _ = clustered_embeddings()
+    ivf.build_ivf_index(embeddings, self.index_filename, num_lists=4,
+                        nprobe=2)
+    index = read_ivf_index(self.index_filename)
+    self.assertEqual(index['magic'], ivf.MAGIC)
+    self.assertEqual((index['dims'], index['nprobe']), (DIMS, 2))
+    self.assertEqual(sorted(index['ids']), list(range(len(embeddings))))
+    self.assertEqual(index['offsets'][-1], len(embeddings))
+
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1,
+                                             keepdims=True)
+    np.testing.assert_allclose(index['vectors'], normalized[index['ids']],
+                               rtol=1e-5, atol=1e-6)
+    assignments = ivf.assign_lists(embeddings, index['centroids'])
+    for list_number in range(4):
+      start, end = index['offsets'][list_number:list_number + 2]
+      self.assertTrue(np.all(assignments[index['ids'][start:end]] ==
+                             list_number))
+
+  def test_num_lists_is_at_most_num_items(self):
+    embeddings, _ = clustered_embeddings()
+    ivf.build_ivf_index(embeddings[:3], self.index_filename, num_lists=10)
+    self.assertEqual(len(read_ivf_index(self.index_filename)['centroids']), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
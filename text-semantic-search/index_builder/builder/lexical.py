@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+import collections
+import logging
+import os
+import pickle
+import re
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+MAX_COUNT = 2 ** 16 - 1
+
+# BM25 parameters, used to order each posting list by impact.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+POSTING_DTYPE = np.dtype([('item', '<u4'), ('tf', '<u2')])
+
+
+def tokenize(text):
+  if isinstance(text, bytes):
+    text = text.decode('utf-8', 'ignore')
+  return TOKEN_PATTERN.findall(text.lower())
+
+
+def build_inverted_index(texts, index_filename):
+  """Builds an inverted index over the item texts, indexed by item number.
+
+  Writes three artefacts next to the index:
+    .lexicon: a pickled dict of term -> (offset, document frequency).
+    .postings: a .npy array of (item, tf) postings, grouped by term, and
+      sorted by decreasing BM25 impact within each term.
+    .doclens: a .npy array of the number of tokens of each item.
+  """
+  vocabulary = {}
+  term_ids, items, tfs = array('I'), array('I'), array('H')
+  doc_lengths = np.zeros(len(texts), dtype=np.uint16)
+
+  for item, text in enumerate(texts):
+    tokens = tokenize(text)
+    doc_lengths[item] = min(len(tokens), MAX_COUNT)
+    for term, tf in collections.Counter(tokens).items():
+      term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+      items.append(item)
+      tfs.append(min(tf, MAX_COUNT))
+
+  term_ids = np.frombuffer(term_ids, dtype=np.uint32)
+  items = np.frombuffer(items, dtype=np.uint32)
+  tfs = np.frombuffer(tfs, dtype=np.uint16)
+  logging.info('Indexed {} postings of {} terms.'.format(
+    len(items), len(vocabulary)))
+
+  average_length = max(doc_lengths.mean(), 1.) if len(texts) else 1.
+  norms = BM25_K1 * (
+    1 - BM25_B + BM25_B * doc_lengths[items] / average_length)
+  impacts = tfs / (tfs + norms)
+  order = np.lexsort((-impacts, term_ids))
+
+  postings = np.empty(len(items), dtype=POSTING_DTYPE)
+  postings['item'] = items[order]
+  postings['tf'] = tfs[order]
+  counts = np.bincount(term_ids, minlength=len(vocabulary))
+  offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+  lexicon = dict((term, (int(offsets[term_id]), int(counts[term_id])))
+                 for term, term_id in vocabulary.items())
+
+  with open(index_filename + '.lexicon', 'wb') as handle:
+    pickle.dump(lexicon, handle, protocol=pickle.HIGHEST_PROTOCOL)
+  with open(index_filename + '.postings', 'wb') as handle:
+    np.save(handle, postings)
+  with open(index_filename + '.doclens', 'wb') as handle:
+    np.save(handle, doc_lengths)
+  logging.info("Inverted index size: {} MB".format(
+    round(sum(os.path.getsize(index_filename + suffix)
+              for suffix in ['.lexicon', '.postings', '.doclens']) /
+          float(1024 ** 2), 2)))
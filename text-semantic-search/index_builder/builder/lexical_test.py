@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import lexical
+
+TEXTS = [u'the quick brown fox', u'the lazy dog', u'quick quick dog',
+         u'', u'Brown dogs and a brown fox']
+
+
+class LexicalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.index_filename = os.path.join(self.temp_dir, 'embeds.index')
+    lexical.build_inverted_index(TEXTS, self.index_filename)
+    with open(self.index_filename + '.lexicon', 'rb') as handle:
+      self.lexicon = pickle.load(handle)
+    self.postings = np.load(self.index_filename + '.postings')
+    self.doc_lengths = np.load(self.index_filename + '.doclens')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def term_postings(self, term):
+    offset, doc_freq = self.lexicon[term]
+    return self.postings[offset:offset + doc_freq]
+
+  def test_tokenize_lowercases_words(self):
+    self.assertEqual(lexical.tokenize(b'The Fox, the dog!'),
+                     [u'the', u'fox', u'the', u'dog'])
+
+  def test_postings_of_every_term(self):
+    self.assertEqual(sorted(self.term_postings(u'dog')['item']), [1, 2])
+    self.assertEqual(sorted(self.term_postings(u'brown')['item']), [0, 4])
+    self.assertEqual(len(self.postings),
+                     sum(doc_freq for _, doc_freq in self.lexicon.values()))
+
+  def test_term_frequencies_and_lengths(self):
+    quick = dict(zip(*[self.term_postings(u'quick')[name]
+                       for name in ['item', 'tf']]))
+    self.assertEqual(quick, {0: 1, 2: 2})
+    self.assertEqual(self.doc_lengths.tolist(), [4, 3, 3, 0, 6])
+
+  def test_postings_are_ordered_by_impact(self):
+    # The higher term frequency of item 2 outweighs its length.
+    self.assertEqual(self.term_postings(u'quick')['item'].tolist(), [2, 0])
+    # Item 1 is shorter than item 0, with the same term frequency.
+    self.assertEqual(self.term_postings(u'the')['item'].tolist(), [1, 0])
+
+
+if __name__ == '__main__':
+  unittest.main()
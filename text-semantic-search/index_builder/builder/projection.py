@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import logging
+import time
+
+PROJECTION_METHODS = ['pca', 'random']
+RANDOM_SEED = 19830610
+
+
+def fit_pca(sample, dims):
+  mean = sample.mean(axis=0)
+  _, singular_values, components = np.linalg.svd(
+    sample - mean, full_matrices=False)
+  variance = singular_values ** 2
+  logging.info('PCA with {} components explains {}% of the variance.'.format(
+    dims, round(100 * variance[:dims].sum() / variance.sum(), 2)))
+  return mean, components[:dims].T
+
+
+def fit_random_projection(input_dims, dims):
+  random_state = np.random.RandomState(RANDOM_SEED)
+  matrix = random_state.normal(size=(input_dims, dims)) / np.sqrt(dims)
+  return np.zeros(input_dims), matrix
+
+
+def fit_projection(embeddings, method, dims, sample_size):
+  """Fits a linear projection of the embeddings to dims dimensions.
+
+  Returns:
+    A (mean, matrix) tuple, so that a vector v is projected as
+    (v - mean).dot(matrix).
+  """
+  if method not in PROJECTION_METHODS:
+    raise ValueError('Unknown projection method: {}'.format(method))
+  if dims >= embeddings.shape[1]:
+    raise ValueError('Projection dims {} should be lower than {}.'.format(
+      dims, embeddings.shape[1]))
+
+  if method == 'pca':
+    sample = _sample_rows(embeddings, sample_size).astype(np.float64)
+    mean, matrix = fit_pca(sample, dims)
+  else:
+    mean, matrix = fit_random_projection(embeddings.shape[1], dims)
+  return mean.astype(np.float32), matrix.astype(np.float32)
+
+
+def project(vectors, mean, matrix):
+  return (vectors - mean).dot(matrix)
+
+
+def save_projection(filename, mean, matrix):
+  with open(filename, 'wb') as handle:
+    np.savez(handle, mean=mean, matrix=matrix)
+
+
+def _sample_rows(embeddings, sample_size):
+  if embeddings.shape[0] <= sample_size:
+    return embeddings
+  random_state = np.random.RandomState(RANDOM_SEED)
+  rows = random_state.choice(embeddings.shape[0], sample_size, replace=False)
+  return embeddings[np.sort(rows)]
+
+
+def _top_k_cosine(queries, candidates, k):
+  queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+  candidates = candidates / np.linalg.norm(candidates, axis=1, keepdims=True)
+  scores = queries.dot(candidates.T)
+  # A pool of k items or fewer has at most k - 1 neighbours per query.
+  k = min(k, candidates.shape[0] - 1)
+  if k <= 0:
+    return np.zeros((queries.shape[0], 0), dtype=np.int64)
+  return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def _timed_top_k_cosine(queries, candidates, k):
+  """Returns the top k and the milliseconds spent per query."""
+  start = time.time()
+  top_k = _top_k_cosine(queries, candidates, k)
+  elapsed = time.time() - start
+  return top_k, 1000. * elapsed / max(queries.shape[0], 1)
+
+
+def recall_report(embeddings, mean, matrix, num_queries=100,
+                  num_neighbours=10, pool_size=20000):
+  """Measures how well the projection preserves cosine nearest neighbours.
+
+  Exact neighbours of num_queries items are computed among a pool of
+  pool_size items, in the original and in the projected space.
+
+  Returns:
+    A dict with the recall@num_neighbours of the projected neighbours, the
+    bytes saved per indexed vector, and the milliseconds per query of the
+    exact search in both spaces.
+  """
+  pool = _sample_rows(embeddings, pool_size)
+  queries = pool[:num_queries]
+  projected_pool = project(pool, mean, matrix)
+  exact, original_ms = _timed_top_k_cosine(
+    queries, pool, num_neighbours + 1)
+  approximate, projected_ms = _timed_top_k_cosine(
+    projected_pool[:num_queries], projected_pool, num_neighbours + 1)
+
+  hits, total = 0, 0
+  for i, (exact_row, approximate_row) in enumerate(zip(exact, approximate)):
+    exact_set = set(exact_row) - {i}
+    hits += len(exact_set & (set(approximate_row) - {i}))
+    total += len(exact_set)
+  report = {
+    'recall_at_{}'.format(num_neighbours): (
+      round(hits / float(total), 4) if total else None),
+    'input_dims': embeddings.shape[1],
+    'projected_dims': matrix.shape[1],
+    'bytes_saved_per_vector': 4 * (embeddings.shape[1] - matrix.shape[1]),
+    'original_search_ms_per_query': round(original_ms, 3),
+    'projected_search_ms_per_query': round(projected_ms, 3)
+  }
+  return report
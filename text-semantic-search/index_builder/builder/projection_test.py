@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import numpy as np
+import projection
+
+
+def random_embeddings(num_items, dims=32, seed=0):
+  random_state = np.random.RandomState(seed)
+  return random_state.normal(size=(num_items, dims)).astype(np.float32)
+
+
+class ProjectionTest(unittest.TestCase):
+
+  def test_pca_keeps_the_variance_of_a_low_rank_sample(self):
+    random_state = np.random.RandomState(0)
+    embeddings = random_state.normal(size=(500, 4)).dot(
+      random_state.normal(size=(4, 32))).astype(np.float32)
+    mean, matrix = projection.fit_projection(embeddings, 'pca', 4, 1000)
+    projected = projection.project(embeddings, mean, matrix)
+    reconstructed = projected.dot(matrix.T) + mean
+    np.testing.assert_allclose(reconstructed, embeddings, atol=1e-3)
+
+  def test_random_projection_is_deterministic(self):
+    embeddings = random_embeddings(10)
+    first = projection.fit_projection(embeddings, 'random', 8, 100)
+    second = projection.fit_projection(embeddings, 'random', 8, 100)
+    np.testing.assert_array_equal(first[1], second[1])
+    self.assertEqual(first[1].shape, (32, 8))
+
+  def test_fit_projection_rejects_dims_not_lower_than_input(self):
+    with self.assertRaises(ValueError):
+      projection.fit_projection(random_embeddings(10), 'pca', 32, 100)
+
+  def test_top_k_cosine_clamps_k_to_pool(self):
+    pool = random_embeddings(3)
+    top_k = projection._top_k_cosine(pool, pool, 10)
+    self.assertEqual(top_k.shape, (3, 2))
+    self.assertEqual(projection._top_k_cosine(pool[:1], pool[:1], 10).shape,
+                     (1, 0))
+
+  def test_recall_report_of_identity_is_perfect(self):
+    embeddings = random_embeddings(200)
+    report = projection.recall_report(
+      embeddings, np.zeros(32, dtype=np.float32),
+      np.eye(32, dtype=np.float32), num_queries=20, num_neighbours=5)
+    self.assertEqual(report['recall_at_5'], 1.)
+    self.assertIn('original_search_ms_per_query', report)
+    self.assertIn('projected_search_ms_per_query', report)
+
+  def test_recall_report_of_tiny_pool(self):
+    embeddings = random_embeddings(1)
+    mean, matrix = projection.fit_projection(embeddings, 'random', 8, 100)
+    report = projection.recall_report(embeddings, mean, matrix)
+    self.assertIsNone(report['recall_at_10'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local staging area, which lets a restarted index builder job resume.
+
+Every step writes its files to the staging directory, then a done marker
+listing them, so a step whose marker exists is finished. Markers carry a
+fingerprint of the step inputs, such as the size and the modification time
+of an embedding file, and a step whose fingerprint changed is redone.
+
+When a remote directory is given, finished steps are also copied there, so
+that a job restarted on another machine restores them instead of redoing
+them. Steps may also produce output files outside the staging directory,
+such as the built index, which are restored to their paths with their
+modification times.
+"""
+
+import json
+import logging
+import os
+import pickle
+import numpy as np
+import tensorflow as tf
+
+MARKER_SUFFIX = '.done'
+OUTPUTS_DIR = 'outputs'
+
+
+def file_fingerprint(filename):
+  """Returns what identifies a version of a GCS or local file."""
+  stat = tf.gfile.Stat(filename)
+  return [filename, stat.length, stat.mtime_nsec]
+
+
+class StagingArea(object):
+
+  def __init__(self, local_dir, remote_dir=None):
+    self.local_dir = local_dir
+    self.remote_dir = remote_dir
+    if not os.path.exists(local_dir):
+      os.makedirs(local_dir)
+
+  def path(self, name):
+    return os.path.join(self.local_dir, name)
+
+  def _remote_path(self, name):
+    return os.path.join(self.remote_dir, name)
+
+  def _remote_output_path(self, name, output):
+    return self._remote_path(
+      os.path.join(OUTPUTS_DIR, name, os.path.basename(output)))
+
+  def _read_marker(self, name):
+    marker_file = self.path(name + MARKER_SUFFIX)
+    if os.path.exists(marker_file):
+      with open(marker_file) as handle:
+        return json.load(handle)
+    if self.remote_dir and tf.gfile.Exists(
+        self._remote_path(name + MARKER_SUFFIX)):
+      with tf.gfile.GFile(self._remote_path(name + MARKER_SUFFIX)) as handle:
+        marker = json.load(handle)
+      for filename in marker['files']:
+        tf.gfile.Copy(self._remote_path(filename), self.path(filename),
+                      overwrite=True)
+      for output, mtime in marker.get('outputs', []):
+        tf.gfile.Copy(self._remote_output_path(name, output), output,
+                      overwrite=True)
+        # Outputs keep their version, e.g. for the upload manifest.
+        os.utime(output, (mtime, mtime))
+      self._write_local(name + MARKER_SUFFIX, json.dumps(marker))
+      logging.info('Step {} is restored from {}.'.format(
+        name, self.remote_dir))
+      return marker
+    return None
+
+  def _write_local(self, filename, content):
+    temp_file = self.path(filename + '.tmp')
+    with open(temp_file, 'w') as handle:
+      handle.write(content)
+    os.rename(temp_file, self.path(filename))
+
+  def is_done(self, name, fingerprint=None):
+    """Returns whether a step is finished with the same fingerprint."""
+    marker = self._read_marker(name)
+    if marker is None:
+      return False
+    # The fingerprint is compared as it is stored, with lists for tuples.
+    if marker.get('fingerprint') != json.loads(json.dumps(fingerprint)):
+      logging.info('Step {} is staged for other inputs, and is redone.'.format(
+        name))
+      self.clear(name)
+      return False
+    return (all(os.path.exists(self.path(filename))
+                for filename in marker['files']) and
+            all(os.path.exists(output)
+                for output, _ in marker.get('outputs', [])))
+
+  def mark_done(self, name, files, fingerprint=None, mirror=True,
+                outputs=()):
+    """Marks a step finished, once all its files are written.
+
+    Args:
+      name: the name of the step.
+      files: the names of its files in the staging directory.
+      fingerprint: what identifies the inputs of the step.
+      mirror: whether the files are copied to the remote directory.
+      outputs: the paths of its files outside the staging directory, which
+        are always copied to the remote directory.
+    """
+    outputs = [[output, os.path.getmtime(output)] for output in outputs]
+    marker = json.dumps({'files': list(files), 'fingerprint': fingerprint,
+                         'outputs': outputs})
+    self._write_local(name + MARKER_SUFFIX, marker)
+    if self.remote_dir and (mirror or outputs):
+      for filename in files if mirror else []:
+        tf.gfile.Copy(self.path(filename), self._remote_path(filename),
+                      overwrite=True)
+      for output, _ in outputs:
+        tf.gfile.Copy(output, self._remote_output_path(name, output),
+                      overwrite=True)
+      # The marker is copied last, so a remote step is only seen complete.
+      with tf.gfile.GFile(self._remote_path(name + MARKER_SUFFIX),
+                          'w') as handle:
+        handle.write(marker)
+
+  def clear(self, name):
+    marker_file = self.path(name + MARKER_SUFFIX)
+    if os.path.exists(marker_file):
+      os.remove(marker_file)
+    if self.remote_dir and tf.gfile.Exists(
+        self._remote_path(name + MARKER_SUFFIX)):
+      tf.gfile.Remove(self._remote_path(name + MARKER_SUFFIX))
+
+  def save_array(self, filename, array):
+    temp_file = self.path(filename + '.tmp')
+    with open(temp_file, 'wb') as handle:
+      np.save(handle, array)
+    os.rename(temp_file, self.path(filename))
+
+  def load_array(self, filename):
+    """Returns a staged array, memory-mapped from the staging area."""
+    return np.load(self.path(filename), mmap_mode='r')
+
+  def concatenate_arrays(self, filename, arrays, dims):
+    """Writes the rows of the arrays to a staged array, one at a time."""
+    temp_file = self.path(filename + '.tmp')
+    num_rows = sum(len(array) for array in arrays)
+    matrix = np.lib.format.open_memmap(
+      temp_file, mode='w+', dtype=np.float32, shape=(num_rows, dims))
+    row = 0
+    for array in arrays:
+      matrix[row:row + len(array)] = array
+      row += len(array)
+    matrix.flush()
+    del matrix
+    os.rename(temp_file, self.path(filename))
+
+  def save_object(self, filename, value):
+    temp_file = self.path(filename + '.tmp')
+    with open(temp_file, 'wb') as handle:
+      pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_file, self.path(filename))
+
+  def load_object(self, filename):
+    with open(self.path(filename), 'rb') as handle:
+      return pickle.load(handle)
+
+  def load_json(self, filename, default=None):
+    if os.path.exists(self.path(filename)):
+      with open(self.path(filename)) as handle:
+        return json.load(handle)
+    if self.remote_dir and tf.gfile.Exists(self._remote_path(filename)):
+      with tf.gfile.GFile(self._remote_path(filename)) as handle:
+        return json.load(handle)
+    return default
+
+  def save_json(self, filename, value):
+    """Saves a JSON file, which is also copied to the remote directory."""
+    self._write_local(filename, json.dumps(value))
+    if self.remote_dir:
+      with tf.gfile.GFile(self._remote_path(filename), 'w') as handle:
+        handle.write(json.dumps(value))
@@ -16,37 +16,110 @@
 
 import logging
 import argparse
+import os
 from datetime import datetime
 import index
+import projection
+import staging
 from httplib2 import Http
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from oauth2client.client import GoogleCredentials
 
 
 LOCAL_INDEX_FILE = 'embeds.index'
 CHUNKSIZE = 64 * 1024 * 1024
+LOCAL_STAGING_DIR = 'staging'
+UPLOAD_MANIFEST = 'upload_manifest.json'
+# Artefacts which are only produced by some index builder configurations.
+OPTIONAL_ARTEFACTS = ['.projection', '.attributes',
+                      '.lexicon', '.postings', '.doclens', '.ids']
 
 
-def _upload_to_gcs(gcs_services, local_file_name, bucket_name, gcs_location):
+def _get_upload_offset(http, resumable_uri, size):
+  """Asks GCS for the number of bytes a resumable upload session received.
 
-  logging.info('Uploading file {} to {}...'.format(
-    local_file_name, "gs://{}/{}".format(bucket_name, gcs_location)))
+  Returns:
+    The offset to continue the upload from, or None if the session expired.
+  """
+  response, _ = http.request(
+    resumable_uri, method='PUT', body='',
+    headers={'Content-Range': 'bytes */{}'.format(size),
+             'Content-Length': '0'})
+  if response.status in (200, 201):
+    return size
+  if response.status == 308:
+    # The Range header is absent when no byte was received yet.
+    received = response.get('range')
+    return int(received.rsplit('-', 1)[1]) + 1 if received else 0
+  if response.status in (404, 410):
+    return None
+  raise HttpError(response, b'', uri=resumable_uri)
+
+
+def _upload_to_gcs(http, gcs_services, local_file_name, bucket_name,
+                   gcs_location, staging_area=None):
+  """Uploads a file in resumable chunks.
+
+  When a staging area is given, the upload session of the file is recorded
+  in its upload manifest, so that an upload interrupted by a restart of the
+  job continues from the last byte GCS received, and a finished upload of
+  the same file is skipped.
+  """
+  gcs_path = "gs://{}/{}".format(bucket_name, gcs_location)
+  stat = os.stat(local_file_name)
+  # Staging restores files with their mtime to the second only.
+  version = [stat.st_size, int(stat.st_mtime)]
+  manifest = (staging_area.load_json(UPLOAD_MANIFEST, {})
+              if staging_area is not None else {})
+  entry = manifest.get(gcs_path)
+  if entry is None or entry['version'] != version:
+    entry = {'version': version, 'resumable_uri': None, 'done': False}
+
+  def _save_entry():
+    if staging_area is not None:
+      manifest[gcs_path] = entry
+      staging_area.save_json(UPLOAD_MANIFEST, manifest)
 
   media = MediaFileUpload(local_file_name,
                           mimetype='application/octet-stream',
                           chunksize=CHUNKSIZE, resumable=True)
   request = gcs_services.objects().insert(
     bucket=bucket_name, name=gcs_location, media_body=media)
+  if entry['resumable_uri'] and not entry['done']:
+    offset = _get_upload_offset(http, entry['resumable_uri'], stat.st_size)
+    if offset is None:
+      logging.info('Upload session of file {} expired, restarting.'.format(
+        local_file_name))
+      entry['resumable_uri'] = None
+    elif offset == stat.st_size:
+      entry['done'] = True
+      _save_entry()
+    else:
+      logging.info('Resuming the upload of file {} from byte {}.'.format(
+        local_file_name, offset))
+      request.resumable_uri = entry['resumable_uri']
+      request.resumable_progress = offset
+  if entry['done']:
+    logging.info('File {} is already uploaded to {}.'.format(
+      local_file_name, gcs_path))
+    return
+
+  logging.info('Uploading file {} to {}...'.format(local_file_name, gcs_path))
   response = None
   while response is None:
     progress, response = request.next_chunk()
+    if request.resumable_uri != entry['resumable_uri']:
+      entry['resumable_uri'] = request.resumable_uri
+      _save_entry()
 
-  logging.info('File {} uploaded to {}.'.format(
-    local_file_name, "gs://{}/{}".format(bucket_name, gcs_location)))
+  entry['done'] = True
+  _save_entry()
+  logging.info('File {} uploaded to {}.'.format(local_file_name, gcs_path))
 
 
-def upload_artefacts(gcs_index_file):
+def upload_artefacts(gcs_index_file, staging_area=None):
 
   http = Http()
   credentials = GoogleCredentials.get_application_default()
@@ -56,9 +129,14 @@ def upload_artefacts(gcs_index_file):
   split_list = gcs_index_file[5:].split('/', 1)
   bucket_name = split_list[0]
   blob_path = split_list[1] if len(split_list) == 2 else None
-  _upload_to_gcs(gcs_services, LOCAL_INDEX_FILE, bucket_name, blob_path)
-  _upload_to_gcs(gcs_services,
-                 LOCAL_INDEX_FILE+'.mapping', bucket_name, blob_path+'.mapping')
+  _upload_to_gcs(http, gcs_services, LOCAL_INDEX_FILE, bucket_name,
+                 blob_path, staging_area)
+  _upload_to_gcs(http, gcs_services, LOCAL_INDEX_FILE+'.mapping',
+                 bucket_name, blob_path+'.mapping', staging_area)
+  for suffix in OPTIONAL_ARTEFACTS:
+    if os.path.exists(LOCAL_INDEX_FILE+suffix):
+      _upload_to_gcs(http, gcs_services, LOCAL_INDEX_FILE+suffix,
+                     bucket_name, blob_path+suffix, staging_area)
 
 
 def get_args():
@@ -77,6 +155,13 @@ def get_args():
     required=True
   )
 
+  args_parser.add_argument(
+    '--index-type',
+    help='Annoy trees, or an inverted file (IVF) index of k-means lists',
+    choices=index.INDEX_TYPES,
+    default='annoy'
+  )
+
   args_parser.add_argument(
     '--num-trees',
     help='Number of trees to build in the index',
@@ -84,6 +169,59 @@ def get_args():
     type=int
   )
 
+  args_parser.add_argument(
+    '--num-lists',
+    help='Number of lists of the IVF index, by default 4 * sqrt(items)',
+    default=None,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--nprobe',
+    help='Number of lists of the IVF index scanned by default per query',
+    default=16,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--projection',
+    help='Reduce the embeddings dimensionality before indexing',
+    choices=projection.PROJECTION_METHODS,
+    default=None
+  )
+
+  args_parser.add_argument(
+    '--projection-dims',
+    help='Number of dimensions of the projected embeddings',
+    default=128,
+    type=int
+  )
+
+  args_parser.add_argument(
+    '--attributes',
+    help='Comma separated item attributes to store for filtered search',
+    default='language'
+  )
+
+  args_parser.add_argument(
+    '--no-lexical-index',
+    help='Do not build the inverted index used by hybrid search',
+    dest='lexical_index',
+    action='store_false'
+  )
+
+  args_parser.add_argument(
+    '--dedup-ids',
+    help='GCS or local path to the ids kept by builder.dedup to index',
+    default=None
+  )
+
+  args_parser.add_argument(
+    '--staging-dir',
+    help='Local directory where a restarted job resumes from, empty to disable',
+    default=LOCAL_STAGING_DIR
+  )
+
   args_parser.add_argument(
     '--job-dir',
     help='GCS or local paths to job package'
@@ -98,7 +236,19 @@ def main():
 
   time_start = datetime.utcnow()
   logging.info('Index building started...')
-  index.build_index(args.embedding_files, LOCAL_INDEX_FILE, args.num_trees)
+  attribute_names = [name for name in args.attributes.split(',') if name]
+  # Staged shards and index artefacts are also kept in the job directory, so
+  # that a job restarted on another machine does not build them again.
+  remote_staging_dir = (os.path.join(args.job_dir, 'staging')
+                        if args.staging_dir and args.job_dir else None)
+  index.build_index(args.embedding_files, LOCAL_INDEX_FILE, args.num_trees,
+                    args.projection, args.projection_dims,
+                    attribute_names=attribute_names,
+                    build_lexical_index=args.lexical_index,
+                    index_type=args.index_type, num_lists=args.num_lists,
+                    nprobe=args.nprobe, dedup_ids_file=args.dedup_ids,
+                    staging_dir=args.staging_dir,
+                    remote_staging_dir=remote_staging_dir)
   time_end = datetime.utcnow()
   logging.info('Index building  finished.')
   time_elapsed = time_end - time_start
@@ -106,7 +256,11 @@ def main():
 
   time_start = datetime.utcnow()
   logging.info('Uploading index artefacts started...')
-  upload_artefacts(args.index_file)
+  # The upload manifest is mirrored too, so that a job restarted on another
+  # machine continues the uploads of the restored artefacts.
+  upload_artefacts(args.index_file,
+                   staging.StagingArea(args.staging_dir, remote_staging_dir)
+                   if args.staging_dir else None)
   time_end = datetime.utcnow()
   logging.info('Uploading index artefacts finished.')
   time_elapsed = time_end - time_start
@@ -19,6 +19,13 @@ PROJECT=""
 
 [[ -z "${PROJECT}" ]] && echo "PROJECT not set" && exit 1
 
+# Export the sentence encoder, which is deployed with the app, so that the
+# app does not download it from tf.Hub when it starts.
+if [[ ! -d encoder ]]; then
+  echo "Exporting the sentence encoder..."
+  python export_encoder.py || exit 1
+fi
+
 echo "App Engine deployment started..."
 
 # Command to deploy an app to AppEngine
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import logging
+import os
+import shutil
+from utils import embedding
+
+
+def get_args():
+
+  args_parser = argparse.ArgumentParser()
+
+  args_parser.add_argument(
+    '--export-dir',
+    help='Local directory of the exported encoder, deployed with the app',
+    default=embedding.ENCODER_DIR
+  )
+
+  args_parser.add_argument(
+    '--module-url',
+    help='URL of the tf.Hub sentence encoder module',
+    default=embedding.MODULE_URL
+  )
+
+  return args_parser.parse_args()
+
+
+def main():
+
+  args = get_args()
+  if os.path.exists(args.export_dir):
+    logging.info('Removing {}...'.format(args.export_dir))
+    shutil.rmtree(args.export_dir)
+  embedding.export_encoder(args.export_dir, args.module_url)
+
+
+if __name__ == '__main__':
+  logging.getLogger().setLevel(logging.INFO)
+  main()
@@ -14,58 +14,225 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import os
+import threading
 from flask import Flask
 from flask import request
 from flask import jsonify
+from utils import metrics
 from utils import search as srch
 
-search_util = srch.SearchUtil()
+search_util = None
+
+
+def init_search_util():
+  """Loads the index in the background, so that the worker boots within
+  the gunicorn timeout, which bounds requests rather than the index load."""
+  global search_util
+  try:
+    search_util = srch.SearchUtil()
+  except Exception:
+    logging.exception('Search utility failed to initialise.')
+    # The worker exits, so that gunicorn starts another one.
+    os._exit(1)
+
+init_thread = threading.Thread(target=init_search_util)
+init_thread.daemon = True
+init_thread.start()
 
 app = Flask(__name__)
+# Paths which are answered before the search utility is initialised.
+ALWAYS_READY_PATHS = ['/', '/readiness_check', '/metrics']
+
+
+@app.before_request
+def check_initialised():
+  if search_util is None and request.path not in ALWAYS_READY_PATHS:
+    return 'App is not ready yet!', 503
 
 
 @app.route('/')
 def display_default():
   return 'Welcome to the semantic search app!\n' \
-         'use /search?query=<your_query> to start searching to articles'
+         'use /search?query=<your_query> to start searching to articles\n' \
+         'add &filter=<attribute>:<value1>,<value2> to filter the results\n' \
+         'add &mode=hybrid to combine lexical and semantic matching\n' \
+         'add &nprobe=<lists> to scan more lists of an IVF index\n' \
+         'add &deadline_ms=<ms> to bound the search latency\n' \
+         'use /search?cursor=<X-Next-Cursor header> to get the next page\n' \
+         'use /similar?id=<article_id> to find articles similar to an article'
 
 
 @app.route('/readiness_check')
 def check_readiness():
+  if search_util is None:
+    return 'App is not ready yet!', 503
   return 'App is ready!'
 
 
+@app.route('/metrics')
+def get_metrics():
+  return jsonify(metrics.REGISTRY.snapshot())
+
+
 @app.route('/search', methods=['GET'])
 def search():
   try:
     query = request.args.get('query')
     show = request.args.get('show')
     show = '10' if show is None else show
+    filters = parse_filters(request.args.getlist('filter'))
+    mode = request.args.get('mode', 'semantic')
+    nprobe = request.args.get('nprobe')
+    deadline_ms = request.headers.get(
+      'X-Search-Deadline-Ms', request.args.get('deadline_ms'))
+    cursor = request.args.get('cursor')
+    degraded, next_cursor = [], None
+
+    is_valid, error = validate_request(
+      query, show, filters, mode, nprobe, deadline_ms, cursor)
+
+    if not is_valid:
+      results = error
+    else:
+      nprobe = None if nprobe is None else int(nprobe)
+      deadline_secs = (srch.DEFAULT_DEADLINE_SECS if deadline_ms is None
+                       else int(deadline_ms) / 1000.)
+      results, degraded, next_cursor = search_util.search(
+        query, int(show), filters, mode, nprobe, deadline_secs, cursor)
+
+  except Exception as error:
+    results = 'Unexpected error: {}'.format(error)
+
+  response = jsonify(results)
+  if degraded:
+    response.headers['X-Search-Degraded'] = ','.join(degraded)
+  if next_cursor:
+    response.headers['X-Next-Cursor'] = next_cursor
+  return response
+
+
+@app.route('/similar', methods=['GET', 'POST'])
+def similar():
+  degraded = []
+  try:
+    if request.method == 'POST':
+      body = request.get_json(force=True)
+      identifiers = body.get('ids')
+      show = str(body.get('show', 10))
+      filters = parse_body_filters(body.get('filters', {}))
+    else:
+      identifiers = request.args.getlist('id')
+      show = request.args.get('show', '10')
+      filters = parse_filters(request.args.getlist('filter'))
 
-    is_valid, error = validate_request(query, show)
+    is_valid, error = validate_similar_request(
+      identifiers, show, filters, request.method == 'POST')
 
     if not is_valid:
       results = error
     else:
-      results = search_util.search(query, int(show))
+      results, degraded = search_util.similar(
+        identifiers, int(show), filters)
+      if request.method == 'POST':
+        results = [{'id': identifier, 'results': result}
+                   for identifier, result in zip(identifiers, results)]
+      elif results[0] is None:
+        results = 'Unknown article id!'
+      else:
+        results = results[0]
 
   except Exception as error:
     results = 'Unexpected error: {}'.format(error)
 
   response = jsonify(results)
+  if degraded:
+    response.headers['X-Search-Degraded'] = ','.join(degraded)
   return response
 
 
-def validate_request(query, show):
+def parse_filters(filter_args):
+  """Parses filter=<attribute>:<value1>,<value2> arguments into a dict.
+
+  Returns None if any of the arguments is malformed.
+  """
+  filters = {}
+  for filter_arg in filter_args:
+    name, _, values = filter_arg.partition(':')
+    values = [value for value in values.split(',') if value]
+    if not name or not values:
+      return None
+    filters.setdefault(name, []).extend(values)
+  return filters
+
+
+def parse_body_filters(body_filters):
+  """Checks {<attribute>: [<value1>, <value2>]} filters of a JSON body.
+
+  Returns None if the filters are not a dict of non-empty lists of strings.
+  """
+  if not isinstance(body_filters, dict):
+    return None
+  for name, values in body_filters.items():
+    if not name or not isinstance(values, list) or not values or not all(
+        isinstance(value, basestring) and value for value in values):
+      return None
+  return body_filters
+
+
+def validate_request(query, show, filters, mode, nprobe=None,
+                     deadline_ms=None, cursor=None):
   is_valid = True
   error = ''
 
-  if query is None or len(query) < 3:
+  if cursor is None and (query is None or len(query) < 3):
     is_valid = False
     error = 'Your search query is too short!'
-  elif show is None or not show.isdigit():
+  elif show is None or not show.isdigit() or \
+      not 0 < int(show) <= srch.MAX_SHOW:
+    is_valid = False
+    error = 'Invalid show results value, it should be at most {}!'.format(
+      srch.MAX_SHOW)
+  elif filters is None:
+    is_valid = False
+    error = 'Invalid filter value, use filter=<attribute>:<values>!'
+  elif mode not in srch.SEARCH_MODES:
+    is_valid = False
+    error = 'Invalid search mode!'
+  elif nprobe is not None and (not nprobe.isdigit() or int(nprobe) == 0):
+    is_valid = False
+    error = 'Invalid nprobe value!'
+  elif deadline_ms is not None and (
+      not deadline_ms.isdigit() or int(deadline_ms) == 0 or
+      int(deadline_ms) > srch.MAX_DEADLINE_SECS * 1000):
+    is_valid = False
+    error = 'Invalid deadline value!'
+
+  return is_valid, error
+
+
+def validate_similar_request(identifiers, show, filters, batched=True):
+  is_valid = True
+  error = ''
+
+  if not identifiers or not isinstance(identifiers, list):
+    is_valid = False
+    error = 'Article ids should not be empty!'
+  elif not batched and len(identifiers) > 1:
+    is_valid = False
+    error = 'Use a POST request to find articles similar to several ids!'
+  elif len(identifiers) > srch.MAX_SIMILAR_IDS:
+    is_valid = False
+    error = 'At most {} article ids are accepted!'.format(
+      srch.MAX_SIMILAR_IDS)
+  elif not show.isdigit() or not 0 < int(show) <= srch.MAX_SHOW:
+    is_valid = False
+    error = 'Invalid show results value, it should be at most {}!'.format(
+      srch.MAX_SHOW)
+  elif filters is None:
     is_valid = False
-    error = 'Invalid show results value!'
+    error = 'Invalid filter value, use filter=<attribute>:<values>!'
 
   return is_valid, error
 
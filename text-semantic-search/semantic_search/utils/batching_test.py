@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+import batching
+
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_least_recently_used_entry_is_evicted(self):
+    cache = batching.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    cache.put('c', 3)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('c'), 3)
+    self.assertEqual(len(cache), 2)
+
+  def test_put_replaces_a_value(self):
+    cache = batching.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('a', 2)
+    self.assertEqual(cache.get('a'), 2)
+    self.assertEqual(len(cache), 1)
+
+
+class CandidateCacheTest(unittest.TestCase):
+
+  def test_lists_are_stored_under_distinct_ids(self):
+    cache = batching.CandidateCache(ttl_secs=60, max_candidates=100)
+    first = cache.put(['a', 'b'])
+    second = cache.put(['c'])
+    self.assertNotEqual(first, second)
+    self.assertEqual(cache.get(first), ['a', 'b'])
+    self.assertEqual(cache.get(second), ['c'])
+    self.assertIsNone(cache.get('unknown'))
+
+  def test_lists_expire(self):
+    cache = batching.CandidateCache(ttl_secs=0.01, max_candidates=100)
+    list_id = cache.put(['a'])
+    time.sleep(0.02)
+    self.assertIsNone(cache.get(list_id))
+    self.assertEqual(len(cache), 0)
+
+  def test_least_recently_used_lists_are_evicted(self):
+    cache = batching.CandidateCache(ttl_secs=60, max_candidates=4)
+    first = cache.put(['a', 'b'])
+    second = cache.put(['c', 'd'])
+    cache.get(first)
+    third = cache.put(['e'])
+    self.assertIsNone(cache.get(second))
+    self.assertEqual(cache.get(first), ['a', 'b'])
+    self.assertEqual(cache.get(third), ['e'])
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+  def test_concurrent_values_are_batched(self):
+    batch_sizes = []
+
+    def double(values):
+      batch_sizes.append(len(values))
+      return [2 * value for value in values]
+
+    batcher = batching.MicroBatcher(double, max_batch_size=4,
+                                    max_wait_secs=0.2)
+    results = {}
+
+    def submit(value):
+      results[value] = batcher.submit(value)
+
+    threads = [threading.Thread(target=submit, args=(value,))
+               for value in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, dict((value, 2 * value) for value in range(8)))
+    self.assertTrue(all(size <= 4 for size in batch_sizes))
+    self.assertLess(len(batch_sizes), 8)
+
+  def test_errors_are_raised_to_every_submitter(self):
+
+    def fail(values):
+      raise ValueError('failed')
+
+    batcher = batching.MicroBatcher(fail)
+    with self.assertRaises(ValueError):
+      batcher.submit(1)
+
+  def test_submit_times_out(self):
+
+    def slow(values):
+      time.sleep(0.5)
+      return values
+
+    batcher = batching.MicroBatcher(slow)
+    with self.assertRaises(batching.BatchTimeout):
+      batcher.submit(1, timeout=0.01)
+
+
+if __name__ == '__main__':
+  unittest.main()
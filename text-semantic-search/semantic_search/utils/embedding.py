@@ -17,21 +17,80 @@
 import tensorflow as tf
 import tensorflow_hub as hub
 import logging
+import os
+import time
 
 MODULE_URL = 'https://tfhub.dev/google/universal-sentence-encoder/2'
 
+# Configurable parameters
+# The encoder exported by export_encoder.py, next to main.py.
+ENCODER_DIR = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'encoder')
+INTRA_OP_THREADS = 4
+INTER_OP_THREADS = 2
+# Sizes of the batches run before serving, up to the micro-batch size.
+WARMUP_BATCH_SIZES = [1, 8, 32]
+WARMUP_SENTENCE = 'warm up the sentence encoder'
+
+SIGNATURE_KEY = 'serving_default'
+INPUT_KEY = 'sentences'
+OUTPUT_KEY = 'embeddings'
+
+
+def export_encoder(export_dir, module_url=MODULE_URL):
+  """Exports the tf.Hub module as a SavedModel with its vocabulary assets.
+
+  Lookup tables of the module are initialised by the main op of the
+  SavedModel, so that loading it needs neither tf.Hub nor the network.
+  """
+  with tf.Graph().as_default():
+    embed_module = hub.Module(module_url)
+    placeholder = tf.placeholder(dtype=tf.string, shape=[None])
+    embed = embed_module(placeholder)
+    with tf.Session() as session:
+      session.run([tf.global_variables_initializer(),
+                   tf.tables_initializer()])
+      builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+      signature = tf.saved_model.signature_def_utils.predict_signature_def(
+        inputs={INPUT_KEY: placeholder}, outputs={OUTPUT_KEY: embed})
+      builder.add_meta_graph_and_variables(
+        session, [tf.saved_model.tag_constants.SERVING],
+        signature_def_map={SIGNATURE_KEY: signature},
+        assets_collection=tf.get_collection(tf.GraphKeys.ASSET_FILEPATHS),
+        main_op=tf.tables_initializer())
+      builder.save()
+  logging.info('Encoder is exported to {}.'.format(export_dir))
+
 
 class EmbedUtil:
 
-  def __init__(self):
+  def __init__(self, encoder_dir=ENCODER_DIR):
 
     logging.info('Initialising embedding utility...')
-    embed_module = hub.Module(MODULE_URL)
-    placeholder = tf.placeholder(dtype=tf.string)
-    embed = embed_module(placeholder)
-    session = tf.Session()
-    session.run([tf.global_variables_initializer(), tf.tables_initializer()])
-    logging.info('tf.Hub module is loaded.')
+    config = tf.ConfigProto(
+      intra_op_parallelism_threads=INTRA_OP_THREADS,
+      inter_op_parallelism_threads=INTER_OP_THREADS)
+    graph = tf.Graph()
+    session = tf.Session(graph=graph, config=config)
+    with graph.as_default():
+      if tf.saved_model.loader.maybe_saved_model_directory(encoder_dir):
+        meta_graph = tf.saved_model.loader.load(
+          session, [tf.saved_model.tag_constants.SERVING], encoder_dir)
+        signature = meta_graph.signature_def[SIGNATURE_KEY]
+        placeholder = graph.get_tensor_by_name(
+          signature.inputs[INPUT_KEY].name)
+        embed = graph.get_tensor_by_name(signature.outputs[OUTPUT_KEY].name)
+        logging.info('Exported encoder {} is loaded.'.format(encoder_dir))
+      else:
+        logging.warning('Encoder {} is not found, loading {}.'.format(
+          encoder_dir, MODULE_URL))
+        embed_module = hub.Module(MODULE_URL)
+        placeholder = tf.placeholder(dtype=tf.string)
+        embed = embed_module(placeholder)
+        session.run([tf.global_variables_initializer(),
+                     tf.tables_initializer()])
+        logging.info('tf.Hub module is loaded.')
+      graph.finalize()
 
     def _embeddings_fn(sentences):
       computed_embeddings = session.run(
@@ -39,11 +98,20 @@ class EmbedUtil:
       return computed_embeddings
 
     self.embedding_fn = _embeddings_fn
+    self._warm_up()
     logging.info('Embedding utility initialised.')
 
+  def _warm_up(self):
+    """Runs batches of several sizes, so that queries do not pay for the
+    graph optimisation and memory allocation of their batch size."""
+    for batch_size in WARMUP_BATCH_SIZES:
+      start_time = time.time()
+      self.embedding_fn([WARMUP_SENTENCE] * batch_size)
+      logging.info('Warm-up batch of {} sentences took {:.3f} secs.'.format(
+        batch_size, time.time() - start_time))
+
   def extract_embeddings(self, query):
     return self.embedding_fn([query])[0]
 
-
-
-
+  def extract_embeddings_batch(self, queries):
+    return self.embedding_fn(queries)
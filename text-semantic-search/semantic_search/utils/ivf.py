@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import numpy as np
+
+# The file layout is described in index_builder/builder/ivf.py.
+MAGIC = b'EMBIVF01'
+HEADER_FIELDS = 8
+
+
+def is_ivf_index(index_file):
+  with open(index_file, 'rb') as handle:
+    return handle.read(len(MAGIC)) == MAGIC
+
+
+class IVFIndex(object):
+  """An inverted file index, memory-mapped from a file.
+
+  Queries score the centroids of the lists, then the vectors of the nprobe
+  closest lists, which are contiguous blocks of the file.
+  """
+
+  def __init__(self, index_file):
+    self._buffer = np.memmap(index_file, dtype=np.uint8, mode='r')
+    (self.dims, self.num_items, self.num_lists, self.default_nprobe,
+     centroids_offset, offsets_offset, ids_offset, self.vectors_offset) = [
+       int(value) for value in np.frombuffer(
+         self._buffer, dtype='<u8', count=HEADER_FIELDS, offset=len(MAGIC))]
+    self.centroids = np.frombuffer(
+      self._buffer, dtype='<f4', count=self.num_lists * self.dims,
+      offset=centroids_offset).reshape(self.num_lists, self.dims)
+    self.offsets = np.frombuffer(
+      self._buffer, dtype='<u8', count=self.num_lists + 1,
+      offset=offsets_offset).astype(np.int64)
+    self.ids = np.frombuffer(
+      self._buffer, dtype='<u4', count=self.num_items, offset=ids_offset)
+    self.vectors = np.frombuffer(
+      self._buffer, dtype='<f4', count=self.num_items * self.dims,
+      offset=self.vectors_offset).reshape(self.num_items, self.dims)
+    self._positions = None
+    logging.info('IVF index with {} items in {} lists is loaded'.format(
+      self.num_items, self.num_lists))
+
+  def get_n_items(self):
+    return self.num_items
+
+  def get_item_vector(self, item):
+    """Returns the unit-norm vector of an item number."""
+    if self._positions is None:
+      positions = np.empty(self.num_items, dtype=np.uint32)
+      positions[self.ids] = np.arange(self.num_items, dtype=np.uint32)
+      self._positions = positions
+    return self.vectors[self._positions[item]].tolist()
+
+  def get_nns_by_vector(self, vector, num_matches, nprobe=None):
+    """Returns the item numbers of the closest vectors by cosine similarity.
+
+    Args:
+      vector: the query vector.
+      num_matches: number of item numbers to return.
+      nprobe: number of lists to scan, or None for the index default.
+        More lists give a better recall at a higher latency.
+    """
+    query = np.asarray(vector, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    nprobe = max(1, min(nprobe or self.default_nprobe, self.num_lists))
+
+    list_scores = self.centroids.dot(query)
+    lists = np.argpartition(-list_scores, nprobe - 1)[:nprobe]
+    ids, scores = [], []
+    for list_number in lists:
+      start, end = self.offsets[list_number], self.offsets[list_number + 1]
+      if start < end:
+        ids.append(self.ids[start:end])
+        scores.append(self.vectors[start:end].dot(query))
+    if not ids or num_matches <= 0:
+      return []
+
+    ids, scores = np.concatenate(ids), np.concatenate(scores)
+    num_matches = min(num_matches, len(scores))
+    top = np.argpartition(-scores, num_matches - 1)[:num_matches]
+    top = top[np.argsort(-scores[top])]
+    return ids[top].tolist()
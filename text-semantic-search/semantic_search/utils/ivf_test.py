@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ivf
+
+DIMS = 8
+
+
+def write_ivf_index(index_file, centroids, lists, vectors, nprobe=1):
+  """Writes an IVF index file whose lists hold the given item numbers."""
+  ids = np.concatenate(lists).astype('<u4')
+  offsets = np.cumsum([0] + [len(items) for items in lists]).astype('<u8')
+  sections = [centroids.astype('<f4'), offsets, ids,
+              vectors[ids].astype('<f4')]
+  section_offsets, position = [], 128
+  for section in sections:
+    section_offsets.append(position)
+    position += (section.nbytes + 63) // 64 * 64
+  header = np.array([DIMS, len(ids), len(lists), nprobe] + section_offsets,
+                    dtype='<u8')
+  data = np.zeros(position, dtype=np.uint8)
+  data[:len(ivf.MAGIC)] = np.frombuffer(ivf.MAGIC, dtype=np.uint8)
+  data[len(ivf.MAGIC):len(ivf.MAGIC) + header.nbytes] = header.view(np.uint8)
+  for offset, section in zip(section_offsets, sections):
+    data[offset:offset + section.nbytes] = section.view(np.uint8).ravel()
+  data.tofile(index_file)
+
+
+class IVFIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.temp_dir, 'embeds.index')
+    random_state = np.random.RandomState(0)
+    vectors = random_state.normal(size=(40, DIMS))
+    self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Two lists, of the items on each side of the first dimension.
+    self.lists = [np.flatnonzero(self.vectors[:, 0] >= 0),
+                  np.flatnonzero(self.vectors[:, 0] < 0)]
+    centroids = np.zeros((2, DIMS))
+    centroids[0, 0], centroids[1, 0] = 1., -1.
+    write_ivf_index(self.index_file, centroids, self.lists, self.vectors)
+    self.index = ivf.IVFIndex(self.index_file)
+
+  def tearDown(self):
+    del self.index
+    shutil.rmtree(self.temp_dir)
+
+  def exact_neighbours(self, query, num_matches, items=None):
+    items = np.arange(len(self.vectors)) if items is None else items
+    scores = self.vectors[items].dot(query)
+    return items[np.argsort(-scores)[:num_matches]].tolist()
+
+  def test_is_ivf_index(self):
+    self.assertTrue(ivf.is_ivf_index(self.index_file))
+    other_file = os.path.join(self.temp_dir, 'annoy.index')
+    with open(other_file, 'wb') as handle:
+      handle.write(b'\0' * 64)
+    self.assertFalse(ivf.is_ivf_index(other_file))
+
+  def test_header(self):
+    self.assertEqual((self.index.dims, self.index.num_items,
+                      self.index.num_lists, self.index.default_nprobe),
+                     (DIMS, 40, 2, 1))
+
+  def test_probing_every_list_is_exact(self):
+    query = self.vectors[3] + 0.1
+    self.assertEqual(self.index.get_nns_by_vector(query, 5, nprobe=2),
+                     self.exact_neighbours(query, 5))
+
+  def test_probing_one_list_scans_the_closest_list(self):
+    query = self.vectors[self.lists[1][0]]
+    self.assertEqual(self.index.get_nns_by_vector(query, 5),
+                     self.exact_neighbours(query, 5, self.lists[1]))
+
+  def test_num_matches_is_bounded_by_the_probed_items(self):
+    query = self.vectors[self.lists[0][0]]
+    self.assertEqual(len(self.index.get_nns_by_vector(query, 100)),
+                     len(self.lists[0]))
+    self.assertEqual(self.index.get_nns_by_vector(query, 0), [])
+
+  def test_item_vectors_are_found_by_item_number(self):
+    for item in [0, 17, 39]:
+      np.testing.assert_allclose(self.index.get_item_vector(item),
+                                 self.vectors[item], rtol=1e-5)
+
+
+if __name__ == '__main__':
+  unittest.main()
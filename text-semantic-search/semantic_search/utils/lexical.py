@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import math
+import pickle
+import re
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Bounds of the work done per query: posting lists are ordered by impact,
+# so only their head is scored.
+MAX_QUERY_TERMS = 16
+MAX_POSTINGS_PER_TERM = 50000
+
+
+def tokenize(text):
+  if isinstance(text, bytes):
+    text = text.decode('utf-8', 'ignore')
+  return TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalUtil:
+
+  def __init__(self, index_file):
+    logging.info('Initialising lexical matching utility...')
+    with open(index_file + '.lexicon', 'rb') as handle:
+      self.lexicon = pickle.load(handle)
+    self.postings = np.load(index_file + '.postings', mmap_mode='r')
+    self.doc_lengths = np.load(index_file + '.doclens', mmap_mode='r')
+    self.num_docs = len(self.doc_lengths)
+    self.average_length = max(float(self.doc_lengths.mean()), 1.)
+    logging.info('Inverted index with {} terms is loaded'.format(
+      len(self.lexicon)))
+    logging.info('Lexical matching utility initialised.')
+
+  def find_matching_items(self, query, num_matches):
+    """Returns the item numbers of the best BM25 matches of the query."""
+    terms = []
+    for term in tokenize(query):
+      if term in self.lexicon and term not in terms:
+        terms.append(term)
+    # Keep the rarest terms, which carry most of the score.
+    terms = sorted(terms, key=lambda t: self.lexicon[t][1])[:MAX_QUERY_TERMS]
+    if not terms:
+      return []
+
+    items, scores = [], []
+    for term in terms:
+      offset, doc_freq = self.lexicon[term]
+      idf = math.log(1. + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+      postings = self.postings[
+        offset:offset + min(doc_freq, MAX_POSTINGS_PER_TERM)]
+      tfs = postings['tf'].astype(np.float32)
+      norms = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[
+        postings['item']] / self.average_length)
+      items.append(postings['item'])
+      scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norms))
+
+    items, inverse = np.unique(np.concatenate(items), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(scores))
+    num_matches = min(num_matches, len(items))
+    top = np.argpartition(-scores, num_matches - 1)[:num_matches]
+    top = top[np.argsort(-scores[top])]
+    return items[top].tolist()
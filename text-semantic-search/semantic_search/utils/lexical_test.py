@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import lexical
+
+TEXTS = [u'the quick brown fox', u'the lazy dog', u'quick quick dog',
+         u'the the the the dog', u'a brown fox jumps']
+POSTING_DTYPE = np.dtype([('item', '<u4'), ('tf', '<u2')])
+
+
+def write_inverted_index(texts, index_file):
+  """Writes the artefacts of the index builder, in item order."""
+  term_postings = collections.OrderedDict()
+  for item, text in enumerate(texts):
+    for term, tf in sorted(collections.Counter(lexical.tokenize(text)).items()):
+      term_postings.setdefault(term, []).append((item, tf))
+  lexicon, postings = {}, []
+  for term, term_list in term_postings.items():
+    lexicon[term] = (len(postings), len(term_list))
+    postings.extend(term_list)
+  with open(index_file + '.lexicon', 'wb') as handle:
+    pickle.dump(lexicon, handle)
+  with open(index_file + '.postings', 'wb') as handle:
+    np.save(handle, np.array(postings, dtype=POSTING_DTYPE))
+  with open(index_file + '.doclens', 'wb') as handle:
+    np.save(handle, np.array([len(lexical.tokenize(text)) for text in texts],
+                             dtype=np.uint16))
+
+
+class LexicalUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    index_file = os.path.join(self.temp_dir, 'embeds.index')
+    write_inverted_index(TEXTS, index_file)
+    self.lexical_util = lexical.LexicalUtil(index_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def test_rare_terms_outweigh_common_terms(self):
+    # 'lazy' is in one text, while 'the' is in three of them.
+    self.assertEqual(
+      self.lexical_util.find_matching_items(u'the lazy', 1), [1])
+
+  def test_term_frequency_raises_the_score(self):
+    self.assertEqual(
+      self.lexical_util.find_matching_items(u'quick', 2), [2, 0])
+
+  def test_matches_are_limited_to_matching_items(self):
+    self.assertEqual(
+      sorted(self.lexical_util.find_matching_items(u'Fox!', 10)), [0, 4])
+
+  def test_unknown_terms_match_nothing(self):
+    self.assertEqual(self.lexical_util.find_matching_items(u'cat', 10), [])
+    self.assertEqual(self.lexical_util.find_matching_items(u'', 10), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
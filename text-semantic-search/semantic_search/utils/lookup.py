@@ -34,6 +34,10 @@ class DatastoreUtil:
     items = self.client.get_multi(keys)
     return items
 
+  def get_items_by_key(self, keys):
+    """Returns a dict of the items found, by key name."""
+    return dict((item.key.name, item) for item in self.get_items(keys))
+
 
 
 
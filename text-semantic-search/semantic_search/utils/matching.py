@@ -15,32 +15,325 @@
 # limitations under the License.
 
 from annoy import AnnoyIndex
+import collections
+import hashlib
+import ivf
+import metrics
 import numpy as np
 import logging
+import math
+import os
 import pickle
+import threading
+import time
+import warming
 
 VECTOR_LENGTH = 512
 
+# Filters matching at most this number of items are answered by an exact
+# scan over their vectors, instead of over-fetching from the Annoy index.
+BRUTE_FORCE_MAX_ITEMS = 5000
+OVERFETCH_FACTOR = 1.5
+MAX_OVERFETCH_CANDIDATES = 20000
+FILTER_CACHE_SIZE = 16
+
+# Bytes of the descendants count and children of an angular Annoy node,
+# which are followed by the node vector.
+ANNOY_NODE_HEADER_BYTES = 12
+# Queries replayed by the warm load policy, from vectors of random items.
+WARM_QUERY_SAMPLE = 1000
+WARM_QUERY_MATCHES = 10
+# Decay of the moving average of full searches latency, which is compared
+# with the time budget of a search to reduce its search_k or nprobe.
+MATCHING_SECS_DECAY = 0.9
+
+
+def _as_bytes(identifier):
+  if isinstance(identifier, bytes):
+    return identifier
+  return identifier.encode('utf-8')
+
+
+def id_hash(identifier):
+  """Returns the 64-bit hash of an identifier, as the index builder does."""
+  return np.frombuffer(
+    hashlib.md5(_as_bytes(identifier)).digest()[:8], dtype='<u8')[0]
+
+
+class ItemFilter(object):
+  """The items matching a filter, as a mask and as sorted item numbers."""
+
+  def __init__(self, mask):
+    self.mask = mask
+    self.items = np.flatnonzero(mask)
+    self.selectivity = len(self.items) / float(max(len(mask), 1))
+    self.vectors = None
+
 
 class MatchingUtil:
 
-  def __init__(self, index_file):
+  def __init__(self, index_file, load_policy='prefault'):
     logging.info('Initialising matching utility...')
-    self.index = AnnoyIndex(VECTOR_LENGTH)
-    self.index.load(index_file, prefault=True)
-    logging.info('Annoy index {} is loaded'.format(index_file))
+    if load_policy not in warming.LOAD_POLICIES:
+      raise ValueError('Unknown index load policy: {}'.format(load_policy))
+    self.projection_mean, self.projection_matrix = None, None
+    vector_length = VECTOR_LENGTH
+    if os.path.exists(index_file + '.projection'):
+      with open(index_file + '.projection', 'rb') as handle:
+        projection = np.load(handle)
+        self.projection_mean = projection['mean']
+        self.projection_matrix = projection['matrix']
+      vector_length = self.projection_matrix.shape[1]
+      logging.info('Projection to {} dimensions is loaded'.format(
+        vector_length))
+    start_time = time.time()
+    self.index_file = index_file
+    self.vector_length = vector_length
+    self.is_ivf = ivf.is_ivf_index(index_file)
+    if self.is_ivf:
+      self.index = ivf.IVFIndex(index_file)
+      if load_policy == 'prefault':
+        warming.touch_pages(index_file, [(0, os.path.getsize(index_file))])
+    else:
+      self.index = AnnoyIndex(vector_length)
+      self.index.load(index_file, prefault=load_policy == 'prefault')
+      logging.info('Annoy index {} is loaded'.format(index_file))
+    self.is_warm = load_policy == 'prefault'
+    metrics.REGISTRY.set_gauge('index_load_policy', load_policy)
+    metrics.REGISTRY.set_gauge('index_load_secs', time.time() - start_time)
     with open(index_file + '.mapping', 'rb') as handle:
       self.mapping = pickle.load(handle)
     logging.info('Mapping file {} is loaded'.format(index_file + '.mapping'))
+    self.attributes = {}
+    if os.path.exists(index_file + '.attributes'):
+      with open(index_file + '.attributes', 'rb') as handle:
+        arrays = np.load(handle)
+        for key in arrays.files:
+          if key.endswith('_codes'):
+            name = key[:-len('_codes')]
+            vocabulary = arrays[name + '_vocabulary']
+            self.attributes[name] = (
+              dict((value, code) for code, value in enumerate(vocabulary)),
+              arrays[key])
+      logging.info('Attributes {} are loaded'.format(
+        ', '.join(sorted(self.attributes))))
+    self.reverse_index = None
+    if os.path.exists(index_file + '.ids'):
+      self.reverse_index = np.load(index_file + '.ids', mmap_mode='r')
+      logging.info('Reverse mapping {} is loaded'.format(index_file + '.ids'))
+    self._filters = collections.OrderedDict()
+    self._filters_lock = threading.Lock()
+    self._matching_secs = None
+    if load_policy == 'warm':
+      warming.IndexWarmer(
+        index_file, self._warm_ranges(), self._replay_queries,
+        metrics.REGISTRY, on_done=self._set_warm).start()
     logging.info('Matching utility initialised.')
 
-  def find_similar_items(self, vector, num_matches):
-    item_ids = self.index.get_nns_by_vector(
-      vector, num_matches, search_k=-1, include_distances=False)
+  def _warm_ranges(self):
+    """Returns the byte ranges of the index which every query reads."""
+    if self.is_ivf:
+      # Header, centroids, list offsets and item numbers.
+      return [(0, self.index.vectors_offset)]
+    # Annoy writes the item nodes first, then the split nodes of the trees,
+    # and the tree roots last, so the file is warmed backwards from its end.
+    node_size = ANNOY_NODE_HEADER_BYTES + 4 * self.vector_length
+    items_end = self.index.get_n_items() * node_size
+    return [(os.path.getsize(self.index_file), items_end)]
+
+  def _replay_queries(self):
+    num_items = self.index.get_n_items()
+    sample = np.random.RandomState(0).choice(
+      num_items, min(WARM_QUERY_SAMPLE, num_items), replace=False)
+    for item in sample:
+      self._get_nns(self.index.get_item_vector(int(item)), WARM_QUERY_MATCHES)
+    return len(sample)
+
+  def _set_warm(self):
+    self.is_warm = True
+
+  def _get_nns(self, vector, num_matches, nprobe=None, effort=1.):
+    """Returns the nearest item numbers, nprobe only applies to IVF.
+
+    An effort below 1 scales down the lists probed by an IVF index, or the
+    nodes inspected by an Annoy index, from their default number.
+    """
+    if self.is_ivf:
+      if effort < 1:
+        nprobe = max(1, int((nprobe or self.index.default_nprobe) * effort))
+      return self.index.get_nns_by_vector(vector, num_matches, nprobe)
+    search_k = -1
+    if effort < 1:
+      search_k = max(num_matches, int(
+        num_matches * self.index.get_n_trees() * effort))
+    return self.index.get_nns_by_vector(
+      vector, num_matches, search_k=search_k, include_distances=False)
+
+  def project(self, vector):
+    if self.projection_matrix is None:
+      return vector
+    return (np.asarray(vector) - self.projection_mean).dot(
+      self.projection_matrix)
+
+  def _get_filter(self, filters):
+    """Returns the ItemFilter of a {attribute: [values]} dict of filters."""
+    key = tuple(sorted((name, tuple(sorted(set(values))))
+                       for name, values in filters.items()))
+    with self._filters_lock:
+      if key in self._filters:
+        item_filter = self._filters.pop(key)
+        self._filters[key] = item_filter
+        return item_filter
+
+    mask = np.ones(self.index.get_n_items(), dtype=bool)
+    for name, values in key:
+      if name not in self.attributes:
+        raise ValueError('Unknown filter attribute: {}'.format(name))
+      vocabulary, codes = self.attributes[name]
+      selected_codes = [vocabulary[value] for value in values
+                        if value in vocabulary]
+      mask &= np.in1d(codes, selected_codes)
+    item_filter = ItemFilter(mask)
+
+    if len(item_filter.items) <= BRUTE_FORCE_MAX_ITEMS:
+      vectors = np.array([self.index.get_item_vector(item)
+                          for item in item_filter.items], dtype=np.float32)
+      norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+      item_filter.vectors = vectors / np.maximum(norms, 1e-12)
+
+    with self._filters_lock:
+      self._filters[key] = item_filter
+      while len(self._filters) > FILTER_CACHE_SIZE:
+        self._filters.popitem(last=False)
+    return item_filter
+
+  def _find_filtered_items(self, vector, num_matches, item_filter,
+                           nprobe=None, effort=1.):
+    if len(item_filter.items) == 0:
+      return []
+
+    if item_filter.vectors is not None:
+      # Very selective filter: exact cosine scan over the matching items.
+      scores = item_filter.vectors.dot(vector)
+      num_matches = min(num_matches, len(scores))
+      top = np.argpartition(-scores, num_matches - 1)[:num_matches]
+      top = top[np.argsort(-scores[top])]
+      return item_filter.items[top].tolist()
+
+    # Over-fetch in proportion to the filter selectivity, and grow the
+    # candidates list until enough of them pass the filter.
+    num_candidates = int(math.ceil(
+      OVERFETCH_FACTOR * num_matches / item_filter.selectivity))
+    while True:
+      num_candidates = min(num_candidates, MAX_OVERFETCH_CANDIDATES,
+                           self.index.get_n_items())
+      candidates = self._get_nns(vector, num_candidates, nprobe, effort)
+      item_ids = [item_id for item_id in candidates
+                  if item_filter.mask[item_id]][:num_matches]
+      if len(item_ids) == num_matches or \
+          num_candidates in (MAX_OVERFETCH_CANDIDATES,
+                             self.index.get_n_items()):
+        return item_ids
+      num_candidates *= 2
+
+  def filter_items(self, item_ids, filters):
+    item_filter = self._get_filter(filters)
+    return [item_id for item_id in item_ids if item_filter.mask[item_id]]
+
+  def get_identifiers(self, item_ids):
+    return [self.mapping[item_id] for item_id in item_ids]
+
+  def find_similar_items(self, vector, num_matches, filters=None,
+                         nprobe=None):
+    identifiers, _ = self.find_similar_items_within(
+      vector, num_matches, filters, nprobe)
+    return identifiers
+
+  def find_similar_items_within(self, vector, num_matches, filters=None,
+                                nprobe=None, budget_secs=None):
+    """Finds similar items, with less effort if the budget is short.
+
+    Returns:
+      The identifiers of the items, and whether the search effort was
+      reduced to fit in budget_secs.
+    """
+    effort = 1.
+    if budget_secs is not None and self._matching_secs:
+      effort = min(1., max(budget_secs, 0.) / self._matching_secs)
+    timer_name = 'matching_secs_warm' if self.is_warm else 'matching_secs_cold'
+    start_time = time.time()
+    with metrics.REGISTRY.timer(timer_name):
+      identifiers = self._find_similar_items(
+        vector, num_matches, filters, nprobe, effort)
+    # Very selective filters are scanned exactly, whatever the effort.
+    if filters and self._get_filter(filters).vectors is not None:
+      return identifiers, False
+    if effort == 1.:
+      elapsed_secs = time.time() - start_time
+      self._matching_secs = elapsed_secs if self._matching_secs is None else (
+        MATCHING_SECS_DECAY * self._matching_secs +
+        (1 - MATCHING_SECS_DECAY) * elapsed_secs)
+    return identifiers, effort < 1.
+
+  def _find_similar_items(self, vector, num_matches, filters, nprobe,
+                          effort=1.):
+    item_ids = self._find_similar_item_numbers(
+      self.project(vector), num_matches, filters, nprobe, effort)
     identifiers = [self.mapping[item_id]
                    for item_id in item_ids]
     return identifiers
 
+  def _find_similar_item_numbers(self, vector, num_matches, filters, nprobe,
+                                 effort=1.):
+    """Returns the item numbers closest to a vector of the index space."""
+    if filters:
+      return self._find_filtered_items(
+        np.asarray(vector, dtype=np.float32), num_matches,
+        self._get_filter(filters), nprobe, effort)
+    return self._get_nns(vector, num_matches, nprobe, effort)
+
+  def get_item_number(self, identifier):
+    """Returns the item number of an identifier, or None if unknown."""
+    if self.reverse_index is None:
+      raise ValueError('Similar items by id need the .ids index artefact.')
+    key = _as_bytes(identifier)
+    key_hash = id_hash(key)
+    hashes = self.reverse_index['hash']
+    position = int(np.searchsorted(hashes, key_hash))
+    # Distinct identifiers may share a hash, and are told apart by mapping.
+    while position < len(hashes) and hashes[position] == key_hash:
+      item_number = int(self.reverse_index['item'][position])
+      if _as_bytes(self.mapping[item_number]) == key:
+        return item_number
+      position += 1
+    return None
+
+  def find_similar_items_by_id(self, identifiers, num_matches, filters=None,
+                               nprobe=None):
+    """Finds the items similar to indexed items, from their stored vectors.
+
+    Returns:
+      A list with the identifiers of the similar items of each identifier,
+      excluding the item itself, or None for unknown identifiers.
+    """
+    results = []
+    for identifier in identifiers:
+      item_number = self.get_item_number(identifier)
+      if item_number is None:
+        results.append(None)
+        continue
+      if filters or self.is_ivf:
+        item_ids = self._find_similar_item_numbers(
+          self.index.get_item_vector(item_number), num_matches + 1,
+          filters, nprobe)
+      else:
+        item_ids = self.index.get_nns_by_item(
+          item_number, num_matches + 1, search_k=-1, include_distances=False)
+      item_ids = [item_id for item_id in item_ids
+                  if item_id != item_number][:num_matches]
+      results.append(self.get_identifiers(item_ids))
+    return results
+
   def find_similar_vectors(self, vector, num_matches):
     items = self.find_similar_items(vector, num_matches)
     vectors = [np.array(self.index.get_item_vector(item))
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import resource
+import threading
+import time
+
+
+def resident_memory_bytes():
+  """Returns the resident memory of this process, or its peak if unknown."""
+  try:
+    with open('/proc/self/statm') as handle:
+      resident_pages = int(handle.read().split()[1])
+    return resident_pages * resource.getpagesize()
+  except (IOError, OSError):
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Timing(object):
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.
+    self.max = 0.
+
+  def observe(self, value):
+    self.count += 1
+    self.total += value
+    self.max = max(self.max, value)
+
+  def to_dict(self):
+    return {'count': self.count, 'max': self.max,
+            'mean': self.total / self.count if self.count else 0.}
+
+
+class Metrics(object):
+  """A thread-safe registry of counters, gauges and timings."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._gauges = {}
+    self._timings = {}
+
+  def increment(self, name, value=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def set_gauge(self, name, value):
+    with self._lock:
+      self._gauges[name] = value
+
+  def observe(self, name, secs):
+    with self._lock:
+      if name not in self._timings:
+        self._timings[name] = _Timing()
+      self._timings[name].observe(secs)
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start_time)
+
+  def snapshot(self):
+    with self._lock:
+      gauges = dict(self._gauges)
+      gauges['resident_memory_bytes'] = resident_memory_bytes()
+      return {
+        'counters': dict(self._counters),
+        'gauges': gauges,
+        'timings': dict((name, timing.to_dict())
+                        for name, timing in self._timings.items())}
+
+
+# The registry of the app, exposed by the /metrics endpoint.
+REGISTRY = Metrics()
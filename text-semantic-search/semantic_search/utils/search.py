@@ -14,12 +14,20 @@
 # See the License for the specif5ic language governing permissions and
 # limitations under the License.
 
+import batching
 import embedding
 import matching
 import lookup
+import lexical
+import metrics
+import base64
 import os
 import logging
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import googleapiclient
+from googleapiclient.errors import HttpError
 from httplib2 import Http
 from oauth2client.client import GoogleCredentials
 
@@ -29,6 +37,45 @@ KIND = 'wikipedia'
 GCS_INDEX_LOCATION = '{}/index/embeds.index'.format(KIND)
 INDEX_FILE = 'embeds.index'
 CHUNKSIZE = 16 * 1024 * 1024
+# One of 'prefault', 'lazy' or 'warm', see warming.LOAD_POLICIES.
+INDEX_LOAD_POLICY = 'prefault'
+# Artefacts which are only produced by some index builder configurations.
+OPTIONAL_ARTEFACTS = ['.projection', '.attributes',
+                      '.lexicon', '.postings', '.doclens', '.ids']
+
+SEARCH_MODES = ['semantic', 'hybrid']
+# Number of candidates retrieved by each pass of the hybrid search, and
+# the constant of the reciprocal rank fusion of their rankings.
+HYBRID_CANDIDATES = 100
+RRF_K = 60
+THREAD_POOL_SIZE = 12
+
+# Concurrent queries are embedded in batches, and their embeddings cached.
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_BATCH_WAIT_SECS = 0.002
+EMBEDDING_CACHE_SIZE = 10000
+
+# Requests are answered within a deadline, which is shared between the
+# stages of the search in these proportions. A stage which overruns its
+# share is degraded: lexical results replace the semantic ones when the
+# query embedding is late, the ANN search inspects fewer candidates, and
+# identifiers are returned without their Datastore entities.
+DEFAULT_DEADLINE_SECS = 1.
+MAX_DEADLINE_SECS = 10.
+STAGES = ['embed', 'match', 'lookup']
+STAGE_SHARES = {'embed': 0.3, 'match': 0.3, 'lookup': 0.4}
+
+# Pages have at most MAX_SHOW items. The first page of a search computes
+# the candidates of PAGES_PER_SEARCH pages, up to MAX_CANDIDATES, which are
+# kept for CURSOR_TTL_SECS, and for CURSOR_CACHE_CANDIDATES candidates of
+# all searches at most.
+MAX_SHOW = 100
+# Maximum number of items of a batched similar items request.
+MAX_SIMILAR_IDS = 100
+PAGES_PER_SEARCH = 5
+MAX_CANDIDATES = 500
+CURSOR_TTL_SECS = 600
+CURSOR_CACHE_CANDIDATES = 1000000
 
 
 def _download_from_gcs(gcs_services, bucket_name, gcs_location, local_file_name):
@@ -60,6 +107,57 @@ def download_artefacts(index_file, bucket_name, gcs_index_location):
   _download_from_gcs(gcs_services, bucket_name, gcs_index_location, index_file)
   _download_from_gcs(gcs_services, bucket_name,
                      gcs_index_location + '.mapping', index_file + '.mapping')
+  for suffix in OPTIONAL_ARTEFACTS:
+    try:
+      _download_from_gcs(gcs_services, bucket_name,
+                         gcs_index_location + suffix, index_file + suffix)
+    except HttpError as error:
+      if error.resp.status != 404:
+        raise
+      print('Optional artefact {} is not found.'.format(suffix))
+      if os.path.exists(index_file + suffix):
+        os.remove(index_file + suffix)
+
+
+def fuse_rankings(rankings, num_matches, rrf_k=RRF_K):
+  """Fuses rankings of identifiers with reciprocal rank fusion."""
+  scores = {}
+  for ranking in rankings:
+    for rank, identifier in enumerate(ranking):
+      scores[identifier] = scores.get(identifier, 0.) + 1. / (rrf_k + rank + 1)
+  fused = sorted(scores, key=lambda identifier: -scores[identifier])
+  return fused[:num_matches]
+
+
+def encode_cursor(list_id, offset):
+  cursor = '{}:{}'.format(list_id, offset).encode('utf-8')
+  return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def decode_cursor(cursor):
+  """Returns the (list_id, offset) of a cursor, or raises ValueError."""
+  try:
+    list_id, offset = base64.urlsafe_b64decode(
+      cursor.encode('ascii')).decode('utf-8').split(':')
+    return list_id, int(offset)
+  except (TypeError, ValueError, UnicodeError):
+    raise ValueError('Invalid cursor!')
+
+
+class Deadline(object):
+  """The time left to answer a request, shared between its stages."""
+
+  def __init__(self, secs):
+    self.expires = time.time() + secs
+
+  def remaining(self):
+    return max(0., self.expires - time.time())
+
+  def budget(self, stage):
+    """Returns the share of the remaining time of a stage, among the
+    stages which are left."""
+    shares = [STAGE_SHARES[name] for name in STAGES[STAGES.index(stage):]]
+    return self.remaining() * shares[0] / sum(shares)
 
 
 class SearchUtil:
@@ -76,24 +174,161 @@ class SearchUtil:
     print('Index artefacts downloaded.')
 
     print('Initialising matching util...')
-    self.match_util = matching.MatchingUtil(index_file)
+    self.match_util = matching.MatchingUtil(index_file, INDEX_LOAD_POLICY)
     print('Matching util initialised.')
 
+    self.lexical_util = None
+    if os.path.exists(index_file + '.lexicon'):
+      print('Initialising lexical util...')
+      self.lexical_util = lexical.LexicalUtil(index_file)
+      print('Lexical util initialised.')
+
+    self.thread_pool = ThreadPool(processes=THREAD_POOL_SIZE)
+
     print('Initialising embedding util...')
     self.embed_util = embedding.EmbedUtil()
+    self.embed_batcher = batching.MicroBatcher(
+      self.embed_util.extract_embeddings_batch,
+      max_batch_size=EMBEDDING_BATCH_SIZE,
+      max_wait_secs=EMBEDDING_BATCH_WAIT_SECS)
+    self.embedding_cache = batching.LRUCache(EMBEDDING_CACHE_SIZE)
     print('Embedding util initialised.')
 
+    self.candidate_cache = batching.CandidateCache(
+      CURSOR_TTL_SECS, CURSOR_CACHE_CANDIDATES)
+
     print('Initialising datastore util...')
     self.datastore_util = lookup.DatastoreUtil(KIND)
     print('Datastore util is initialised.')
 
     print('Search utility is up and running.')
 
-  def search(self, query, num_matches=10):
-    query_embedding = self.embed_util.extract_embeddings(query)
-    item_ids = self.match_util.find_similar_items(query_embedding, num_matches)
-    items = self.datastore_util.get_items(item_ids)
-    return items
+  def _lexical_search(self, query, num_matches, filters):
+    item_ids = self.lexical_util.find_matching_items(query, num_matches)
+    if filters:
+      item_ids = self.match_util.filter_items(item_ids, filters)
+    return self.match_util.get_identifiers(item_ids)
+
+  def _embed(self, query, timeout=None):
+    query_embedding = self.embedding_cache.get(query)
+    if query_embedding is None:
+      query_embedding = self.embed_batcher.submit(query, timeout)
+      self.embedding_cache.put(query, query_embedding)
+    return query_embedding
+
+  def _semantic_search(self, query, num_matches, filters, nprobe, deadline,
+                       degraded):
+    # Without an inverted index to fall back on, the embedding is awaited.
+    try:
+      query_embedding = self._embed(
+        query, None if self.lexical_util is None else deadline.budget('embed'))
+    except batching.BatchTimeout:
+      degraded.add('embed')
+      return self._lexical_search(query, num_matches, filters)
+    identifiers, reduced = self.match_util.find_similar_items_within(
+      query_embedding, num_matches, filters, nprobe, deadline.budget('match'))
+    if reduced:
+      degraded.add('match')
+    return identifiers
+
+  def _hybrid_search(self, query, num_matches, filters, nprobe, deadline,
+                     degraded):
+    if self.lexical_util is None:
+      raise ValueError('Hybrid search needs the inverted index artefacts.')
+    num_candidates = max(num_matches, HYBRID_CANDIDATES)
+    lexical_result = self.thread_pool.apply_async(
+      self._lexical_search, (query, num_candidates, filters))
+    semantic_ids = self._semantic_search(
+      query, num_candidates, filters, nprobe, deadline, degraded)
+    try:
+      lexical_ids = lexical_result.get(timeout=deadline.budget('match'))
+    except TimeoutError:
+      degraded.add('match')
+      return semantic_ids[:num_matches]
+    return fuse_rankings([semantic_ids, lexical_ids], num_matches)
+
+  def _lookup(self, identifiers, deadline, degraded):
+    lookup_result = self.thread_pool.apply_async(
+      self.datastore_util.get_items, (identifiers,))
+    try:
+      return lookup_result.get(timeout=deadline.budget('lookup'))
+    except TimeoutError:
+      degraded.add('lookup')
+      return [{'id': identifier} for identifier in identifiers]
+
+  def similar(self, identifiers, num_matches=10, filters=None, nprobe=None,
+              deadline_secs=DEFAULT_DEADLINE_SECS):
+    """Finds the items similar to indexed items, without embedding.
+
+    Returns:
+      A list with the similar items of each identifier, or None for unknown
+      identifiers, and the sorted list of the degraded stages.
+    """
+    metrics.REGISTRY.increment('similar_requests')
+    with metrics.REGISTRY.timer('similar_secs'):
+      deadline = Deadline(deadline_secs)
+      results = self.match_util.find_similar_items_by_id(
+        identifiers, num_matches, filters, nprobe)
+      found = set(identifier for result in results if result is not None
+                  for identifier in result)
+      lookup_result = self.thread_pool.apply_async(
+        self.datastore_util.get_items_by_key, (list(found),))
+      try:
+        items = lookup_result.get(timeout=deadline.budget('lookup'))
+        degraded = []
+      except TimeoutError:
+        items = dict((identifier, {'id': identifier}) for identifier in found)
+        degraded = ['lookup']
+        metrics.REGISTRY.increment('similar_degraded_lookup')
+
+    return [None if result is None else
+            [items[identifier] for identifier in result if identifier in items]
+            for result in results], degraded
+
+  def search(self, query, num_matches=10, filters=None, mode='semantic',
+             nprobe=None, deadline_secs=DEFAULT_DEADLINE_SECS, cursor=None):
+    """Searches a page of items, degrading the stages which overrun their
+    budget.
+
+    The first page computes the candidates of the next pages too, which
+    later pages read back with the returned cursor instead of the query.
 
+    Returns:
+      The items, the sorted list of the degraded stages, and the cursor of
+      the next page, or None for the last page.
+    """
+    metrics.REGISTRY.increment('search_requests')
+    with metrics.REGISTRY.timer('search_secs'):
+      deadline = Deadline(deadline_secs)
+      degraded = set()
+      if cursor is None:
+        num_candidates = min(MAX_CANDIDATES, num_matches * PAGES_PER_SEARCH)
+        if mode == 'hybrid':
+          identifiers = self._hybrid_search(
+            query, num_candidates, filters, nprobe, deadline, degraded)
+        else:
+          identifiers = self._semantic_search(
+            query, num_candidates, filters, nprobe, deadline, degraded)
+        list_id, offset = None, 0
+        if len(identifiers) > num_matches:
+          list_id = self.candidate_cache.put(identifiers)
+      else:
+        metrics.REGISTRY.increment('search_cursor_requests')
+        list_id, offset = decode_cursor(cursor)
+        identifiers = self.candidate_cache.get(list_id)
+        # Offsets out of the list are forged, since cursors only point to
+        # the pages which are left.
+        if identifiers is None or not 0 <= offset < len(identifiers):
+          raise ValueError('The cursor has expired, search again!')
 
+      next_offset = offset + num_matches
+      next_cursor = None
+      if list_id is not None and next_offset < len(identifiers):
+        next_cursor = encode_cursor(list_id, next_offset)
+      items = self._lookup(identifiers[offset:next_offset], deadline, degraded)
 
+    if degraded:
+      metrics.REGISTRY.increment('search_degraded_requests')
+      for stage in degraded:
+        metrics.REGISTRY.increment('search_degraded_{}'.format(stage))
+    return items, sorted(degraded), next_cursor
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import search
+
+
+class FuseRankingsTest(unittest.TestCase):
+
+  def test_items_of_both_rankings_come_first(self):
+    fused = search.fuse_rankings([['a', 'b', 'c'], ['c', 'd', 'a']], 4)
+    self.assertEqual(sorted(fused[:2]), ['a', 'c'])
+    self.assertEqual(sorted(fused[2:]), ['b', 'd'])
+
+  def test_fused_ranking_is_truncated(self):
+    self.assertEqual(search.fuse_rankings([['a', 'b'], ['b']], 1), ['b'])
+
+  def test_reciprocal_ranks_are_summed(self):
+    fused = search.fuse_rankings([['a', 'b'], ['b', 'a'], ['c']], 3, rrf_k=0)
+    # a and b both score 1 + 1/2, c scores 1.
+    self.assertEqual(sorted(fused[:2]), ['a', 'b'])
+    self.assertEqual(fused[2], 'c')
+
+  def test_empty_rankings(self):
+    self.assertEqual(search.fuse_rankings([[], []], 10), [])
+
+
+class CursorTest(unittest.TestCase):
+
+  def test_cursor_round_trip(self):
+    cursor = search.encode_cursor('0123abcd', 20)
+    self.assertEqual(search.decode_cursor(cursor), ('0123abcd', 20))
+
+  def test_cursor_is_url_safe(self):
+    cursor = search.encode_cursor('f' * 32, 123456)
+    self.assertTrue(all(c.isalnum() or c in '-_=' for c in cursor))
+
+  def test_invalid_cursors_are_rejected(self):
+    for cursor in [u'', u'not a cursor', search.encode_cursor('abc', 'x'),
+                   u'\u00e9t\u00e9']:
+      with self.assertRaises(ValueError):
+        search.decode_cursor(cursor)
+
+
+if __name__ == '__main__':
+  unittest.main()
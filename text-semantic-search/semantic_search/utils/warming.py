@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import threading
+import time
+
+# prefault: page the whole index in before serving.
+# lazy: memory-map the index, and page it in as queries touch it.
+# warm: lazy, and page the hottest parts in with a background thread.
+LOAD_POLICIES = ['prefault', 'lazy', 'warm']
+
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def _load_readahead():
+  """Returns readahead(2) of libc, or None where it is not available."""
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    readahead = libc.readahead
+  except (OSError, AttributeError):
+    return None
+  readahead.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_size_t]
+  readahead.restype = ctypes.c_ssize_t
+  return readahead
+
+
+# Python 2 has neither mmap.madvise nor os.posix_fadvise, so the kernel is
+# asked to read ahead through libc instead.
+_readahead = _load_readahead()
+
+
+def _advise_willneed(handle, index_map, start, end):
+  """Asks the kernel to read a byte range ahead into the page cache, which
+  the memory maps of the index share."""
+  if hasattr(index_map, 'madvise'):
+    aligned_start = start - start % PAGE_SIZE
+    index_map.madvise(mmap.MADV_WILLNEED, aligned_start, end - aligned_start)
+  elif _readahead is not None:
+    if _readahead(handle.fileno(), start, end - start) != 0:
+      logging.warning('readahead of {} failed with errno {}.'.format(
+        handle.name, ctypes.get_errno()))
+  elif hasattr(os, 'posix_fadvise'):
+    os.posix_fadvise(handle.fileno(), start, end - start,
+                     os.POSIX_FADV_WILLNEED)
+  else:
+    logging.warning('No read ahead hint is supported, pages are only touched.')
+
+
+def touch_pages(index_file, ranges):
+  """Pages the byte ranges of a file in, in order.
+
+  Ranges whose start is after their end are touched backwards, from their
+  start down to their end.
+
+  Returns:
+    The number of bytes touched.
+  """
+  touched = 0
+  file_size = os.path.getsize(index_file)
+  if not file_size:
+    return touched
+  with open(index_file, 'rb') as handle:
+    index_map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for start, end in ranges:
+        backwards = start > end
+        low, high = (end, start) if backwards else (start, end)
+        low, high = max(low, 0), min(high, file_size)
+        if low >= high:
+          continue
+        _advise_willneed(handle, index_map, low, high)
+        offsets = range(low - low % PAGE_SIZE, high, PAGE_SIZE)
+        for offset in (reversed(offsets) if backwards else offsets):
+          index_map[max(offset, low)]
+        touched += high - low
+    finally:
+      index_map.close()
+  return touched
+
+
+class IndexWarmer(threading.Thread):
+  """Pages the hottest parts of an index in, without blocking startup.
+
+  The warmer first touches the priority byte ranges of the index file, such
+  as the tree nodes of an Annoy index, and then replays a sample of queries
+  against the index, which pages in what real queries are likely to read.
+  """
+
+  def __init__(self, index_file, ranges, replay_fn, metrics, on_done=None):
+    super(IndexWarmer, self).__init__()
+    self.daemon = True
+    self._index_file = index_file
+    self._ranges = ranges
+    self._replay_fn = replay_fn
+    self._metrics = metrics
+    self._on_done = on_done
+
+  def run(self):
+    start_time = time.time()
+    try:
+      touched = touch_pages(self._index_file, self._ranges)
+      self._metrics.set_gauge('index_warm_touched_bytes', touched)
+      self._metrics.set_gauge(
+        'index_warm_ranges_secs', time.time() - start_time)
+      logging.info('Warmed {} bytes of {} in {:.1f} secs.'.format(
+        touched, self._index_file, time.time() - start_time))
+      num_queries = self._replay_fn()
+      self._metrics.set_gauge('index_warm_replayed_queries', num_queries)
+    except Exception:
+      logging.exception('Index warming failed.')
+      self._metrics.increment('index_warm_errors')
+    self._metrics.set_gauge('index_warm_secs', time.time() - start_time)
+    logging.info('Index {} is warm after {:.1f} secs.'.format(
+      self._index_file, time.time() - start_time))
+    if self._on_done is not None:
+      self._on_done()